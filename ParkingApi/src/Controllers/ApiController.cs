@@ -3,7 +3,9 @@ using System.Collections.Generic;
 using System.Linq;
 using System.Threading.Tasks;
 using Microsoft.AspNetCore.Mvc;
+using Microsoft.Extensions.Configuration;
 using Microsoft.Extensions.Logging;
+using InfluxDB.Client.Core.Flux.Domain;
 using ParkingApi.Models;
 using ParkingApi.Services;
 
@@ -17,17 +19,25 @@ public class ParkingController : ControllerBase
     private readonly PostgresService _postgresService;
     private readonly ILogger<ParkingController> _logger;
     private readonly ICacheService _cacheService;
+    private readonly ParkingStateService _parkingStateService;
+    private readonly TimeSpan _stateMaxAge;
+    private readonly string? _rollupBucket;
 
     public ParkingController(
         InfluxDbService influxDbService,
         PostgresService postgresService,
         ILogger<ParkingController> logger,
-        ICacheService cacheService)
+        ICacheService cacheService,
+        ParkingStateService parkingStateService,
+        IConfiguration configuration)
     {
         _influxDbService = influxDbService;
         _postgresService = postgresService;
         _logger = logger;
         _cacheService = cacheService;
+        _parkingStateService = parkingStateService;
+        _stateMaxAge = TimeSpan.FromSeconds(configuration.GetValue<int>("Redis:StateMaxAgeSeconds", 3600));
+        _rollupBucket = configuration["InfluxDB:RollupBucket"];
     }
 
     [HttpGet("status")]
@@ -52,7 +62,40 @@ public class ParkingController : ControllerBase
                 {
                     _logger.LogInformation("Cache miss for {CacheKey}, querying from database", cacheKey);
 
-                    _logger.LogInformation("Starting query to InfluxDB");
+                    var fetchedParkingLots = new List<ParkingStatus>();
+
+                    // Актуальное состояние iot_controller пишет в Redis (write-through): сначала читаем его
+                    var latestState = await _parkingStateService.GetFreeSpotsAsync(_stateMaxAge);
+                    foreach (var (deviceId, freeSpots) in latestState.FreeSpots)
+                    {
+                        var location = await _cacheService.GetOrCreateAsync(
+                            $"parking:location:{deviceId}",
+                            () => _postgresService.GetParkingLotLocationAsync(deviceId),
+                            TimeSpan.FromMinutes(30) // Местоположение меняется редко
+                        );
+
+                        if (location.HasValue)
+                        {
+                            fetchedParkingLots.Add(new ParkingStatus
+                            {
+                                Id = deviceId,
+                                FreeSpots = freeSpots,
+                                Lat = location.Value.lat,
+                                Lon = location.Value.lon
+                            });
+                        }
+                    }
+
+                    // InfluxDB опрашивается, если в Redis нет свежего состояния всех устройств
+                    bool fromRedisOnly = latestState.Complete && fetchedParkingLots.Count > 0;
+                    if (fetchedParkingLots.Count > 0)
+                    {
+                        _logger.LogInformation("Loaded {Count} parking lots from Redis state", fetchedParkingLots.Count);
+                    }
+                    if (!fromRedisOnly)
+                    {
+                        _logger.LogInformation("Starting query to InfluxDB");
+                    }
 
                     // Улучшенный запрос к InfluxDB, который получает последние данные для каждого устройства
                     string query = @"from(bucket:""iot_bucket"") 
@@ -62,8 +105,9 @@ public class ParkingController : ControllerBase
                                     |> group(columns: [""device_id""])
                                     |> last()";
 
-                    var result = await _influxDbService.QueryAsync(query);
-                    var fetchedParkingLots = new List<ParkingStatus>();
+                    var result = fromRedisOnly
+                        ? new List<FluxTable>()
+                        : await _influxDbService.QueryAsync(query);
 
                     foreach (var table in result)
                     {
@@ -83,6 +127,10 @@ public class ParkingController : ControllerBase
                                 _logger.LogWarning($"Skipping record due to invalid free_spots: {record}");
                                 continue;
                             }
+                            if (latestState.FreeSpots.ContainsKey(deviceId))
+                            {
+                                continue; // Состояние из Redis свежее
+                            }
 
                             // Кэшируем местоположение парковки
                             var locationCacheKey = $"parking:location:{deviceId}";
@@ -113,11 +161,19 @@ public class ParkingController : ControllerBase
                     if (fetchedParkingLots.Count == 0)
                     {
                         _logger.LogWarning("No data found in InfluxDB for the last hour, trying with extended time range.");
-                        query = @"from(bucket:""iot_bucket"") 
+                        // Минутные агрегаты iot_controller (last) дают то же значение, читая в разы меньше точек
+                        query = string.IsNullOrEmpty(_rollupBucket)
+                            ? @"from(bucket:""iot_bucket"") 
                                 |> range(start: -24h) 
                                 |> filter(fn: (r) => r._measurement == ""parking_data"")
                                 |> filter(fn: (r) => r._field == ""free_spots"")
                                 |> group(columns: [""device_id""])
+                                |> last()"
+                            : $@"from(bucket:""{_rollupBucket}"") 
+                                |> range(start: -24h) 
+                                |> filter(fn: (r) => r._measurement == ""parking_rollup"")
+                                |> filter(fn: (r) => r.window == ""1m"" and r._field == ""last"")
+                                |> group(columns: [""device_id""])
                                 |> last()";
 
                         result = await _influxDbService.QueryAsync(query);
@@ -36,6 +36,15 @@ builder.Services.AddStackExchangeRedisCache(options =>
 // Add custom cache service
 builder.Services.AddScoped<ICacheService, RedisCacheService>();
 
+// Текущее состояние парковок, которое пишет iot_controller
+builder.Services.AddSingleton<ParkingStateService>(sp =>
+{
+    var configuration = sp.GetRequiredService<IConfiguration>();
+    var logger = sp.GetRequiredService<ILogger<ParkingStateService>>();
+    var keyPrefix = configuration["Redis:StateKeyPrefix"] ?? "parking:state:";
+    return new ParkingStateService(configuration.GetConnectionString("Redis"), keyPrefix, logger);
+});
+
 // Проверяем наличие переменной окружения USE_MOCK_DATA
 var useMockData = Environment.GetEnvironmentVariable("USE_MOCK_DATA")?.ToLower() == "true";
 
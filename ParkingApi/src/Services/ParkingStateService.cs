@@ -0,0 +1,133 @@
+using System;
+using System.Collections.Generic;
+using System.Linq;
+using System.Threading;
+using System.Threading.Tasks;
+using Microsoft.Extensions.Logging;
+using StackExchange.Redis;
+
+namespace ParkingApi.Services;
+
+/// <summary>
+/// Свободные места из Redis по device_id. Complete - свежее состояние есть у всех устройств
+/// из parking:state:devices; иначе недостающие устройства надо дочитать из InfluxDB.
+/// </summary>
+public class ParkingStateSnapshot
+{
+    public Dictionary<int, int> FreeSpots { get; } = new();
+    public bool Complete { get; set; }
+}
+
+/// <summary>
+/// Текущее состояние парковок, которое iot_controller пишет в Redis (write-through):
+/// хэш parking:state:{device_id} и множество parking:state:devices.
+/// К Redis подключается при первом запросе, а не в конструкторе: без строки подключения
+/// или при недоступном Redis сервис возвращает пустой результат, и контроллер читает InfluxDB.
+/// </summary>
+public class ParkingStateService
+{
+    private static readonly RedisValue[] Fields = { "free_spots", "timestamp" };
+    private static readonly TimeSpan ReconnectDelay = TimeSpan.FromSeconds(30);
+
+    private readonly string? _connectionString;
+    private readonly string _keyPrefix;
+    private readonly ILogger<ParkingStateService> _logger;
+    private readonly SemaphoreSlim _connectLock = new(1, 1);
+    private ConnectionMultiplexer? _redis;
+    private DateTime _nextConnectAttempt = DateTime.MinValue;
+
+    public ParkingStateService(string? connectionString, string keyPrefix, ILogger<ParkingStateService> logger)
+    {
+        _connectionString = connectionString;
+        _keyPrefix = keyPrefix;
+        _logger = logger;
+        if (string.IsNullOrEmpty(connectionString))
+            _logger.LogWarning("ConnectionStrings:Redis is not set, parking state is read from InfluxDB only");
+    }
+
+    /// <summary>
+    /// Подключение к Redis; null, если Redis не настроен или последняя попытка подключиться
+    /// не удалась меньше ReconnectDelay назад.
+    /// </summary>
+    private async Task<ConnectionMultiplexer?> GetConnectionAsync()
+    {
+        if (_redis != null)
+            return _redis;
+        if (string.IsNullOrEmpty(_connectionString) || DateTime.UtcNow < _nextConnectAttempt)
+            return null;
+
+        await _connectLock.WaitAsync();
+        try
+        {
+            if (_redis == null && DateTime.UtcNow >= _nextConnectAttempt)
+            {
+                try
+                {
+                    _redis = await ConnectionMultiplexer.ConnectAsync(_connectionString);
+                }
+                catch (Exception ex)
+                {
+                    _logger.LogWarning(ex, "Failed to connect to Redis, retrying in {Delay}", ReconnectDelay);
+                    _nextConnectAttempt = DateTime.UtcNow + ReconnectDelay;
+                }
+            }
+            return _redis;
+        }
+        finally
+        {
+            _connectLock.Release();
+        }
+    }
+
+    /// <summary>
+    /// Свободные места по device_id для устройств, приславших данные не раньше maxAge назад.
+    /// Устройства без свежего состояния делают снимок неполным (Complete = false), как и любая
+    /// ошибка Redis, включая таймауты: тогда контроллер дочитывает данные из InfluxDB.
+    /// </summary>
+    public async Task<ParkingStateSnapshot> GetFreeSpotsAsync(TimeSpan maxAge)
+    {
+        var snapshot = new ParkingStateSnapshot();
+        var redis = await GetConnectionAsync();
+        if (redis == null)
+            return snapshot;
+        try
+        {
+            var db = redis.GetDatabase();
+            var deviceIds = await db.SetMembersAsync($"{_keyPrefix}devices");
+            if (deviceIds.Length == 0)
+                return snapshot;
+
+            // Все HMGET уходят одним пакетом
+            var batch = db.CreateBatch();
+            var requests = deviceIds
+                .Select(id => (id, task: batch.HashGetAsync($"{_keyPrefix}{id}", Fields)))
+                .ToList();
+            batch.Execute();
+            await Task.WhenAll(requests.Select(r => r.task));
+
+            var minTimestamp = (DateTimeOffset.UtcNow - maxAge).ToUnixTimeMilliseconds() * 1_000_000;
+            foreach (var (id, task) in requests)
+            {
+                var values = task.Result;
+                if (!int.TryParse(id.ToString(), out int deviceId)
+                    || !values[0].TryParse(out int spots)
+                    || !values[1].TryParse(out long timestamp))
+                    continue;
+                if (timestamp >= minTimestamp)
+                    snapshot.FreeSpots[deviceId] = spots;
+            }
+            snapshot.Complete = snapshot.FreeSpots.Count == deviceIds.Length;
+            if (!snapshot.Complete)
+                _logger.LogInformation("Redis has fresh state for {Fresh} of {Total} devices",
+                    snapshot.FreeSpots.Count, deviceIds.Length);
+        }
+        catch (Exception ex)
+        {
+            // RedisTimeoutException - это TimeoutException, а не RedisException
+            _logger.LogWarning(ex, "Failed to read parking state from Redis");
+            snapshot.FreeSpots.Clear();
+            snapshot.Complete = false;
+        }
+        return snapshot;
+    }
+}
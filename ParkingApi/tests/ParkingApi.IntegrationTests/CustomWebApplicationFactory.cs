@@ -68,6 +68,9 @@ namespace ParkingApi.IntegrationTests
                     {
                         {"ConnectionStrings:PostgreSQL", "Host=localhost;Port=5433;Database=parking_test;Username=postgres;Password=postgres"},
                         {"ConnectionStrings:InfluxDB", "http://localhost:18086"},
+                        // Redis в тестовом окружении нет: abortConnect=false не роняет старт,
+                        // а ParkingStateService читает InfluxDB
+                        {"ConnectionStrings:Redis", "localhost:6379,abortConnect=false,connectTimeout=1000"},
                         {"InfluxDB:Token", "my-super-secret-auth-token"},
                         {"InfluxDB:Org", "test-org"},
                         {"InfluxDB:Bucket", "iot_bucket"}
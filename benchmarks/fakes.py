@@ -0,0 +1,119 @@
+"""In-process stand-ins for the MQTT broker and the InfluxDB write API, and synthetic device streams."""
+import random
+from iot_common.codec import encode_readings, FORMAT_JSON
+
+
+class PublishResult:
+    """What paho's publish() returns, as far as the services look at it."""
+    rc = 0
+    mid = 0
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.qos = 0
+        self.retain = False
+
+
+class FakeBroker:
+    """Routes publishes to subscribed callbacks synchronously and counts traffic per topic.
+
+    Subscriptions are exact topics or prefixes ending with ``#``.
+    """
+
+    def __init__(self):
+        self.subscriptions = []  # (topic filter, callback)
+        self.messages = {}  # topic -> count
+        self.bytes = 0
+
+    def subscribe(self, topic_filter, callback):
+        self.subscriptions.append((topic_filter, callback))
+
+    def client(self):
+        return FakeClient(self)
+
+    def deliver(self, client, topic, payload):
+        self.messages[topic] = self.messages.get(topic, 0) + 1
+        self.bytes += len(payload)
+        for topic_filter, callback in self.subscriptions:
+            if topic_filter == topic or (topic_filter.endswith('#') and topic.startswith(topic_filter[:-1])):
+                callback(client, None, FakeMessage(topic, payload))
+
+    def published(self):
+        return sum(self.messages.values())
+
+
+class FakeClient:
+    def __init__(self, broker):
+        self.broker = broker
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.broker.deliver(self, topic, bytes(payload))
+        return PublishResult()
+
+    def subscribe(self, *args, **kwargs):
+        return 0, 0
+
+
+class FakeWriteApi:
+    """Accepts ``write(bucket=..., record=...)`` like the InfluxDB write API and counts points.
+
+    ``serialize=True`` renders every point to line protocol, which is most of the
+    client-side cost of a real write.
+    """
+
+    def __init__(self, serialize=True):
+        self.serialize = serialize
+        self.calls = 0
+        self.points = 0
+        self.bytes = 0
+
+    def write(self, bucket, record, **kwargs):
+        records = record if isinstance(record, list) else [record]
+        self.calls += 1
+        self.points += len(records)
+        if self.serialize:
+            for point in records:
+                self.bytes += len(point.to_line_protocol())
+
+    def close(self):
+        pass
+
+
+def device_stream(devices, readings, batch_size=1, fmt=FORMAT_JSON, seed=42, fields='iot'):
+    """Pre-encoded payloads for ``readings`` readings spread over ``devices`` devices.
+
+    Every device does a random walk of its free spots, so thresholds are crossed in both
+    directions and the rule engine sees alerts fire and resolve. ``fields='rule_engine'``
+    produces what iot_controller forwards to the rule engine instead of full readings.
+    """
+    rng = random.Random(seed)
+    capacity = [rng.randint(20, 500) for _ in range(devices)]
+    free = [rng.randint(0, c) for c in capacity]
+    timestamp = 1_700_000_000_000_000_000
+    payloads = []
+    group = []
+    for i in range(readings):
+        device = i % devices
+        free[device] = min(capacity[device], max(0, free[device] + rng.randint(-5, 5)))
+        if fields == 'rule_engine':
+            data = {"device_id": device, "free_spots": free[device], "total_capacity": capacity[device]}
+        else:
+            data = {
+                "device_id": device,
+                "free_spots": free[device],
+                "total_capacity": capacity[device],
+                "occupied_spots": capacity[device] - free[device],
+                "timestamp": timestamp + i * 1000,
+            }
+        group.append(data)
+        if len(group) >= batch_size:
+            payloads.append(encode_readings(group, fmt, batched=batch_size > 1))
+            group = []
+    if group:
+        payloads.append(encode_readings(group, fmt, batched=batch_size > 1))
+    return payloads
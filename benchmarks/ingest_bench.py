@@ -0,0 +1,251 @@
+"""Offline benchmark of the Python ingest path.
+
+Feeds pre-encoded synthetic device streams straight into ``iot_controller.on_message``
+and ``rule_engine.on_message``, with an in-process broker and an InfluxDB write sink
+instead of mosquitto and InfluxDB. Every target runs in its own subprocess, so peak
+RSS is per target and module state does not leak between runs.
+
+    python benchmarks/ingest_bench.py --devices 1000 --readings 100000
+    python benchmarks/ingest_bench.py --batch-size 100 --format struct --output after.json --baseline before.json
+
+Needs the service requirements (paho-mqtt, influxdb-client, prometheus-client) but
+no network access.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from array import array
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGETS = ('iot_controller', 'rule_engine')
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+
+def setup_path():
+    # Same layout the service images use: iot_common importable, siblings by plain name.
+    # The service directories go first so that "import rule_engine" finds the module,
+    # not the rule_engine/ directory at the repo root.
+    paths = [os.path.join(ROOT, 'iot_controller', 'src'), os.path.join(ROOT, 'rule_engine'),
+             ROOT, os.path.dirname(os.path.abspath(__file__))]
+    sys.path[:0] = [path for path in paths if path not in sys.path]
+
+
+def silence_logging(level, handler):
+    """Keep the services' log calls (and their formatting cost) but send the output nowhere.
+
+    ``shared`` is the services' own setup (queue, rate limits from the LOG_* variables),
+    ``sync`` formats and writes every record on the calling thread.
+    """
+    from iot_common.log_setup import configure_logging
+    devnull = open(os.devnull, 'w')
+    if handler == 'sync':
+        configure_logging(level, stream=devnull, rate=0, sample_every=0, summary_interval=0, non_blocking=False)
+    else:
+        configure_logging(level, stream=devnull)
+    for name in list(logging.root.manager.loggerDict):
+        logging.getLogger(name).setLevel(logging.NOTSET)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def percentiles_us(latencies):
+    ordered = sorted(latencies)
+    if not ordered:
+        return {}
+
+    def at(q):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))] / 1000, 2)
+
+    return {"p50": at(50), "p95": at(95), "p99": at(99), "max": round(ordered[-1] / 1000, 2),
+            "mean": round(sum(ordered) / len(ordered) / 1000, 2)}
+
+
+def prepare_iot_controller(args):
+    import iot_controller
+    from fakes import FakeBroker, FakeWriteApi
+    from iot_common.influx_writer import BatchingWriter
+
+    broker = FakeBroker()
+    sink = FakeWriteApi(serialize=not args.no_serialize)
+    iot_controller.write_api = BatchingWriter(sink, batch_size=args.influx_batch_size, flush_interval=1.0,
+                                              max_queue_size=max(args.readings, 10000),
+                                              overflow_policy='block')
+    client = broker.client()
+
+    def finish():
+        # Points still queued in the writer are part of the cost of the run
+        iot_controller.write_api.close()
+        return {"points_written": sink.points, "write_calls": sink.calls,
+                "forwarded_messages": broker.published(), "forwarded_bytes": broker.bytes}
+
+    return iot_controller.on_message, client, finish, 'iot'
+
+
+def prepare_rule_engine(args):
+    import rule_engine
+    from fakes import FakeBroker, FakeWriteApi
+    from iot_common.influx_writer import BatchingWriter
+
+    sink = FakeWriteApi(serialize=not args.no_serialize)
+    rule_engine.write_api = BatchingWriter(sink, batch_size=args.influx_batch_size, flush_interval=1.0,
+                                           max_queue_size=max(args.readings, 10000),
+                                           overflow_policy='block')
+
+    def finish():
+        rule_engine.write_api.close()
+        return {"points_written": sink.points, "write_calls": sink.calls,
+                "devices_tracked": len(rule_engine.rule_set.index),
+                "active_alerts": rule_engine.rule_set.active_alerts()}
+
+    return rule_engine.on_message, FakeBroker().client(), finish, 'rule_engine'
+
+
+def run_target(target, args):
+    """Runs one target in this process and returns its result dict."""
+    setup_path()
+    from fakes import FakeMessage, device_stream
+    from iot_common.codec import use_json_library
+    json_library = use_json_library(args.json_library)
+
+    on_message, client, finish, fields = {
+        'iot_controller': prepare_iot_controller,
+        'rule_engine': prepare_rule_engine,
+    }[target](args)
+    silence_logging(args.log_level, args.log_handler)
+
+    payloads = device_stream(args.devices, args.readings, args.batch_size, args.format,
+                             seed=args.seed, fields=fields)
+    messages = [FakeMessage('iot_topic', payload) for payload in payloads]
+    warmup = messages[:args.warmup]
+    for message in warmup:
+        on_message(client, None, message)
+
+    latencies = array('q')
+    clock = time.perf_counter_ns
+    started = clock()
+    for message in messages:
+        before = clock()
+        on_message(client, None, message)
+        latencies.append(clock() - before)
+    extra = finish()
+    elapsed = (clock() - started) / 1e9
+
+    return {
+        "target": target,
+        "json_library": json_library,
+        "log_handler": args.log_handler,
+        "messages": len(messages),
+        "readings": args.readings,
+        "seconds": round(elapsed, 4),
+        "messages_per_second": round(len(messages) / elapsed, 1),
+        "readings_per_second": round(args.readings / elapsed, 1),
+        "latency_us": percentiles_us(latencies),
+        "payload_bytes": sum(len(m.payload) for m in messages),
+        "peak_rss_mb": peak_rss_mb(),
+        **extra,
+    }
+
+
+def worker_argv(args):
+    argv = ['--devices', str(args.devices), '--readings', str(args.readings),
+            '--batch-size', str(args.batch_size), '--format', args.format, '--json-library', args.json_library,
+            '--influx-batch-size', str(args.influx_batch_size), '--warmup', str(args.warmup),
+            '--seed', str(args.seed), '--log-level', args.log_level, '--log-handler', args.log_handler]
+    if args.no_serialize:
+        argv.append('--no-serialize')
+    return argv
+
+
+def spawn(target, argv):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', target] + argv,
+                            check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {r["target"]: r for r in json.load(f)["results"]}
+    for result in results:
+        before = baseline.get(result["target"])
+        if before is None:
+            continue
+        speedup = result["readings_per_second"] / before["readings_per_second"]
+        p99 = result["latency_us"]["p99"] / max(before["latency_us"]["p99"], 1e-9)
+        print(f"{result['target']}: {speedup:.2f}x readings/s, p99 latency x{p99:.2f}, "
+              f"peak RSS {before['peak_rss_mb']} -> {result['peak_rss_mb']} MB")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--targets', default=','.join(TARGETS), help="comma-separated: " + ", ".join(TARGETS))
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--readings', type=int, default=50000)
+    parser.add_argument('--batch-size', type=int, default=1, help="readings per MQTT message")
+    parser.add_argument('--format', default='json', help="payload format: json | msgpack | struct")
+    parser.add_argument('--json-library', default='auto', help="JSON codec: auto | orjson | json")
+    parser.add_argument('--influx-batch-size', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=1000, help="messages replayed before timing")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--log-level', default='INFO', help="service log level (output is discarded)")
+    parser.add_argument('--log-handler', default='shared', choices=('shared', 'sync'),
+                        help="shared: the services' queued, rate-limited logging; sync: every record written inline")
+    parser.add_argument('--no-serialize', action='store_true', help="do not render points to line protocol")
+    parser.add_argument('--output', help="results file, default benchmarks/results/ingest-<time>.json")
+    parser.add_argument('--baseline', help="earlier results file to compare against")
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.run_one:
+        print(json.dumps(run_target(args.run_one, args)))
+        return
+
+    results = []
+    for target in args.targets.split(','):
+        result = spawn(target.strip(), worker_argv(args))
+        results.append(result)
+        print(f"{result['target']}: {result['readings_per_second']:.0f} readings/s, "
+              f"{result['messages_per_second']:.0f} msg/s, p50={result['latency_us']['p50']}us "
+              f"p99={result['latency_us']['p99']}us, peak RSS {result['peak_rss_mb']} MB")
+
+    report = {
+        "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k not in ('output', 'baseline', 'run_one')},
+        "results": results,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"ingest-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""Record live MQTT traffic to a file and replay it later.
+
+``record`` subscribes to the pipeline topics and appends every message, with its
+arrival time and raw payload, to an iot_common.recording file. ``replay`` publishes
+a recording back: with the original timing, N times faster, or flat out, over one or
+more publisher connections. With several connections a message goes out on the
+connection of its device (of the first reading for a batch), so every device keeps
+the recorded order; devices that only show up later in mixed batches may not.
+
+    python benchmarks/mqtt_replay.py record traffic.rec --duration 600
+    python benchmarks/mqtt_replay.py replay traffic.rec --speed 10 --connections 4
+    python benchmarks/mqtt_replay.py replay traffic.rec --speed max --topics iot_topic
+
+Files written by data_simulator (SIM_OUTPUT_FILE) replay the same way. Needs paho-mqtt.
+"""
+import argparse
+import os
+import re
+import signal
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+import paho.mqtt.client as mqtt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from iot_common.codec import STRUCT_HEADER, STRUCT_MAGIC, STRUCT_RECORD, decode_readings  # noqa: E402
+from iot_common.recording import RecordWriter, read_records  # noqa: E402
+
+DEFAULT_TOPICS = 'iot_topic,rule_engine_topic'
+
+# The device id of a JSON payload (the first one of a batch) without decoding it
+DEVICE_ID_RE = re.compile(rb'"device_id"\s*:\s*"?([^",}\s]*)')
+
+
+def connect(host, port, name, on_connect=None, on_message=None):
+    client = mqtt.Client(client_id=f"{name}-{uuid.uuid4().hex[:8]}")
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.max_inflight_messages_set(1000)
+    client.max_queued_messages_set(0)
+    client.connect(host, port, 60)
+    client.loop_start()
+    return client
+
+
+def record(args):
+    topics = args.topics.split(',')
+    writer = RecordWriter(args.file, append=args.append)
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def on_connect(client, userdata, flags, rc):
+        if rc != 0:
+            print(f"Connection failed with code {rc}", file=sys.stderr)
+            return
+        client.subscribe([(topic, args.qos) for topic in topics])
+
+    def on_message(client, userdata, msg):
+        with lock:
+            writer.write(time.time_ns(), msg.topic, msg.payload)
+
+    # Subscribing in on_connect also resubscribes after a reconnect
+    client = connect(args.host, args.port, 'mqtt-recorder', on_connect, on_message)
+
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    print(f"Recording {', '.join(topics)} from {args.host}:{args.port} to {args.file}")
+    deadline = time.monotonic() + args.duration if args.duration > 0 else None
+    last_count = 0
+    while not stop.wait(args.flush_interval):
+        with lock:
+            writer.flush()
+            count = writer.records
+        print(f"{count} messages recorded (+{(count - last_count) / args.flush_interval:.0f}/s)")
+        last_count = count
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+
+    client.disconnect()
+    client.loop_stop()
+    with lock:
+        writer.close()
+    print(f"Recorded {writer.records} messages to {args.file}")
+
+
+def parse_speed(value):
+    """Replay speed: 1 keeps the recorded timing, N is N times faster, 0 or 'max' is flat out."""
+    return 0.0 if value == 'max' else float(value)
+
+
+def connection_for(payload, connections):
+    """Connection index for a recorded payload, picked from its (first) device id.
+
+    Integer ids use ``id % connections`` like the simulator's RatePublisher, other ids a
+    hash; payloads without a readable id go to connection 0.
+    """
+    if connections == 1:
+        return 0
+    if payload[:2] == STRUCT_MAGIC:
+        if len(payload) < STRUCT_HEADER.size + STRUCT_RECORD.size:
+            return 0
+        return STRUCT_RECORD.unpack_from(payload, STRUCT_HEADER.size)[0] % connections
+    match = DEVICE_ID_RE.search(payload)
+    if match is not None:
+        device_id = match.group(1)
+    else:
+        # msgpack, or JSON this pattern does not cover
+        try:
+            readings, _ = decode_readings(payload)
+            device_id = str(readings[0]["device_id"]).encode()
+        except Exception:
+            return 0
+    try:
+        return int(device_id) % connections
+    except ValueError:
+        return zlib.crc32(device_id) % connections
+
+
+def replay(args):
+    speed = parse_speed(args.speed)
+    topics = set(args.topics.split(',')) if args.topics else None
+    clients = [connect(args.host, args.port, 'mqtt-replay') for _ in range(args.connections)]
+    connections = len(clients)
+
+    print(f"Replaying {args.file} to {args.host}:{args.port} over {connections} connection(s), "
+          + (f"x{speed} of recorded time" if speed > 0 else "as fast as possible"))
+    messages = 0
+    payload_bytes = 0
+    errors = 0
+    first_ns = None
+    started = time.monotonic()
+    sleep = time.sleep
+    clock = time.monotonic
+    try:
+        for _ in range(args.loops):
+            loop_started = clock()
+            for timestamp_ns, topic, payload, _readings in read_records(args.file):
+                if topics is not None and topic not in topics:
+                    continue
+                if speed > 0:
+                    if first_ns is None:
+                        first_ns = timestamp_ns
+                    delay = loop_started + (timestamp_ns - first_ns) / 1e9 / speed - clock()
+                    if delay > 0.001:
+                        sleep(delay)
+                # One recorded stream becomes N concurrent publishers, each device on its own one
+                info = clients[connection_for(payload, connections)].publish(topic, payload, qos=args.qos)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    errors += 1
+                messages += 1
+                payload_bytes += len(payload)
+            first_ns = None
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for client in clients:
+            # disconnect() queues behind pending publishes, the loop thread flushes them
+            client.disconnect()
+            client.loop_stop()
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    print(f"Published {messages} messages ({payload_bytes / 1e6:.1f} MB) in {elapsed:.1f}s: "
+          f"{messages / elapsed:.0f} msg/s, {errors} publish errors")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=os.getenv('MQTT_HOST', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('MQTT_PORT', '1883')))
+    parser.add_argument('--qos', type=int, default=0)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rec = commands.add_parser('record', help="capture live traffic")
+    rec.add_argument('file')
+    rec.add_argument('--topics', default=DEFAULT_TOPICS, help="comma-separated topic filters")
+    rec.add_argument('--duration', type=float, default=0, help="seconds to record, 0 until interrupted")
+    rec.add_argument('--append', action='store_true', help="continue an existing recording")
+    rec.add_argument('--flush-interval', type=float, default=5.0)
+
+    rep = commands.add_parser('replay', help="publish a recording")
+    rep.add_argument('file')
+    rep.add_argument('--speed', default='1', help="1 = recorded timing, N = N times faster, max = flat out")
+    rep.add_argument('--connections', type=int, default=1, help="publisher connections to fan out over")
+    rep.add_argument('--topics', default='', help="only replay these topics (comma-separated)")
+    rep.add_argument('--loops', type=int, default=1, help="replay the file this many times")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'record':
+        record(args)
+    else:
+        replay(args)
+
+
+if __name__ == '__main__':
+    main()
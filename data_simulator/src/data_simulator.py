@@ -6,6 +6,16 @@ import json
 import os
 from datetime import datetime, timedelta
 import math
+from publisher import RatePublisher, DROPPED_PUBLISH_ERROR
+from sim_clock import SimulatedClock, parse_start
+from iot_common.codec import encode_readings
+from iot_common.metrics import MESSAGES_PUBLISHED, READINGS_PUBLISHED, start_metrics_server
+from iot_common.recording import RecordWriter, read_records
+
+try:
+    import numpy as np
+except ImportError:  # only the vectorized engine needs NumPy
+    np = None
 
 # Configure logging with more detail
 logging.basicConfig(
@@ -20,10 +30,37 @@ MQTT_PORT = 1883
 MQTT_TOPIC = 'iot_topic'
 
 # Simulation parameters
-NUM_PARKINGS = 150
+NUM_PARKINGS = int(os.getenv('NUM_PARKINGS', '150'))
 MIN_CAPACITY = 20
 MAX_CAPACITY = 500
 UPDATE_INTERVAL = 15  # seconds between updates
+# 'loop' - one dict per lot, 'numpy' - column arrays updated in one vectorized step (large fleets)
+SIMULATOR_ENGINE = os.getenv('SIMULATOR_ENGINE', 'loop')
+
+# High-rate mode for load tests: publish continuously at PUBLISH_RATE messages per
+# second ('max' - unthrottled) instead of one pass every UPDATE_INTERVAL seconds
+PUBLISH_RATE = os.getenv('PUBLISH_RATE', '')
+PUBLISH_CONNECTIONS = int(os.getenv('PUBLISH_CONNECTIONS', '1'))
+PUBLISH_BATCH_SIZE = int(os.getenv('PUBLISH_BATCH_SIZE', '1'))  # readings per MQTT message
+PUBLISH_FORMAT = os.getenv('PUBLISH_FORMAT', 'json')  # json | msgpack | struct (batches only)
+PUBLISH_DURATION = float(os.getenv('PUBLISH_DURATION', '0'))  # seconds, 0 - run until stopped
+REPORT_INTERVAL = 10  # seconds between achieved-throughput log lines
+
+# Prometheus /metrics port, 0 disables it
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9104'))
+
+# Simulated clock: occupancy trends follow SIM_START (ISO date/time, empty - now)
+# and run SIM_SPEEDUP times faster than real time
+SIM_START = os.getenv('SIM_START', '')
+SIM_SPEEDUP = float(os.getenv('SIM_SPEEDUP', '1'))
+# Generation: SIM_GENERATE_HOURS of readings (one pass every UPDATE_INTERVAL simulated
+# seconds) as fast as possible, into SIM_OUTPUT_FILE or, without it, to MQTT
+SIM_GENERATE_HOURS = float(os.getenv('SIM_GENERATE_HOURS', '0'))
+SIM_OUTPUT_FILE = os.getenv('SIM_OUTPUT_FILE', '')
+# Replay of a generated file: REPLAY_SPEEDUP > 0 follows the recorded timeline that
+# many times faster, 0 publishes back to back at PUBLISH_RATE (empty/max - unthrottled)
+REPLAY_FILE = os.getenv('REPLAY_FILE', '')
+REPLAY_SPEEDUP = float(os.getenv('REPLAY_SPEEDUP', '0'))
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
@@ -35,7 +72,8 @@ def on_disconnect(client, userdata, rc):
     logger.warning(f"Disconnected from MQTT Broker. Reason: {rc}")
 
 class ParkingSimulator:
-    def __init__(self, num_parkings=NUM_PARKINGS):
+    def __init__(self, num_parkings=NUM_PARKINGS, clock=None):
+        self.clock = clock or SimulatedClock()
         self.parkings = []
         
         # Initialize parking lots
@@ -60,8 +98,8 @@ class ParkingSimulator:
         logger.info(f"Initialized {len(self.parkings)} parking lots for simulation")
 
     def get_occupancy_trend(self):
-        """Calculate the current trend factor based on time of day"""
-        now = datetime.now()
+        """Calculate the current trend factor based on the simulated time of day"""
+        now = self.clock.now()
         hour = now.hour
         minute = now.minute
         day_of_week = now.weekday()  # 0-6, Monday to Sunday
@@ -139,6 +177,76 @@ class ParkingSimulator:
             
         return self.parkings
 
+    def readings(self):
+        """Current state as (id, free_spots, capacity, occupied_spots) tuples"""
+        return [(p['id'], p['free_spots'], p['capacity'], p['occupied_spots']) for p in self.parkings]
+
+
+class VectorizedParkingSimulator(ParkingSimulator):
+    """Same model as ParkingSimulator, but every lot attribute is a NumPy column
+    and update() processes the whole fleet in one vectorized step."""
+
+    def __init__(self, num_parkings=NUM_PARKINGS, seed=None, clock=None):
+        if np is None:
+            raise RuntimeError("The numpy simulator engine requires numpy")
+        self.clock = clock or SimulatedClock()
+        rng = np.random.default_rng(seed)
+        self.rng = rng
+        self.ids = np.arange(1, num_parkings + 1, dtype=np.int64)
+        self.capacity = rng.integers(MIN_CAPACITY, MAX_CAPACITY, size=num_parkings, endpoint=True)
+        # Start with random occupancy between 20% and 80%
+        self.occupied_spots = (self.capacity * rng.uniform(0.2, 0.8, num_parkings)).astype(np.int64)
+        self.free_spots = self.capacity - self.occupied_spots
+        self.volatility = rng.uniform(0.8, 1.5, num_parkings)
+        self.peak_hour_factor = rng.uniform(0.8, 1.2, num_parkings)
+        self.weekend_factor = rng.uniform(0.4, 0.8, num_parkings)
+        logger.info(f"Initialized {num_parkings} parking lots for vectorized simulation")
+
+    @property
+    def parkings(self):
+        return [
+            {'id': i, 'name': f"Parking {i}", 'capacity': c, 'free_spots': f, 'occupied_spots': o}
+            for i, f, c, o in self.readings()
+        ]
+
+    def update(self):
+        """Update parking occupancy based on time trends and randomness"""
+        trend, is_weekend = self.get_occupancy_trend()
+        capacity = self.capacity
+        factor = self.weekend_factor if is_weekend else self.peak_hour_factor
+
+        # Float -> int64 casts truncate toward zero, like int() in the loop engine
+        target_occupied = (capacity * trend * factor).astype(np.int64)
+        delta = target_occupied - self.occupied_spots
+        noise = self.rng.uniform(-0.03, 0.03, len(capacity))
+        delta += (capacity * noise * self.volatility).astype(np.int64)
+
+        # Dampen large swings
+        large = np.abs(delta) > capacity * 0.1
+        delta = np.where(large, (delta * 0.5).astype(np.int64), delta)
+
+        self.occupied_spots = np.clip(self.occupied_spots + delta, 0, capacity)
+        self.free_spots = capacity - self.occupied_spots
+        return self.free_spots
+
+    def readings(self):
+        return list(zip(self.ids.tolist(), self.free_spots.tolist(),
+                        self.capacity.tolist(), self.occupied_spots.tolist()))
+
+
+def create_simulator(num_parkings=NUM_PARKINGS, engine=SIMULATOR_ENGINE, clock=None):
+    if engine == 'numpy':
+        return VectorizedParkingSimulator(num_parkings, clock=clock)
+    if engine != 'loop':
+        raise ValueError(f"Unknown simulator engine: {engine}")
+    return ParkingSimulator(num_parkings, clock=clock)
+
+def create_clock():
+    clock = SimulatedClock(parse_start(SIM_START), SIM_SPEEDUP)
+    if SIM_START or SIM_SPEEDUP != 1:
+        logger.info(f"Simulated clock starts at {clock.start:%Y-%m-%d %H:%M}, x{SIM_SPEEDUP} speed")
+    return clock
+
 def run_simulator():
     """Main function to run the parking simulator"""
     # Initialize MQTT client
@@ -155,7 +263,8 @@ def run_simulator():
         exit(1)
     
     # Create parking simulator
-    simulator = ParkingSimulator(NUM_PARKINGS)
+    clock = create_clock()
+    simulator = create_simulator(NUM_PARKINGS, SIMULATOR_ENGINE, clock)
     
     # Main loop
     cycle = 0
@@ -165,43 +274,150 @@ def run_simulator():
             start_time = time.time()
             
             # Update parking lots
-            parking_lots = simulator.update()
+            simulator.update()
             
             # Log current time trend
             trend, is_weekend = simulator.get_occupancy_trend()
             if cycle % 4 == 0:  # Log every 4 cycles
                 day_type = "weekend" if is_weekend else "weekday"
-                logger.info(f"Current occupancy trend: {trend:.2f} ({day_type}, {datetime.now().hour:02d}:{datetime.now().minute:02d})")
+                now = clock.now()
+                logger.info(f"Current occupancy trend: {trend:.2f} ({day_type}, {now.hour:02d}:{now.minute:02d})")
             
             # Publish data for each parking
-            for parking in parking_lots:
+            for parking_id, free_spots, capacity, occupied_spots in simulator.readings():
                 # Prepare data
                 data = {
-                    "device_id": parking['id'],
-                    "free_spots": parking['free_spots'],
-                    "total_capacity": parking['capacity'],
-                    "occupied_spots": parking['occupied_spots'],
-                    "timestamp": int(time.time() * 1e9)
+                    "device_id": parking_id,
+                    "free_spots": free_spots,
+                    "total_capacity": capacity,
+                    "occupied_spots": occupied_spots,
+                    "timestamp": clock.time_ns()
                 }
                 
                 # Convert to JSON and publish
                 payload = json.dumps(data)
-                client.publish(MQTT_TOPIC, payload)
+                if client.publish(MQTT_TOPIC, payload).rc == mqtt.MQTT_ERR_SUCCESS:
+                    MESSAGES_PUBLISHED.inc()
+                    READINGS_PUBLISHED.inc()
+                else:
+                    DROPPED_PUBLISH_ERROR.inc()
                 
                 # Log some data for verification
-                if parking['id'] % 30 == 0:  # Log every 30th parking
-                    occupancy_percent = (parking['occupied_spots'] / parking['capacity']) * 100
-                    logger.info(f"Parking {parking['id']}: {parking['free_spots']} free, {parking['occupied_spots']} occupied, {occupancy_percent:.1f}% full")
+                if parking_id % 30 == 0:  # Log every 30th parking
+                    occupancy_percent = (occupied_spots / capacity) * 100
+                    logger.info(f"Parking {parking_id}: {free_spots} free, {occupied_spots} occupied, {occupancy_percent:.1f}% full")
             
-            # Ensure consistent timing between updates
-            elapsed = time.time() - start_time
+            # Ensure consistent timing between updates (in simulated seconds)
+            elapsed = (time.time() - start_time) * max(clock.speedup, 1)
             sleep_time = max(1, UPDATE_INTERVAL - elapsed)  # At least 1 second
-            time.sleep(sleep_time)
+            clock.sleep(sleep_time)
             
         except Exception as e:
             logger.error(f"Error in simulator loop: {e}")
             time.sleep(5)
 
+def run_high_rate():
+    """Publish simulator readings back to back at the configured target rate"""
+    simulator = create_simulator(NUM_PARKINGS, SIMULATOR_ENGINE, create_clock())
+    publisher = create_publisher()
+
+    deadline = time.time() + PUBLISH_DURATION if PUBLISH_DURATION > 0 else None
+    try:
+        while deadline is None or time.time() < deadline:
+            simulator.update()
+            publisher.publish_readings(simulator.readings(), simulator.clock.time_ns())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.close()
+
+def create_publisher():
+    rate = 0 if PUBLISH_RATE in ('', 'max') else float(PUBLISH_RATE)
+    try:
+        return RatePublisher(MQTT_HOST, MQTT_PORT, MQTT_TOPIC, rate,
+                             connections=PUBLISH_CONNECTIONS,
+                             batch_size=PUBLISH_BATCH_SIZE,
+                             report_interval=REPORT_INTERVAL,
+                             payload_format=PUBLISH_FORMAT)
+    except Exception as e:
+        logger.error(f"MQTT connection error: {e}")
+        exit(1)
+
+def generated_passes(simulator, hours, interval=UPDATE_INTERVAL):
+    """Yield (timestamp_ns, readings) for every update pass over ``hours`` of simulated time."""
+    clock = simulator.clock
+    for _ in range(int(hours * 3600 // interval)):
+        clock.advance(interval)
+        simulator.update()
+        yield clock.time_ns(), simulator.readings()
+
+def encode_pass(readings, timestamp_ns, batch_size=PUBLISH_BATCH_SIZE, fmt=PUBLISH_FORMAT):
+    """Payloads for one pass, ``batch_size`` readings each, like the rate publisher sends them."""
+    data = [
+        {"device_id": parking_id, "free_spots": free_spots, "total_capacity": capacity,
+         "occupied_spots": occupied_spots, "timestamp": timestamp_ns}
+        for parking_id, free_spots, capacity, occupied_spots in readings
+    ]
+    batched = batch_size > 1
+    for i in range(0, len(data), batch_size):
+        group = data[i:i + batch_size]
+        yield encode_readings(group, fmt, batched=batched), len(group)
+
+def run_generate():
+    """Generate SIM_GENERATE_HOURS of readings on a stepped clock as fast as possible"""
+    clock = SimulatedClock.stepped(parse_start(SIM_START))
+    simulator = create_simulator(NUM_PARKINGS, SIMULATOR_ENGINE, clock)
+    logger.info(f"Generating {SIM_GENERATE_HOURS}h of readings from {clock.start:%Y-%m-%d %H:%M} "
+                f"into {SIM_OUTPUT_FILE or 'MQTT'}")
+    started = time.time()
+    if SIM_OUTPUT_FILE:
+        readings_written = 0
+        with RecordWriter(SIM_OUTPUT_FILE) as writer:
+            for timestamp_ns, readings in generated_passes(simulator, SIM_GENERATE_HOURS):
+                for payload, count in encode_pass(readings, timestamp_ns):
+                    writer.write(timestamp_ns, MQTT_TOPIC, payload, count)
+                    readings_written += count
+        logger.info(f"Wrote {writer.records} messages ({readings_written} readings) to {SIM_OUTPUT_FILE} "
+                    f"in {time.time() - started:.1f}s")
+        return
+    publisher = create_publisher()
+    try:
+        for timestamp_ns, readings in generated_passes(simulator, SIM_GENERATE_HOURS):
+            publisher.publish_readings(readings, timestamp_ns)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.close()
+
+def run_replay():
+    """Publish a generated file, following its timeline or at PUBLISH_RATE"""
+    publisher = create_publisher()
+    logger.info(f"Replaying {REPLAY_FILE}" + (f" at x{REPLAY_SPEEDUP} of recorded time" if REPLAY_SPEEDUP > 0 else ""))
+    first_ns = None
+    started = time.monotonic()
+    try:
+        for timestamp_ns, topic, payload, readings in read_records(REPLAY_FILE):
+            if REPLAY_SPEEDUP > 0:
+                if first_ns is None:
+                    first_ns = timestamp_ns
+                due = started + (timestamp_ns - first_ns) / 1e9 / REPLAY_SPEEDUP
+                delay = due - time.monotonic()
+                if delay > 0.001:
+                    time.sleep(delay)
+            publisher.publish_payload(payload, readings or 1, topic)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.close()
+
 if __name__ == "__main__":
     logger.info("Parking occupancy simulator starting")
-    run_simulator()
\ No newline at end of file
+    start_metrics_server(METRICS_PORT)
+    if REPLAY_FILE:
+        run_replay()
+    elif SIM_GENERATE_HOURS > 0:
+        run_generate()
+    elif PUBLISH_RATE:
+        run_high_rate()
+    else:
+        run_simulator()
\ No newline at end of file
@@ -1 +1 @@
-from .data_simulator import on_connect, on_disconnect, init_parking_lots, init_bookings_table, logger
\ No newline at end of file
+from .data_simulator import on_connect, on_disconnect, ParkingSimulator, VectorizedParkingSimulator, logger
@@ -0,0 +1,197 @@
+import os
+import time
+import socket
+import logging
+import paho.mqtt.client as mqtt
+from iot_common.codec import encode_readings, FORMAT_JSON
+from iot_common.metrics import MESSAGES_PUBLISHED, READINGS_PUBLISHED, READINGS_DROPPED
+
+logger = logging.getLogger(__name__)
+
+DROPPED_PUBLISH_ERROR = READINGS_DROPPED.labels(reason='publish_error')
+
+# One reading, same fields as the json.dumps() payload of the regular loop.
+# JSON payloads are rendered from these templates; msgpack/struct go through the codec.
+READING_TEMPLATE = b'{"device_id": %d, "free_spots": %d, "total_capacity": %d, "occupied_spots": %d, "timestamp": %d}'
+# Batch envelope: many readings in one MQTT message
+BATCH_PREFIX = b'{"readings": ['
+BATCH_SEPARATOR = b', '
+BATCH_SUFFIX = b']}'
+
+
+class ThroughputReporter:
+    """Counts published messages/readings/bytes and logs the achieved rate periodically."""
+
+    def __init__(self, report_interval=10.0):
+        self.report_interval = report_interval
+        self.started = time.perf_counter()
+        self.messages = 0
+        self.readings = 0
+        self.bytes = 0
+        self._last_report = self.started
+        self._last_messages = 0
+        self._last_readings = 0
+
+    def add(self, readings, size):
+        self.messages += 1
+        self.readings += readings
+        self.bytes += size
+
+    def maybe_report(self, now):
+        elapsed = now - self._last_report
+        if elapsed < self.report_interval:
+            return
+        logger.info(
+            f"Publish rate: {(self.messages - self._last_messages) / elapsed:.0f} msg/s, "
+            f"{(self.readings - self._last_readings) / elapsed:.0f} readings/s"
+        )
+        self._last_report = now
+        self._last_messages = self.messages
+        self._last_readings = self.readings
+
+    def summary(self):
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        return {
+            "seconds": round(elapsed, 3),
+            "messages": self.messages,
+            "readings": self.readings,
+            "bytes": self.bytes,
+            "messages_per_second": round(self.messages / elapsed, 1),
+            "readings_per_second": round(self.readings / elapsed, 1),
+        }
+
+
+class RatePublisher:
+    """Publishes simulator readings at a target message rate over several MQTT connections.
+
+    Payloads are rendered straight into one reusable bytearray from a bytes template
+    instead of building a dict and calling json.dumps per reading. Reusing the buffer
+    is safe at QoS 0 only: paho copies the payload into the outgoing packet before
+    publish() returns. A device always goes out on the same connection, so per-device
+    ordering is kept.
+    """
+
+    def __init__(self, host, port, topic, rate, connections=1, batch_size=1, report_interval=10.0,
+                 payload_format=FORMAT_JSON):
+        self.topic = topic
+        self.rate = rate
+        self.batch_size = max(1, batch_size)
+        self.payload_format = payload_format
+        self.clients = []
+        for i in range(max(1, connections)):
+            client = mqtt.Client(client_id=f"data-simulator-{socket.gethostname()}-{os.getpid()}-{i}")
+            client.connect(host, port, 60)
+            client.loop_start()
+            self.clients.append(client)
+        self.reporter = ThroughputReporter(report_interval)
+        self._buffer = bytearray()
+        self._next_send = None
+        logger.info(f"Rate publisher: {rate} msg/s target, {len(self.clients)} connections, "
+                    f"{self.batch_size} readings per message")
+
+    def _pace(self):
+        if self.rate <= 0:
+            return
+        now = time.perf_counter()
+        if self._next_send is None or now - self._next_send > 1.0:
+            # First message, or we fell more than a second behind: don't burst to catch up
+            self._next_send = now
+        elif self._next_send - now > 0.001:
+            time.sleep(self._next_send - now)
+        self._next_send += 1.0 / self.rate
+
+    def _send(self, client, readings_in_message, topic=None):
+        self._pace()
+        if client.publish(topic or self.topic, self._buffer).rc != mqtt.MQTT_ERR_SUCCESS:
+            DROPPED_PUBLISH_ERROR.inc(readings_in_message)
+            return
+        MESSAGES_PUBLISHED.inc()
+        READINGS_PUBLISHED.inc(readings_in_message)
+        self.reporter.add(readings_in_message, len(self._buffer))
+
+    def publish_readings(self, readings, timestamp_ns=None):
+        """Publish one pass over (id, free_spots, capacity, occupied_spots) tuples.
+
+        Readings are stamped with the wall clock when rendered, unless a fixed
+        ``timestamp_ns`` is given for the whole pass.
+        """
+        clients = self.clients
+        connections = len(clients)
+        buffer = self._buffer
+        clock = time.time_ns
+        if self.payload_format != FORMAT_JSON:
+            self._publish_encoded(readings, timestamp_ns)
+        elif self.batch_size == 1:
+            for parking_id, free_spots, capacity, occupied_spots in readings:
+                buffer.clear()
+                buffer += READING_TEMPLATE % (parking_id, free_spots, capacity, occupied_spots,
+                                              timestamp_ns or clock())
+                self._send(clients[parking_id % connections], 1)
+        else:
+            # Batches are grouped per connection so a device keeps its connection
+            pending = [[] for _ in clients]
+            for parking_id, free_spots, capacity, occupied_spots in readings:
+                shard = parking_id % connections
+                group = pending[shard]
+                group.append(READING_TEMPLATE % (parking_id, free_spots, capacity, occupied_spots,
+                                                 timestamp_ns or clock()))
+                if len(group) >= self.batch_size:
+                    self._send_batch(clients[shard], group)
+            for shard, group in enumerate(pending):
+                if group:
+                    self._send_batch(clients[shard], group)
+        self.reporter.maybe_report(time.perf_counter())
+
+    def publish_payload(self, payload, readings=1, topic=None, connection=0):
+        """Publish an already encoded payload, e.g. one read back from a recording."""
+        buffer = self._buffer
+        buffer.clear()
+        buffer += payload
+        self._send(self.clients[connection % len(self.clients)], readings, topic)
+        self.reporter.maybe_report(time.perf_counter())
+
+    def _publish_encoded(self, readings, timestamp_ns):
+        clients = self.clients
+        connections = len(clients)
+        batched = self.batch_size > 1
+        pending = [[] for _ in clients]
+        for parking_id, free_spots, capacity, occupied_spots in readings:
+            shard = parking_id % connections
+            group = pending[shard]
+            group.append({
+                "device_id": parking_id,
+                "free_spots": free_spots,
+                "total_capacity": capacity,
+                "occupied_spots": occupied_spots,
+                "timestamp": timestamp_ns or time.time_ns(),
+            })
+            if len(group) >= self.batch_size:
+                self._send_encoded(clients[shard], group, batched)
+        for shard, group in enumerate(pending):
+            if group:
+                self._send_encoded(clients[shard], group, batched)
+
+    def _send_encoded(self, client, group, batched):
+        buffer = self._buffer
+        buffer.clear()
+        buffer += encode_readings(group, self.payload_format, batched=batched)
+        self._send(client, len(group))
+        group.clear()
+
+    def _send_batch(self, client, group):
+        buffer = self._buffer
+        buffer.clear()
+        buffer += BATCH_PREFIX
+        buffer += BATCH_SEPARATOR.join(group)
+        buffer += BATCH_SUFFIX
+        self._send(client, len(group))
+        group.clear()
+
+    def close(self):
+        for client in self.clients:
+            # disconnect() queues behind pending publishes, the loop thread flushes them
+            client.disconnect()
+            client.loop_stop()
+        summary = self.reporter.summary()
+        logger.info(f"Publisher summary: {summary}")
+        return summary
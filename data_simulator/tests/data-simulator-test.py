@@ -1,127 +1,244 @@
 import unittest
 from unittest import mock
 import json
-import time
+import random
+import statistics
+from datetime import datetime
 import paho.mqtt.client as mqtt
+from prometheus_client import REGISTRY
 from data_simulator.data_simulator import (
     on_connect,
     on_disconnect,
-    init_bookings_table,
-    init_parking_lots,
+    ParkingSimulator,
+    VectorizedParkingSimulator,
     logger,
-    MQTT_TOPIC
 )
+from sim_clock import SimulatedClock, parse_start
+from publisher import RatePublisher, ThroughputReporter
 
 class UnitTestDataSimulator(unittest.TestCase):
-    @mock.patch('paho.mqtt.client.Client')
-    def test_on_connect_success(self, mock_mqtt_client_class):
-        mock_client = mock_mqtt_client_class.return_value
-        on_connect(mock_client, None, None, 0)
-        mock_client.subscribe.assert_called_once_with(MQTT_TOPIC)
-        logger.info("test_on_connect_success passed")
-
-    @mock.patch('paho.mqtt.client.Client')
-    def test_on_connect_failure_logs_error(self, mock_mqtt_client_class):
-        mock_client = mock_mqtt_client_class.return_value
+    def test_on_connect_success(self):
+        with self.assertLogs(logger, level='INFO') as cm:
+            on_connect(mock.MagicMock(), None, None, 0)
+        self.assertTrue(any("Connected to MQTT Broker" in message for message in cm.output))
+
+    def test_on_connect_failure_logs_error(self):
         with self.assertLogs(logger, level='ERROR') as cm:
-            on_connect(mock_client, None, None, 1)
+            on_connect(mock.MagicMock(), None, None, 1)
         self.assertTrue(any("Failed to connect" in message for message in cm.output))
-        logger.info("test_on_connect_failure_logs_error passed")
 
-    @mock.patch('paho.mqtt.client.Client')
-    @mock.patch('time.sleep', return_value=None)
-    def test_on_disconnect_reconnect(self, mock_sleep, mock_mqtt_client_class):
-        mock_client = mock_mqtt_client_class.return_value
-        reconnect_calls = []
+    def test_on_disconnect_logs_warning(self):
+        with self.assertLogs(logger, level='WARNING') as cm:
+            on_disconnect(mock.MagicMock(), None, 1)
+        self.assertTrue(any("Disconnected from MQTT Broker" in message for message in cm.output))
 
-        def side_effect():
-            if len(reconnect_calls) < 1:
-                reconnect_calls.append(1)
-                raise Exception("fail")
-            return None
+class TestParkingSimulator(unittest.TestCase):
+    LOTS = 2000
+    UPDATES = 20
 
-        mock_client.reconnect.side_effect = side_effect
-        with self.assertLogs(logger, level='ERROR') as cm:
-            on_disconnect(mock_client, None, 1)
-        self.assertTrue(any("Reconnection failed" in message for message in cm.output))
-        self.assertEqual(mock_client.reconnect.call_count, 2)
-        mock_sleep.assert_called_once_with(5)
-        logger.info("test_on_disconnect_reconnect passed")    @mock.patch('data_simulator.data_simulator.data_simulator_client')
-    @mock.patch('data_simulator.data_simulator.pg_conn')
-    def test_free_spots_calculation_and_publish(self, mock_pg_conn, mock_client):
-        mock_cursor = mock.MagicMock()
-        mock_pg_conn.cursor.return_value.__enter__.return_value = mock_cursor
-        mock_cursor.fetchone.side_effect = [
-            (20,),  # total_spots
-            (5,)    # booked_spots
-        ]
-
-        device_id = 1
-        try:
-            with mock_pg_conn.cursor() as cur:
-                cur.execute("SELECT total_spots FROM parking_lots WHERE id = %s", (device_id,))
-                total_spots = cur.fetchone()[0]
-                cur.execute("SELECT COUNT(*) FROM bookings WHERE parking_id = %s AND active = true", (device_id,))
-                booked_spots = cur.fetchone()[0]
-                free_spots = total_spots - booked_spots
-                if free_spots < 0:
-                    free_spots = 0
-                data_controller = {
-                    "device_id": device_id,
-                    "free_spots": free_spots,
-                    "timestamp": int(time.time() * 1e9)
-                }
-                payload_controller = json.dumps(data_controller)
-                mock_client.publish(MQTT_TOPIC, payload_controller)
-                logger.info(f"Published MQTT message for device_id {device_id} with free_spots {free_spots}")
-        except Exception as e:
-            self.fail(f"Exception during free spots calculation and publish: {e}")
-
-        mock_client.publish.assert_called_once()
-        args, kwargs = mock_client.publish.call_args
-        self.assertEqual(args[0], MQTT_TOPIC)
-        published_data = json.loads(args[1])
-        self.assertEqual(published_data["device_id"], device_id)
-        self.assertEqual(published_data["free_spots"], 15)
-        logger.info("test_free_spots_calculation_and_publish passed")
-
-    @mock.patch('data_simulator.data_simulator.data_simulator_client')
-    @mock.patch('data_simulator.data_simulator.pg_conn')
-    def test_simulator_loop_iteration(self, mock_pg_conn, mock_client):
-        mock_cursor = mock.MagicMock()
-        mock_pg_conn.cursor.return_value.__enter__.return_value = mock_cursor
-        # Setup fetchone to return total_spots and booked_spots for multiple devices
-        mock_cursor.fetchone.side_effect = [
-            (20,),  # total_spots for device 1
-            (5,),   # booked_spots for device 1
-            (15,),  # total_spots for device 2
-            (10,),  # booked_spots for device 2
-        ]
-
-        # Simulate one iteration of the loop for two devices
-        for device_id in [1, 2]:
-            try:
-                with mock_pg_conn.cursor() as cur:
-                    cur.execute("SELECT total_spots FROM parking_lots WHERE id = %s", (device_id,))
-                    total_spots = cur.fetchone()[0]
-                    cur.execute("SELECT COUNT(*) FROM bookings WHERE parking_id = %s AND active = true", (device_id,))
-                    booked_spots = cur.fetchone()[0]
-                    free_spots = total_spots - booked_spots
-                    if free_spots < 0:
-                        free_spots = 0
-                    data_controller = {
-                        "device_id": device_id,
-                        "free_spots": free_spots,
-                        "timestamp": int(time.time() * 1e9)
-                    }
-                    payload_controller = json.dumps(data_controller)
-                    mock_client.publish(MQTT_TOPIC, payload_controller)
-                    logger.info(f"Simulator loop published MQTT message for device_id {device_id} with free_spots {free_spots}")
-            except Exception as e:
-                self.fail(f"Exception during simulator loop iteration for device {device_id}: {e}")
-
-        self.assertEqual(mock_client.publish.call_count, 2)
-        logger.info("test_simulator_loop_iteration passed")
+    def setUp(self):
+        # The loop engine draws from the global random module
+        state = random.getstate()
+        self.addCleanup(random.setstate, state)
+
+    def run_engines(self, start, seed):
+        random.seed(seed)
+        with self.assertLogs(logger, level='INFO'):
+            loop = ParkingSimulator(self.LOTS, clock=SimulatedClock.stepped(datetime.fromisoformat(start)))
+            vectorized = VectorizedParkingSimulator(self.LOTS, seed=seed,
+                                                    clock=SimulatedClock.stepped(datetime.fromisoformat(start)))
+        for _ in range(self.UPDATES):
+            for simulator in (loop, vectorized):
+                simulator.update()
+                simulator.clock.advance(15)
+                self.assert_within_bounds(simulator.readings())
+        return loop, vectorized
+
+    def assert_within_bounds(self, readings):
+        for parking_id, free_spots, capacity, occupied_spots in readings:
+            self.assertTrue(0 <= free_spots <= capacity, (parking_id, free_spots, capacity))
+            self.assertEqual(free_spots + occupied_spots, capacity)
+
+    @staticmethod
+    def occupancy(readings):
+        ratios = [occupied_spots / capacity for _, _, capacity, occupied_spots in readings]
+        return statistics.mean(ratios), statistics.pstdev(ratios)
+
+    def test_engines_agree_statistically(self):
+        # Weekday morning rush and a weekend afternoon
+        for start in ("2025-03-03T08:00", "2025-03-08T14:00"):
+            loop, vectorized = self.run_engines(start, seed=1)
+            loop_mean, loop_std = self.occupancy(loop.readings())
+            vectorized_mean, vectorized_std = self.occupancy(vectorized.readings())
+            self.assertAlmostEqual(loop_mean, vectorized_mean, delta=0.01)
+            self.assertAlmostEqual(loop_std, vectorized_std, delta=0.005)
+            self.assertAlmostEqual(statistics.mean(r[2] for r in loop.readings()),
+                                   statistics.mean(r[2] for r in vectorized.readings()), delta=15)
+
+    def test_vectorized_engine_is_reproducible(self):
+        clock = SimulatedClock.stepped(datetime(2025, 3, 3, 8))
+        with self.assertLogs(logger, level='INFO'):
+            first = VectorizedParkingSimulator(100, seed=7, clock=clock)
+            second = VectorizedParkingSimulator(100, seed=7, clock=clock)
+        first.update()
+        second.update()
+        self.assertEqual(first.readings(), second.readings())
+        self.assertEqual([p['id'] for p in first.parkings], list(range(1, 101)))
+
+class FakeMqttClient:
+    """Keeps what was published; ``fail`` makes publish() report an error."""
+
+    def __init__(self, client_id=None):
+        self.client_id = client_id
+        self.published = []
+        self.fail = False
+
+    def connect(self, host, port, keepalive):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def publish(self, topic, payload):
+        # The publisher reuses its buffer, so keep a copy
+        self.published.append((topic, bytes(payload)))
+        return mock.Mock(rc=mqtt.MQTT_ERR_NO_CONN if self.fail else mqtt.MQTT_ERR_SUCCESS)
+
+    def device_ids(self):
+        ids = []
+        for _, payload in self.published:
+            data = json.loads(payload)
+            ids += [reading["device_id"] for reading in data.get("readings", [data])]
+        return ids
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(round(seconds, 6))
+        self.now += seconds
+
+    def time_ns(self):
+        return int(self.now * 1e9)
+
+class TestRatePublisher(unittest.TestCase):
+    def publisher(self, rate=0, connections=1, batch_size=1):
+        with mock.patch('publisher.mqtt.Client', FakeMqttClient), self.assertLogs('publisher', level='INFO'):
+            return RatePublisher('mosquitto', 1883, 'iot_topic', rate, connections=connections,
+                                 batch_size=batch_size)
+
+    @staticmethod
+    def readings(count):
+        return [(device_id, device_id % 7, 100, 100 - device_id % 7) for device_id in range(1, count + 1)]
+
+    def test_batch_envelope(self):
+        publisher = self.publisher(batch_size=3)
+        publisher.publish_readings(self.readings(4), timestamp_ns=123)
+        client = publisher.clients[0]
+        self.assertEqual(len(client.published), 2)
+        topic, payload = client.published[0]
+        self.assertEqual(topic, 'iot_topic')
+        self.assertEqual(json.loads(payload), {"readings": [
+            {"device_id": device_id, "free_spots": device_id % 7, "total_capacity": 100,
+             "occupied_spots": 100 - device_id % 7, "timestamp": 123}
+            for device_id in (1, 2, 3)
+        ]})
+        self.assertEqual(len(json.loads(client.published[1][1])["readings"]), 1)
+        self.assertEqual((publisher.reporter.messages, publisher.reporter.readings), (2, 4))
+
+    def test_device_keeps_its_connection(self):
+        for batch_size in (1, 2):
+            publisher = self.publisher(connections=3, batch_size=batch_size)
+            for _ in range(2):
+                publisher.publish_readings(self.readings(9))
+            for index, client in enumerate(publisher.clients):
+                expected = [device_id for device_id in range(1, 10) if device_id % 3 == index]
+                self.assertEqual(client.device_ids(), expected * 2)
+
+    def test_pace_does_not_burst_after_falling_behind(self):
+        clock = FakeClock()
+        with mock.patch('publisher.time', clock):
+            publisher = self.publisher(rate=10)
+            for _ in range(3):
+                publisher.publish_payload(b'{}')
+            self.assertEqual(clock.sleeps, [0.1, 0.1])
+            # Stalled for 5s: restart the schedule from now instead of sending 50 messages at once
+            clock.now += 5
+            clock.sleeps.clear()
+            for _ in range(3):
+                publisher.publish_payload(b'{}')
+            self.assertEqual(clock.sleeps, [0.1, 0.1])
+
+    def test_failed_publish_is_counted_as_dropped(self):
+        before = REGISTRY.get_sample_value('readings_dropped_total', {'reason': 'publish_error'}) or 0
+        publisher = self.publisher(batch_size=2)
+        publisher.clients[0].fail = True
+        publisher.publish_readings(self.readings(3))
+        after = REGISTRY.get_sample_value('readings_dropped_total', {'reason': 'publish_error'})
+        self.assertEqual(after - before, 3)
+        self.assertEqual(publisher.reporter.messages, 0)
+
+class TestThroughputReporter(unittest.TestCase):
+    def test_reports_rate_once_per_interval(self):
+        clock = FakeClock()
+        with mock.patch('publisher.time', clock):
+            reporter = ThroughputReporter(report_interval=10)
+            for _ in range(50):
+                reporter.add(4, 100)
+            with self.assertLogs('publisher', level='INFO') as cm:
+                reporter.maybe_report(5.0)
+                reporter.maybe_report(10.0)
+            self.assertEqual(len(cm.output), 1)
+            self.assertIn("5 msg/s, 20 readings/s", cm.output[0])
+            clock.now = 2.0
+            summary = reporter.summary()
+        self.assertEqual((summary["messages"], summary["readings"], summary["bytes"]), (50, 200, 5000))
+        self.assertEqual(summary["readings_per_second"], 100.0)
+
+class TestSimulatedClock(unittest.TestCase):
+    START = datetime(2025, 3, 3, 7, 30)
+
+    def test_stepped_clock_moves_only_when_told(self):
+        clock = SimulatedClock.stepped(self.START)
+        self.assertEqual(clock.speedup, 0)
+        self.assertEqual(clock.now(), self.START)
+        clock.advance(90)
+        clock.sleep(30)
+        self.assertEqual(clock.elapsed(), 120)
+        self.assertEqual(clock.now(), datetime(2025, 3, 3, 7, 32))
+        self.assertEqual(clock.time_ns(), int(datetime(2025, 3, 3, 7, 32).timestamp() * 1e9))
+
+    def test_speedup_scales_real_time(self):
+        with mock.patch('sim_clock.time') as fake_time:
+            fake_time.monotonic.return_value = 100.0
+            clock = SimulatedClock(self.START, speedup=60)
+            fake_time.monotonic.return_value = 102.0
+            self.assertEqual(clock.now(), datetime(2025, 3, 3, 7, 32))
+            clock.advance(60)
+            self.assertEqual(clock.elapsed(), 180)
+            clock.sleep(120)
+            fake_time.sleep.assert_called_once_with(2.0)
+
+    def test_negative_speedup_is_rejected(self):
+        with self.assertRaises(ValueError):
+            SimulatedClock(self.START, speedup=-1)
+
+    def test_parse_start(self):
+        self.assertIsNone(parse_start(""))
+        self.assertEqual(parse_start("2025-03-03T07:30"), self.START)
+        with self.assertRaises(ValueError):
+            parse_start("monday morning")
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1 @@
+# Code shared by the Python pipeline services (data_simulator, iot_controller, rule_engine)
@@ -0,0 +1,218 @@
+import json
+import os
+import struct
+
+try:
+    import msgpack
+except ImportError:  # msgpack payloads are optional
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # the stdlib json module is the fallback
+    orjson = None
+
+# JSON library: auto (orjson when installed) | orjson | json
+JSON_LIBRARY = os.getenv('IOT_JSON_LIBRARY', 'auto')
+
+FORMAT_JSON = 'json'
+FORMAT_MSGPACK = 'msgpack'
+FORMAT_STRUCT = 'struct'
+FORMATS = (FORMAT_JSON, FORMAT_MSGPACK, FORMAT_STRUCT)
+
+# Batch envelope in JSON / msgpack: {"readings": [reading, ...]}
+BATCH_KEY = 'readings'
+
+# Struct-packed batch: header + fixed-size records, 28 bytes per reading.
+# Needs integer device ids; a capacity or occupancy of -1 and a timestamp of 0
+# mean "not reported".
+STRUCT_MAGIC = b'PK'
+STRUCT_VERSION = 1
+STRUCT_HEADER = struct.Struct('<2sBH')  # magic, version, record count
+STRUCT_RECORD = struct.Struct('<qiiiq')  # device_id, free_spots, total_capacity, occupied_spots, timestamp
+MAX_STRUCT_RECORDS = 0xFFFF
+
+# First byte of a msgpack map or array (fixmap, fixarray, map16/32, array16/32)
+_MSGPACK_CONTAINER = set(range(0x80, 0xA0)) | {0xDC, 0xDD, 0xDE, 0xDF}
+
+
+def _stdlib_dumps(data):
+    return json.dumps(data).encode()
+
+
+def use_json_library(name):
+    """Select the JSON implementation behind decode/encode; returns the name in use."""
+    global json_loads, json_dumps, json_library
+    if name not in ('auto', 'orjson', 'json'):
+        raise ValueError(f"Unknown JSON library: {name}")
+    if name == 'orjson' and orjson is None:
+        raise RuntimeError("IOT_JSON_LIBRARY=orjson requires the orjson package")
+    if name != 'json' and orjson is not None:
+        # Both parse bytes directly, no intermediate str; orjson errors are json.JSONDecodeError too
+        json_loads, json_dumps, json_library = orjson.loads, orjson.dumps, 'orjson'
+    else:
+        json_loads, json_dumps, json_library = json.loads, _stdlib_dumps, 'json'
+    return json_library
+
+
+use_json_library(JSON_LIBRARY)
+
+
+class Reading:
+    """One validated parking reading.
+
+    Fields a device did not report are None. ``get`` and item access mirror the dict
+    the reading was decoded from, so code written against dicts keeps working.
+    """
+
+    __slots__ = ('device_id', 'free_spots', 'total_capacity', 'occupied_spots', 'timestamp')
+
+    def __init__(self, device_id, free_spots, total_capacity=None, occupied_spots=None, timestamp=None):
+        self.device_id = device_id
+        self.free_spots = free_spots
+        self.total_capacity = total_capacity
+        self.occupied_spots = occupied_spots
+        self.timestamp = timestamp
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def __getitem__(self, name):
+        value = getattr(self, name, None)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return getattr(self, name, None) is not None
+
+    def keys(self):
+        return [name for name in self.__slots__ if getattr(self, name) is not None]
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.keys()}
+
+    def __eq__(self, other):
+        if isinstance(other, Reading):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __repr__(self):
+        return f"Reading({self.as_dict()})"
+
+
+def _as_int(value, name):
+    # bool is an int subclass and int() truncates 2.5: neither is a count a device meant
+    if type(value) is bool or (type(value) is float and not value.is_integer()):
+        raise ValueError(f"{name}={value!r} is not an integer")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name}={value!r} is not an integer") from None
+
+
+def _optional_int(data, name):
+    value = data.get(name)
+    if value is None or type(value) is int:
+        return value
+    return _as_int(value, name)
+
+
+def to_reading(data):
+    """Validate a decoded reading against the schema; raises ValueError if it does not fit.
+
+    device_id is required, free_spots must be a non-negative integer (numeric strings and
+    integral floats such as 5.0 are accepted, booleans are not), total_capacity,
+    occupied_spots and timestamp are optional integers.
+    """
+    if type(data) is not dict:
+        raise ValueError(f"reading must be an object, got {type(data).__name__}")
+    device_id = data.get("device_id")
+    if device_id is None:
+        raise ValueError("device_id is missing")
+    free_spots = data.get("free_spots")
+    if type(free_spots) is not int:
+        if free_spots is None:
+            raise ValueError("free_spots is missing")
+        free_spots = _as_int(free_spots, "free_spots")
+    if free_spots < 0:
+        raise ValueError(f"free_spots={free_spots} (must be >= 0)")
+    return Reading(device_id, free_spots, _optional_int(data, "total_capacity"),
+                   _optional_int(data, "occupied_spots"), _optional_int(data, "timestamp"))
+
+
+def decode_readings(payload):
+    """Decode an MQTT payload into ``(readings, batched)``.
+
+    Accepts a single JSON reading, a JSON batch (envelope or bare array), the
+    struct-packed batch format and, when msgpack is installed, msgpack maps/arrays.
+    """
+    first = payload[:1]
+    if first == b'{' or first == b'[' or first.isspace():
+        data = json_loads(payload)
+    elif payload[:2] == STRUCT_MAGIC:
+        return _unpack_struct(payload), True
+    elif first and first[0] in _MSGPACK_CONTAINER and msgpack is not None:
+        data = msgpack.unpackb(payload, raw=False)
+    else:
+        # Let json report what is wrong with the payload
+        data = json_loads(payload)
+    if isinstance(data, list):
+        return data, True
+    if isinstance(data, dict) and BATCH_KEY in data and 'device_id' not in data:
+        return data[BATCH_KEY], True
+    return [data], False
+
+
+def encode_readings(readings, fmt=FORMAT_JSON, batched=True):
+    """Encode reading dicts; a single reading is sent bare unless ``batched``."""
+    if fmt == FORMAT_STRUCT:
+        return _pack_struct(readings)
+    data = {BATCH_KEY: readings} if batched or len(readings) != 1 else readings[0]
+    if fmt == FORMAT_JSON:
+        return json_dumps(data)
+    if fmt == FORMAT_MSGPACK:
+        if msgpack is None:
+            raise RuntimeError("msgpack payload format requires the msgpack package")
+        return msgpack.packb(data)
+    raise ValueError(f"Unknown payload format: {fmt}")
+
+
+def _pack_struct(readings):
+    if len(readings) > MAX_STRUCT_RECORDS:
+        raise ValueError(f"Struct batches hold at most {MAX_STRUCT_RECORDS} readings")
+    buffer = bytearray(STRUCT_HEADER.pack(STRUCT_MAGIC, STRUCT_VERSION, len(readings)))
+    pack = STRUCT_RECORD.pack
+    for r in readings:
+        capacity = r.get("total_capacity")
+        occupied = r.get("occupied_spots")
+        buffer += pack(
+            int(r["device_id"]),
+            int(r["free_spots"]),
+            -1 if capacity is None else int(capacity),
+            -1 if occupied is None else int(occupied),
+            int(r.get("timestamp") or 0),
+        )
+    return bytes(buffer)
+
+
+def _unpack_struct(payload):
+    _, version, count = STRUCT_HEADER.unpack_from(payload)
+    if version != STRUCT_VERSION:
+        raise ValueError(f"Unsupported struct payload version {version}")
+    expected = STRUCT_HEADER.size + count * STRUCT_RECORD.size
+    if len(payload) != expected:
+        raise ValueError(f"Struct payload is {len(payload)} bytes, expected {expected}")
+    readings = []
+    for device_id, free_spots, capacity, occupied, timestamp in STRUCT_RECORD.iter_unpack(
+            memoryview(payload)[STRUCT_HEADER.size:]):
+        reading = {"device_id": device_id, "free_spots": free_spots}
+        if timestamp:
+            reading["timestamp"] = timestamp
+        if capacity >= 0:
+            reading["total_capacity"] = capacity
+        if occupied >= 0:
+            reading["occupied_spots"] = occupied
+        readings.append(reading)
+    return readings
@@ -0,0 +1,466 @@
+import logging
+import os
+import struct
+import threading
+import time
+from collections import deque
+from iot_common.metrics import (INFLUX_BATCH_POINTS, INFLUX_POINTS_DROPPED, INFLUX_POINTS_WRITTEN,
+                                INFLUX_SPILL_BYTES, INFLUX_SPILLED_BYTES, INFLUX_WRITE_ERRORS,
+                                INFLUX_WRITE_RETRIES, INFLUX_WRITE_SECONDS)
+
+logger = logging.getLogger(__name__)
+
+# What to do with a new point when the queue is full (and there is no spill directory)
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_BLOCK)
+
+FRAME_HEADER = struct.Struct('<I')
+DEFAULT_PRECISION = 'ns'
+
+# Outcome of one (retried) write call
+WRITE_OK = 'ok'
+WRITE_REJECTED = 'rejected'  # not retryable, the points are lost
+WRITE_GAVE_UP = 'gave_up'  # out of retries or shutting down, worth keeping
+
+
+def is_retryable(error):
+    """Connection errors, timeouts, 429 and 5xx are worth retrying; other HTTP errors are not."""
+    status = getattr(error, 'status', None)
+    return status is None or status == 429 or status >= 500
+
+
+def to_line(record):
+    """(line protocol, precision) of a queued record, for the spill file."""
+    if isinstance(record, bytes):
+        return record.decode(), DEFAULT_PRECISION
+    if isinstance(record, str):
+        return record, DEFAULT_PRECISION
+    return record.to_line_protocol(), getattr(record, '_write_precision', None) or DEFAULT_PRECISION
+
+
+class SpillQueue:
+    """Write-ahead segment files in ``directory``, consumed oldest first.
+
+    Every record is one frame: a little-endian uint32 length, then
+    ``bucket\\nprecision\\nline protocol`` in utf-8. Segments are named by sequence
+    number; ``prepend()`` writes below the lowest one so that points taken back from
+    memory on shutdown stay ahead of what was spilled before them.
+    """
+
+    def __init__(self, directory, max_bytes, segment_bytes=16 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(self._sequence(name) for name in os.listdir(directory) if name.endswith('.wal'))
+        self.bytes = sum(os.path.getsize(self._path(seq)) for seq in self.segments)
+        self._active = None  # (seq, file) being appended to
+        INFLUX_SPILL_BYTES.set(self.bytes)
+
+    @staticmethod
+    def _sequence(name):
+        return int(name[len('segment-'):-len('.wal')])
+
+    def _path(self, seq):
+        return os.path.join(self.directory, f"segment-{seq}.wal")
+
+    @staticmethod
+    def _frame(bucket, line, precision):
+        body = f"{bucket}\n{precision}\n{line}".encode()
+        return FRAME_HEADER.pack(len(body)) + body
+
+    def __bool__(self):
+        return bool(self.segments)
+
+    def append(self, bucket, line, precision=DEFAULT_PRECISION):
+        """Add a record at the tail; False when the size budget is used up."""
+        frame = self._frame(bucket, line, precision)
+        if self.bytes + len(frame) > self.max_bytes:
+            return False
+        if self._active is None or self._active[1].tell() >= self.segment_bytes:
+            self.seal()
+            seq = self.segments[-1] + 1 if self.segments else 0
+            self._active = (seq, open(self._path(seq), 'ab'))
+            self.segments.append(seq)
+        self._active[1].write(frame)
+        self.bytes += len(frame)
+        INFLUX_SPILLED_BYTES.inc(len(frame))
+        INFLUX_SPILL_BYTES.set(self.bytes)
+        return True
+
+    def prepend(self, records):
+        """Write ``(bucket, line, precision)`` records as a new head segment, ignoring the budget."""
+        if not records:
+            return
+        seq = self.segments[0] - 1 if self.segments else 0
+        data = b''.join(self._frame(bucket, line, precision) for bucket, line, precision in records)
+        with open(self._path(seq), 'wb') as f:
+            f.write(data)
+        self.segments.insert(0, seq)
+        self.bytes += len(data)
+        INFLUX_SPILLED_BYTES.inc(len(data))
+        INFLUX_SPILL_BYTES.set(self.bytes)
+
+    def seal(self):
+        if self._active is not None:
+            self._active[1].close()
+            self._active = None
+
+    def head(self):
+        """Sequence number of the oldest segment, sealing it first if it is being appended to."""
+        seq = self.segments[0]
+        if self._active is not None and self._active[0] == seq:
+            self.seal()
+        return seq
+
+    def read(self, seq):
+        """``(bucket, precision, line)`` records of a sealed segment; a torn last frame is ignored."""
+        with open(self._path(seq), 'rb') as f:
+            data = f.read()
+        records = []
+        offset = 0
+        while offset + FRAME_HEADER.size <= len(data):
+            (length,) = FRAME_HEADER.unpack_from(data, offset)
+            offset += FRAME_HEADER.size
+            if offset + length > len(data):
+                break
+            bucket, precision, line = data[offset:offset + length].decode().split('\n', 2)
+            records.append((bucket, precision, line))
+            offset += length
+        return records
+
+    def remove(self, seq):
+        path = self._path(seq)
+        self.bytes -= os.path.getsize(path)
+        os.remove(path)
+        self.segments.remove(seq)
+        INFLUX_SPILL_BYTES.set(self.bytes)
+
+    def close(self):
+        self.seal()
+
+
+class BatchingWriter:
+    """Buffers points in a bounded queue and writes them to InfluxDB in batches
+    from a background thread, so callers never wait for an HTTP round trip.
+
+    Failed writes are retried with exponential backoff (``retry_initial`` doubling up to
+    ``retry_max`` seconds) while new points keep queueing, at most ``max_retries`` times
+    (0 - until it works). With a ``spill_dir``, points that do not fit in memory go to
+    write-ahead segment files (at most ``spill_max_bytes``) instead of being dropped, and
+    are written back in order once InfluxDB keeps up again; segments left by a previous
+    run are replayed first. A batch that runs out of retries goes to the spill files too,
+    in front of everything queued after it; without a spill directory it is counted as
+    failed. Disk I/O runs outside the queue lock, so producers that go to memory never
+    wait for the disk.
+
+    Exposes the same ``write(bucket=..., record=...)`` call as the InfluxDB write API.
+    ``background=False`` starts no writer thread: points are written by ``flush()`` only.
+    """
+
+    def __init__(self, write_api, batch_size=500, flush_interval=1.0,
+                 max_queue_size=10000, overflow_policy=OVERFLOW_DROP_OLDEST,
+                 retry_initial=0.5, retry_max=30.0, max_retries=10, spill_dir=None,
+                 spill_max_bytes=1024 ** 3, background=True):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.write_api = write_api
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_queue_size = max(self.batch_size, max_queue_size)
+        self.overflow_policy = overflow_policy
+        self.retry_initial = retry_initial
+        self.retry_max = retry_max
+        self.max_retries = max_retries
+        self.background = background
+
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._stopping = threading.Event()  # cuts retry backoff short on close()
+        self._unwritten = []  # (bucket, record) that failed during close(), kept in the spill directory
+        self._thread = None
+        self._closed = False
+        self._finished = False  # close() has returned
+
+        self._spill = SpillQueue(spill_dir, spill_max_bytes) if spill_dir else None
+        # Guards the spill files; taken after _lock, never the other way round
+        self._spill_lock = threading.Lock()
+        # Records a producer routed to the spill but has not appended yet
+        self._spill_pending = 0
+        # (segment, records of it already written) when a replay stopped half way
+        self._replay_progress = (None, 0)
+        # While spilled points are pending every new point goes behind them on disk
+        self._spilling = bool(self._spill)
+        if self._spilling:
+            logger.info(f"Replaying {self._spill.bytes} bytes of spilled points from {spill_dir}")
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.spilled = 0
+
+    def write(self, bucket, record):
+        """Queue a point, or a list of points; returns False if anything was dropped."""
+        records = record if isinstance(record, list) else (record,)
+        accepted = True
+        to_spill = []
+        if self._thread is None and self.background:
+            # Started before queueing: the block policy needs a consumer to wait on
+            self.start()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BatchingWriter is closed")
+            for item in records:
+                if self._spill is not None and (self._spilling or len(self._queue) >= self.max_queue_size):
+                    self._spilling = True
+                    to_spill.append(item)
+                else:
+                    accepted = self._put(bucket, item) and accepted
+            self._spill_pending += len(to_spill)
+            if len(self._queue) >= self.batch_size:
+                self._not_empty.notify()
+        if to_spill:
+            accepted = self._spill_records(bucket, to_spill) and accepted
+        return accepted
+
+    def _put(self, bucket, record):
+        if len(self._queue) >= self.max_queue_size:
+            if self.overflow_policy == OVERFLOW_DROP_NEWEST:
+                self._count_dropped(1)
+                return False
+            if self.overflow_policy == OVERFLOW_DROP_OLDEST:
+                self._queue.popleft()
+                self._count_dropped(1)
+            else:
+                self._not_empty.notify()
+                while len(self._queue) >= self.max_queue_size and not self._closed:
+                    self._not_full.wait()
+                if self._closed:
+                    self._count_dropped(1)
+                    return False
+        self._queue.append((bucket, record))
+        return True
+
+    def _spill_records(self, bucket, records):
+        lines = [to_line(record) for record in records]
+        accepted = True
+        with self._spill_lock:
+            if not self._spill:
+                logger.warning(f"Influx write queue full ({self.max_queue_size}), spilling points to "
+                               f"{self._spill.directory}")
+            for line, precision in lines:
+                if self._spill.append(bucket, line, precision):
+                    self.spilled += 1
+                else:
+                    self._count_dropped(1)
+                    accepted = False
+        with self._lock:
+            self._spill_pending -= len(records)
+        return accepted
+
+    def _spill_front(self, records):
+        """Put ``(bucket, record)`` that ran out of retries ahead of everything queued after them."""
+        with self._lock:
+            # Points in memory are newer than the failed ones, so they go to disk behind them
+            records = records + list(self._queue)
+            self._queue.clear()
+            self._not_full.notify_all()
+            self._spilling = True
+        frames = [(bucket, *to_line(record)) for bucket, record in records]
+        with self._spill_lock:
+            self._spill.prepend(frames)
+            self.spilled += len(frames)
+        logger.warning(f"InfluxDB still failing after {self.max_retries} retries, spilled {len(frames)} "
+                       f"points to {self._spill.directory}")
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="influx-writer", daemon=True)
+            self._thread.start()
+
+    def flush(self):
+        """Synchronously write everything queued in memory and then the spilled points,
+        one attempt per batch. Not to be called while the writer thread is running."""
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                break
+            self._write_batch(batch, retry=False)
+        # Spilled points are newer than unwritten ones, so they wait for the next start too
+        while self._spilling and not self._queue and not self._unwritten:
+            if not self._replay_spill(retry=False):
+                return
+
+    def close(self, timeout=10):
+        """Stop the background thread and flush the remaining points.
+
+        If the thread is still inside a write after ``timeout`` seconds, nothing is flushed
+        from here, which could write a batch twice: the points still queued are spilled (or
+        counted as dropped without a spill directory). Points that cannot be written are kept
+        in the spill directory, if there is one.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._stopping.set()
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._thread is not None and self._thread.is_alive():
+            with self._lock:
+                left = list(self._queue)
+                self._queue.clear()
+            logger.error(f"Influx writer thread still busy after {timeout}s, not flushing {len(left)} queued points")
+            if self._spill is not None:
+                self._unwritten.extend(left)
+            else:
+                self._count_dropped(len(left))
+        else:
+            self.flush()
+        if self._spill is not None:
+            with self._spill_lock:
+                # Older than anything spilled before, so they go in front
+                self._spill.prepend([(bucket, *to_line(record)) for bucket, record in self._unwritten])
+                self.spilled += len(self._unwritten)
+                self._spill.close()
+        self._finished = True
+        logger.info(f"Influx writer closed: written={self.written}, dropped={self.dropped}, "
+                    f"failed={self.failed}, spilled={self.spilled}")
+
+    def queue_size(self):
+        return len(self._queue)
+
+    def spilled_bytes(self):
+        return self._spill.bytes if self._spill is not None else 0
+
+    def _count_dropped(self, count):
+        self.dropped += count
+        INFLUX_POINTS_DROPPED.inc(count)
+        # Log the first drop and then every 1000th, not every point
+        if self.dropped == count or self.dropped % 1000 < count:
+            logger.warning(f"Influx write queue full ({self.max_queue_size}), dropped {self.dropped} points so far")
+
+    def _take_batch(self):
+        with self._lock:
+            count = min(self.batch_size, len(self._queue))
+            batch = [self._queue.popleft() for _ in range(count)]
+            if count:
+                self._not_full.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if len(self._queue) < self.batch_size and not self._closed and not (self._spilling and not self._queue):
+                    self._not_empty.wait(self.flush_interval)
+                if self._closed:
+                    return
+            batch = self._take_batch()
+            if batch:
+                self._write_batch(batch)
+            elif self._spilling and not self._replay_spill():
+                # A segment could not be written yet, or a producer is still appending
+                self._stopping.wait(self.flush_interval)
+
+    def _replay_spill(self, retry=True):
+        """Write the oldest spill segment; False when there was nothing to do or it has to wait."""
+        with self._lock:
+            with self._spill_lock:
+                if not self._spill:
+                    if self._spill_pending:
+                        return False
+                    self._spilling = False
+                    logger.info("Spilled points replayed, back to in-memory buffering")
+                    return False
+                seq = self._spill.head()
+        # Sealed segments are only changed by this thread, so reading needs no lock
+        records = self._spill.read(seq)
+        progress_seq, done = self._replay_progress
+        for start in range(done if progress_seq == seq else 0, len(records), self.batch_size):
+            chunk = records[start:start + self.batch_size]
+            groups = {}
+            for bucket, precision, line in chunk:
+                groups.setdefault((bucket, precision), []).append(line)
+            for (bucket, precision), lines in groups.items():
+                result = self._write(bucket, lines, precision, retry=retry)
+                if result == WRITE_GAVE_UP:
+                    # The segment stays and is replayed from this chunk later; after a restart
+                    # from its start, and InfluxDB overwrites the points written twice
+                    self._replay_progress = (seq, start)
+                    return False
+                if result == WRITE_REJECTED:
+                    self.failed += len(lines)
+        with self._spill_lock:
+            self._spill.remove(seq)
+        return True
+
+    def _write_batch(self, batch, retry=True):
+        by_bucket = {}
+        for bucket, record in batch:
+            by_bucket.setdefault(bucket, []).append(record)
+        groups = list(by_bucket.items())
+        for index, (bucket, records) in enumerate(groups):
+            result = self._write(bucket, records, retry=retry)
+            if result == WRITE_OK:
+                continue
+            if result == WRITE_REJECTED or self._spill is None:
+                self.failed += len(records)
+                continue
+            left = [(bucket, record) for bucket, records in groups[index:] for record in records]
+            if self._finished:
+                # A write that outlived close(): too late to spill
+                self.failed += len(left)
+            elif self._stopping.is_set():
+                # Shutting down with InfluxDB unreachable: keep the points for the next start
+                self._unwritten.extend(left)
+            else:
+                self._spill_front(left)
+            return
+
+    def _write(self, bucket, records, precision=None, retry=True):
+        """One write call, repeated with backoff while the error is retryable.
+
+        Returns WRITE_OK, WRITE_REJECTED (not retryable) or WRITE_GAVE_UP (out of retries,
+        or stopping).
+        """
+        delay = self.retry_initial
+        attempts = 0
+        while True:
+            started = time.perf_counter()
+            INFLUX_BATCH_POINTS.observe(len(records))
+            try:
+                if precision is None:
+                    self.write_api.write(bucket=bucket, record=records)
+                else:
+                    self.write_api.write(bucket=bucket, record=records, write_precision=precision)
+                elapsed = time.perf_counter() - started
+                INFLUX_WRITE_SECONDS.observe(elapsed)
+                INFLUX_POINTS_WRITTEN.inc(len(records))
+                self.written += len(records)
+                logger.debug(f"Wrote {len(records)} points to {bucket} in {elapsed:.3f}s")
+                return WRITE_OK
+            except Exception as e:
+                INFLUX_WRITE_ERRORS.inc()
+                if not is_retryable(e):
+                    logger.error(f"Error writing batch of {len(records)} points to InfluxDB: {e}")
+                    return WRITE_REJECTED
+                if not retry or self._stopping.is_set() or (self.max_retries and attempts >= self.max_retries):
+                    logger.error(f"Error writing batch of {len(records)} points to InfluxDB: {e}, "
+                                 f"giving up after {attempts} retries")
+                    return WRITE_GAVE_UP
+                logger.warning(f"Error writing batch of {len(records)} points to InfluxDB: {e}, "
+                               f"retrying in {delay:.1f}s")
+            attempts += 1
+            INFLUX_WRITE_RETRIES.inc()
+            if self._stopping.wait(delay):
+                # close() during the backoff: one last attempt, then give up or spill
+                retry = False
+            delay = min(delay * 2, self.retry_max)
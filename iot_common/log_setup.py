@@ -0,0 +1,207 @@
+"""Non-blocking, rate-limited logging shared by the pipeline services.
+
+``configure_logging()`` replaces ``logging.basicConfig``. The calling thread only runs
+the rate limiter and puts the record on a bounded queue. A listener thread formats
+and writes it, so a slow stderr or log shipper never stalls the MQTT loop. Records
+are formatted only when they are written: hot paths log with %-style arguments
+(``logger.debug("Received data: %s", data)``), and the arguments must not be mutated
+after the call.
+
+Rate limiting is per call site (file and line), so every distinct log statement gets
+its own budget no matter how its message is built; ERROR and above are never limited.
+With ``sample_every=N`` only every N-th record of a call site is considered at all.
+Suppressed records are counted and summarized once per ``summary_interval``.
+
+Importing the module changes nothing: a service calls ``configure_logging()`` when it
+starts, which also installs the exit and fork hooks.
+
+    LOG_LEVEL=INFO LOG_RATE_LIMIT=5 LOG_BURST=20 LOG_SAMPLE_EVERY=0 LOG_SUMMARY_INTERVAL=60
+    LOG_QUEUE_SIZE=10000 LOG_ASYNC=true
+"""
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing.util import Finalize, register_after_fork
+from iot_common.metrics import LOG_SUPPRESSED_QUEUE_FULL, LOG_SUPPRESSED_RATE_LIMIT, LOG_SUPPRESSED_SAMPLED
+
+logger = logging.getLogger(__name__)
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_RATE_LIMIT = float(os.getenv('LOG_RATE_LIMIT', '5'))  # records per second per call site, 0 - unlimited
+LOG_BURST = int(os.getenv('LOG_BURST', '20'))
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', '0'))  # keep 1 in N records per call site, 0 - all
+LOG_SUMMARY_INTERVAL = float(os.getenv('LOG_SUMMARY_INTERVAL', '60'))  # seconds
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_ASYNC = os.getenv('LOG_ASYNC', 'true').lower() == 'true'
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per call site: ``rate`` records per second with bursts of ``burst``.
+
+    Records at ``exempt_level`` and above always pass. Suppressed records are counted
+    per call site for ``take_suppressed()``.
+    """
+
+    def __init__(self, rate=LOG_RATE_LIMIT, burst=LOG_BURST, sample_every=LOG_SAMPLE_EVERY,
+                 exempt_level=logging.ERROR):
+        super().__init__()
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.sample_every = sample_every if sample_every > 1 else 0
+        self.exempt_level = exempt_level
+        self._buckets = {}  # (pathname, lineno) -> [tokens, last refill, records seen]
+        self._suppressed = {}  # (pathname, lineno) -> [count, first suppressed message]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.exempt_level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            bucket[2] += 1
+            if self.sample_every and bucket[2] % self.sample_every != 1:
+                self._suppress(key, record)
+                LOG_SUPPRESSED_SAMPLED.inc()
+                return False
+            if self.rate > 0:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                if tokens < 1:
+                    bucket[0] = tokens
+                    self._suppress(key, record)
+                    LOG_SUPPRESSED_RATE_LIMIT.inc()
+                    return False
+                bucket[0] = tokens - 1
+        return True
+
+    def _suppress(self, key, record):
+        suppressed = self._suppressed.get(key)
+        if suppressed is None:
+            # The raw template: formatting it here would defeat the point
+            self._suppressed[key] = [1, str(record.msg)[:80]]
+        else:
+            suppressed[0] += 1
+
+    def take_suppressed(self):
+        """Counts suppressed since the last call: ``[((pathname, lineno), count, message), ...]``."""
+        with self._lock:
+            suppressed, self._suppressed = self._suppressed, {}
+        return [(key, count, message) for key, (count, message) in suppressed.items()]
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Puts records on the queue as they are, leaving formatting to the listener thread;
+    drops and counts them when the queue is full instead of blocking."""
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_SUPPRESSED_QUEUE_FULL.inc()
+
+
+def summarize(suppressed, interval):
+    suppressed = sorted(suppressed, key=lambda item: -item[1])
+    total = sum(count for _, count, _ in suppressed)
+    top = ", ".join(f"{os.path.basename(path)}:{line} x{count} ({message!r})"
+                    for (path, line), count, message in suppressed[:5])
+    return f"Suppressed {total} log records in the last {interval:.0f}s: {top}"
+
+
+class _LoggingSetup:
+    def __init__(self, handler, listener, rate_filter, summary_interval):
+        self.handler = handler
+        self.listener = listener
+        self.rate_filter = rate_filter
+        self._stop = threading.Event()
+        self._summary = None
+        if summary_interval > 0:
+            self._summary = threading.Thread(target=self._summarize, args=(summary_interval,),
+                                             name="log-summary", daemon=True)
+            self._summary.start()
+
+    def _summarize(self, interval):
+        while not self._stop.wait(interval):
+            self.flush_summary(interval)
+
+    def flush_summary(self, interval):
+        suppressed = self.rate_filter.take_suppressed()
+        if suppressed:
+            logger.warning(summarize(suppressed, interval))
+
+    def stop(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self.listener is not None:
+            self.listener.stop()
+
+
+_setup = None
+_config = None
+_hooks_installed = False
+
+
+def configure_logging(level=LOG_LEVEL, stream=None, rate=LOG_RATE_LIMIT, burst=LOG_BURST,
+                      sample_every=LOG_SAMPLE_EVERY, summary_interval=LOG_SUMMARY_INTERVAL,
+                      queue_size=LOG_QUEUE_SIZE, non_blocking=LOG_ASYNC):
+    """Install the root handler; calling it again replaces the previous setup."""
+    global _setup, _config, _hooks_installed
+    if not _hooks_installed:
+        atexit.register(_shutdown)
+        os.register_at_fork(after_in_child=_after_fork)
+        _hooks_installed = True
+    _config = dict(level=level, stream=stream, rate=rate, burst=burst, sample_every=sample_every,
+                   summary_interval=summary_interval, queue_size=queue_size, non_blocking=non_blocking)
+    root = logging.getLogger()
+    if _setup is not None:
+        root.removeHandler(_setup.handler)
+        _setup.stop()
+    output = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    output.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    rate_filter = RateLimitFilter(rate, burst, sample_every)
+    if non_blocking:
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+        listener = QueueListener(handler.queue, output)
+        listener.start()
+    else:
+        handler, listener = output, None
+    handler.addFilter(rate_filter)
+    root.addHandler(handler)
+    root.setLevel(level)
+    _setup = _LoggingSetup(handler, listener, rate_filter, summary_interval)
+    register_after_fork(_setup, _register_worker_shutdown)
+    return _setup
+
+
+def _shutdown():
+    # Write out what is still queued before the interpreter exits
+    if _setup is not None:
+        _setup.stop()
+
+
+def _after_fork():
+    # The listener and summary threads do not survive a fork (pipeline workers in
+    # process mode): start a setup of the child's own
+    global _setup
+    if _setup is not None:
+        logging.getLogger().removeHandler(_setup.handler)
+        _setup = None
+        configure_logging(**_config)
+
+
+def _register_worker_shutdown(_):
+    # multiprocessing workers exit without running atexit
+    Finalize(None, _shutdown, exitpriority=0)
@@ -0,0 +1,67 @@
+"""Prometheus metrics shared by the pipeline services.
+
+Every service is scraped as its own job, so the names are common across services.
+Labelled metrics are bound to their label values once, at import time, and the hot
+path only calls ``inc()`` / ``observe()`` on the bound children.
+"""
+import logging
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+logger = logging.getLogger(__name__)
+
+# Per-message work is sub-millisecond, so the default buckets would be too coarse
+STAGE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+WRITE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+MESSAGES_RECEIVED = Counter('mqtt_messages_received_total', 'MQTT messages received')
+MESSAGES_PUBLISHED = Counter('mqtt_messages_published_total', 'MQTT messages published')
+READINGS_RECEIVED = Counter('readings_received_total', 'Readings decoded from received messages')
+READINGS_PUBLISHED = Counter('readings_published_total', 'Readings published')
+READINGS_DROPPED = Counter('readings_dropped_total', 'Readings dropped before storage', ['reason'])
+READINGS_SUPPRESSED = Counter('readings_suppressed_total', 'Unchanged readings not forwarded or stored')
+STAGE_SECONDS = Histogram('stage_duration_seconds', 'Time spent per message in a processing stage',
+                          ['stage'], buckets=STAGE_BUCKETS)
+QUEUE_DEPTH = Gauge('queue_depth', 'Items waiting in an internal queue', ['queue'])
+
+INFLUX_WRITE_SECONDS = Histogram('influx_write_duration_seconds', 'InfluxDB write call latency',
+                                 buckets=WRITE_BUCKETS)
+INFLUX_BATCH_POINTS = Histogram('influx_batch_points', 'Points per InfluxDB write call', buckets=BATCH_BUCKETS)
+INFLUX_POINTS_WRITTEN = Counter('influx_points_written_total', 'Points written to InfluxDB')
+INFLUX_WRITE_ERRORS = Counter('influx_write_errors_total', 'Failed InfluxDB write calls')
+INFLUX_POINTS_DROPPED = Counter('influx_points_dropped_total', 'Points dropped by a full write queue or spill budget')
+INFLUX_WRITE_RETRIES = Counter('influx_write_retries_total', 'InfluxDB write calls retried after a backoff')
+INFLUX_SPILLED_BYTES = Counter('influx_spilled_bytes_total', 'Bytes of points spilled to disk')
+INFLUX_SPILL_BYTES = Gauge('influx_spill_bytes', 'Bytes of spilled points waiting on disk')
+
+REDIS_FLUSH_SECONDS = Histogram('redis_state_flush_duration_seconds', 'Redis last-value flush latency',
+                                buckets=WRITE_BUCKETS)
+REDIS_DEVICES_WRITTEN = Counter('redis_state_devices_written_total', 'Device states written to Redis')
+REDIS_READINGS_COALESCED = Counter('redis_state_readings_coalesced_total',
+                                   'Readings superseded by a later reading of the same device before a flush')
+REDIS_WRITE_ERRORS = Counter('redis_state_write_errors_total', 'Failed Redis last-value flushes')
+
+ROLLUP_WINDOWS_CLOSED = Counter('rollup_windows_closed_total', 'Per-device rollup windows closed', ['window'])
+ROLLUP_LATE_READINGS = Counter('rollup_late_readings_total',
+                               'Readings older than the open rollup window of their device', ['window'])
+ROLLUP_OPEN_WINDOWS = Gauge('rollup_open_windows', 'Per-device rollup windows being aggregated')
+
+LOG_RECORDS_SUPPRESSED = Counter('log_records_suppressed_total', 'Log records not written', ['reason'])
+
+DECODE_SECONDS = STAGE_SECONDS.labels(stage='decode')
+VALIDATE_SECONDS = STAGE_SECONDS.labels(stage='validate')
+WRITE_SECONDS = STAGE_SECONDS.labels(stage='write')
+ROLLUP_SECONDS = STAGE_SECONDS.labels(stage='rollup')
+DROPPED_DECODE_ERROR = READINGS_DROPPED.labels(reason='decode_error')
+DROPPED_INVALID = READINGS_DROPPED.labels(reason='invalid')
+LOG_SUPPRESSED_RATE_LIMIT = LOG_RECORDS_SUPPRESSED.labels(reason='rate_limit')
+LOG_SUPPRESSED_SAMPLED = LOG_RECORDS_SUPPRESSED.labels(reason='sampled')
+LOG_SUPPRESSED_QUEUE_FULL = LOG_RECORDS_SUPPRESSED.labels(reason='queue_full')
+
+
+def start_metrics_server(port):
+    """Serve /metrics on ``port`` from a daemon thread; 0 disables it."""
+    if port <= 0:
+        return
+    start_http_server(port)
+    logger.info(f"Serving Prometheus metrics on :{port}/metrics")
@@ -0,0 +1,84 @@
+"""Append-only files of timestamped MQTT messages.
+
+The data simulator writes generated streams in this format, the MQTT recorder captures
+live traffic in it, and both are replayed later at any rate. Layout: an 8-byte magic,
+then one record per message:
+
+    header (RECORD_HEADER) | topic (utf-8) | payload
+
+``readings`` is the number of readings in the payload when the writer knows it, 0 otherwise.
+"""
+import mmap
+import os
+import struct
+
+RECORD_MAGIC = b'IOTREC1\n'
+RECORD_HEADER = struct.Struct('<qHHI')  # timestamp_ns, topic length, readings, payload length
+
+
+class RecordWriter:
+    """Writes records to ``path``; ``append=True`` continues an existing recording."""
+
+    def __init__(self, path, append=False):
+        self.path = path
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                if f.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+                    raise ValueError(f"{path} is not a message recording")
+            self.file = open(path, 'ab')
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(RECORD_MAGIC)
+        self.records = 0
+
+    def write(self, timestamp_ns, topic, payload, readings=0):
+        topic = topic.encode()
+        self.file.write(RECORD_HEADER.pack(timestamp_ns, len(topic), min(readings, 0xFFFF), len(payload)))
+        self.file.write(topic)
+        self.file.write(payload)
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_records(path):
+    """Yield ``(timestamp_ns, topic, payload, readings)`` in file order.
+
+    The file is memory-mapped, so a sequential pass costs one slice per payload
+    rather than a read() call per field.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < len(RECORD_MAGIC):
+            raise ValueError(f"{path} is not a message recording")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(RECORD_MAGIC)] != RECORD_MAGIC:
+                raise ValueError(f"{path} is not a message recording")
+            if hasattr(data, 'madvise'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            unpack_header = RECORD_HEADER.unpack_from
+            header_size = RECORD_HEADER.size
+            topics = {}  # topic bytes -> str, a recording has only a handful of topics
+            offset = len(RECORD_MAGIC)
+            while offset + header_size <= size:
+                timestamp_ns, topic_length, readings, payload_length = unpack_header(data, offset)
+                topic_end = offset + header_size + topic_length
+                end = topic_end + payload_length
+                if end > size:
+                    return  # truncated tail of a file still being written
+                raw_topic = data[offset + header_size:topic_end]
+                topic = topics.get(raw_topic)
+                if topic is None:
+                    topic = topics[raw_topic] = raw_topic.decode()
+                yield timestamp_ns, topic, data[topic_end:end], readings
+                offset = end
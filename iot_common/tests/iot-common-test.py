@@ -0,0 +1,390 @@
+import unittest
+from unittest import mock
+from iot_common.codec import decode_readings, encode_readings, to_reading, use_json_library
+from iot_common.influx_writer import BatchingWriter
+from iot_common.recording import RecordWriter, read_records
+from iot_common.log_setup import RateLimitFilter, NonBlockingQueueHandler, configure_logging, summarize
+from prometheus_client import REGISTRY
+import time
+import threading
+import io
+import logging
+import os
+import queue
+import shutil
+import tempfile
+
+class TestToReading(unittest.TestCase):
+    def test_valid_integer(self):
+        reading = to_reading({"device_id": 1, "free_spots": 5})
+        self.assertEqual((reading.device_id, reading.free_spots, reading.timestamp), (1, 5, None))
+
+    def test_valid_string_integer(self):
+        self.assertEqual(to_reading({"device_id": 1, "free_spots": "5"}).free_spots, 5)
+
+    def test_invalid_negative(self):
+        with self.assertRaisesRegex(ValueError, "must be >= 0"):
+            to_reading({"device_id": 1, "free_spots": -1})
+
+    def test_missing_free_spots(self):
+        with self.assertRaises(ValueError):
+            to_reading({"device_id": 1})
+
+    def test_missing_device_id(self):
+        with self.assertRaises(ValueError):
+            to_reading({"free_spots": 5})
+
+    def test_invalid_string(self):
+        with self.assertRaises(ValueError):
+            to_reading({"device_id": 1, "free_spots": "five"})
+
+    def test_not_an_object(self):
+        with self.assertRaises(ValueError):
+            to_reading([1, 2])
+
+    def test_booleans_are_not_integers(self):
+        for data in ({"device_id": 1, "free_spots": True},
+                     {"device_id": 1, "free_spots": 5, "total_capacity": False}):
+            with self.assertRaisesRegex(ValueError, "is not an integer"):
+                to_reading(data)
+
+    def test_fractional_floats_are_rejected(self):
+        for data in ({"device_id": 1, "free_spots": 2.5},
+                     {"device_id": 1, "free_spots": 5, "occupied_spots": 0.1},
+                     {"device_id": 1, "free_spots": float("nan")}):
+            with self.assertRaisesRegex(ValueError, "is not an integer"):
+                to_reading(data)
+        self.assertEqual(to_reading({"device_id": 1, "free_spots": 5.0, "timestamp": 1e18}).as_dict(),
+                         {"device_id": 1, "free_spots": 5, "timestamp": 10 ** 18})
+
+    def test_reads_like_the_decoded_dict(self):
+        data = {"device_id": "a", "free_spots": 3, "total_capacity": 10, "timestamp": 7}
+        reading = to_reading(data)
+        self.assertEqual(reading, data)
+        self.assertEqual(dict(reading), data)
+        self.assertEqual(reading.get("occupied_spots", -1), -1)
+        self.assertIn("total_capacity", reading)
+        self.assertNotIn("occupied_spots", reading)
+
+class TestCodec(unittest.TestCase):
+    def test_single_json_reading(self):
+        self.assertEqual(decode_readings(b'{"device_id": "a", "free_spots": 1}'),
+                         ([{"device_id": "a", "free_spots": 1}], False))
+
+    def test_json_batches(self):
+        readings = [{"device_id": "a", "free_spots": 1}, {"device_id": "b", "free_spots": 2}]
+        self.assertEqual(decode_readings(encode_readings(readings)), (readings, True))
+        self.assertEqual(decode_readings(b'[{"device_id": "a", "free_spots": 1}]'), (readings[:1], True))
+
+    def test_struct_round_trip(self):
+        readings = [
+            {"device_id": 7, "free_spots": 3, "total_capacity": 40, "occupied_spots": 37, "timestamp": 99},
+            {"device_id": 8, "free_spots": 0},
+        ]
+        payload = encode_readings(readings, fmt='struct')
+        self.assertEqual(len(payload), 5 + 2 * 28)
+        self.assertEqual(decode_readings(payload), (readings, True))
+
+    def test_truncated_struct_payload(self):
+        payload = encode_readings([{"device_id": 7, "free_spots": 3}], fmt='struct')
+        with self.assertRaises(ValueError):
+            decode_readings(payload[:-1])
+
+    def test_invalid_payload(self):
+        with self.assertRaises(ValueError):
+            decode_readings(b'invalid json')
+
+    def test_json_libraries_agree(self):
+        readings = [{"device_id": "a", "free_spots": 1, "timestamp": 1234567890123456789}]
+        try:
+            for name in ('json', 'auto'):
+                use_json_library(name)
+                self.assertEqual(decode_readings(encode_readings(readings)), (readings, True))
+                with self.assertRaises(ValueError):
+                    decode_readings(b'{"device_id": ')
+        finally:
+            use_json_library('auto')
+
+class TestRecording(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.rec')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def test_append_and_read_back(self):
+        with RecordWriter(self.path) as writer:
+            writer.write(1, "iot_topic", b'{"device_id": 1}', 1)
+        with RecordWriter(self.path, append=True) as writer:
+            writer.write(2, "rule_engine_topic", b'')
+        self.assertEqual(list(read_records(self.path)),
+                         [(1, "iot_topic", b'{"device_id": 1}', 1), (2, "rule_engine_topic", b'', 0)])
+
+    def test_truncated_tail_is_skipped(self):
+        with RecordWriter(self.path) as writer:
+            writer.write(1, "iot_topic", b'payload')
+            writer.write(2, "iot_topic", b'payload')
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        self.assertEqual([r[0] for r in read_records(self.path)], [1])
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a recording')
+        with self.assertRaises(ValueError):
+            list(read_records(self.path))
+
+class TestBatchingWriter(unittest.TestCase):
+    def test_flush_groups_points_by_bucket(self):
+        mock_api = mock.MagicMock()
+        writer = BatchingWriter(mock_api, batch_size=10, flush_interval=60)
+        writer.write(bucket="iot_bucket", record="p1")
+        writer.write(bucket="iot_bucket", record="p2")
+        writer.write(bucket="other_bucket", record="p3")
+        writer.close()
+        mock_api.write.assert_any_call(bucket="iot_bucket", record=["p1", "p2"])
+        mock_api.write.assert_any_call(bucket="other_bucket", record=["p3"])
+        self.assertEqual(writer.written, 3)
+
+    def test_flushes_full_batch_in_background(self):
+        mock_api = mock.MagicMock()
+        writer = BatchingWriter(mock_api, batch_size=2, flush_interval=60)
+        writer.write(bucket="iot_bucket", record="p1")
+        writer.write(bucket="iot_bucket", record="p2")
+        deadline = time.time() + 2
+        while not mock_api.write.called and time.time() < deadline:
+            time.sleep(0.01)
+        mock_api.write.assert_called_once_with(bucket="iot_bucket", record=["p1", "p2"])
+        writer.close()
+
+    def test_drop_oldest_when_queue_full(self):
+        mock_api = mock.MagicMock()
+        writer = BatchingWriter(mock_api, batch_size=2, max_queue_size=2, overflow_policy='drop_oldest',
+                                background=False)
+        for record in ("p1", "p2", "p3"):
+            writer.write(bucket="iot_bucket", record=record)
+        writer.flush()
+        mock_api.write.assert_called_once_with(bucket="iot_bucket", record=["p2", "p3"])
+        self.assertEqual(writer.dropped, 1)
+
+    def test_drop_newest_when_queue_full(self):
+        mock_api = mock.MagicMock()
+        writer = BatchingWriter(mock_api, batch_size=2, max_queue_size=2, overflow_policy='drop_newest',
+                                background=False)
+        results = [writer.write(bucket="iot_bucket", record=r) for r in ("p1", "p2", "p3")]
+        writer.flush()
+        self.assertEqual(results, [True, True, False])
+        mock_api.write.assert_called_once_with(bucket="iot_bucket", record=["p1", "p2"])
+
+    def test_failed_write_is_counted(self):
+        mock_api = mock.MagicMock()
+        mock_api.write.side_effect = Exception("influx down")
+        writer = BatchingWriter(mock_api, batch_size=10, flush_interval=60)
+        writer.write(bucket="iot_bucket", record="p1")
+        with self.assertLogs('iot_common.influx_writer', level='ERROR'):
+            writer.close()
+        self.assertEqual(writer.failed, 1)
+
+    def test_unknown_overflow_policy(self):
+        with self.assertRaises(ValueError):
+            BatchingWriter(mock.MagicMock(), overflow_policy='explode')
+
+    def wait_for(self, condition, timeout=2):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def spill_dir(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, True)
+        return path
+
+    def written_records(self, mock_api):
+        return [record for c in mock_api.write.call_args_list for record in c.kwargs["record"]]
+
+    def test_failed_write_is_retried(self):
+        mock_api = mock.MagicMock()
+        mock_api.write.side_effect = [Exception("timeout"), None]
+        writer = BatchingWriter(mock_api, batch_size=2, flush_interval=60, retry_initial=0.01)
+        with self.assertLogs('iot_common.influx_writer', level='WARNING'):
+            writer.write(bucket="iot_bucket", record=["p1", "p2"])
+            self.wait_for(lambda: writer.written == 2)
+        writer.close()
+        self.assertEqual(mock_api.write.call_count, 2)
+        self.assertEqual(writer.failed, 0)
+
+    def test_client_error_is_not_retried(self):
+        mock_api = mock.MagicMock()
+        error = Exception("bad request")
+        error.status = 400
+        mock_api.write.side_effect = error
+        writer = BatchingWriter(mock_api, batch_size=1, flush_interval=60, retry_initial=0.01)
+        with self.assertLogs('iot_common.influx_writer', level='ERROR'):
+            writer.write(bucket="iot_bucket", record="p1")
+            self.wait_for(lambda: writer.failed == 1)
+        writer.close()
+        mock_api.write.assert_called_once()
+
+    def test_overflow_spills_to_disk_and_replays_in_order(self):
+        spill_dir = self.spill_dir()
+        mock_api = mock.MagicMock()
+        writer = BatchingWriter(mock_api, batch_size=2, max_queue_size=2, spill_dir=spill_dir, background=False)
+        with self.assertLogs('iot_common.influx_writer', level='WARNING'):
+            for record in ("p1", "p2", "p3", "p4", "p5"):
+                self.assertTrue(writer.write(bucket="iot_bucket", record=record))
+        self.assertEqual(writer.queue_size(), 2)
+        self.assertGreater(writer.spilled_bytes(), 0)
+        with self.assertLogs('iot_common.influx_writer', level='INFO'):
+            writer.flush()
+        self.assertEqual(self.written_records(mock_api), ["p1", "p2", "p3", "p4", "p5"])
+        mock_api.write.assert_called_with(bucket="iot_bucket", record=["p5"], write_precision="ns")
+        self.assertEqual(writer.spilled_bytes(), 0)
+        self.assertEqual(writer.queue_size(), 0)
+        writer.write(bucket="iot_bucket", record="p6")
+        self.assertEqual(writer.queue_size(), 1)  # back to memory once the spill is replayed
+
+    def test_points_left_on_close_are_replayed_first_on_restart(self):
+        spill_dir = self.spill_dir()
+        down_api = mock.MagicMock()
+        down_api.write.side_effect = Exception("connection refused")
+        writer = BatchingWriter(down_api, batch_size=10, flush_interval=60, spill_dir=spill_dir)
+        writer.write(bucket="iot_bucket", record=["p1", "p2"])
+        with self.assertLogs('iot_common.influx_writer', level='ERROR'):
+            writer.close()
+        self.assertEqual((writer.failed, writer.spilled), (0, 2))
+
+        up_api = mock.MagicMock()
+        writer = BatchingWriter(up_api, batch_size=10, flush_interval=60, spill_dir=spill_dir)
+        writer.write(bucket="iot_bucket", record="p3")
+        self.wait_for(lambda: writer.written == 3)
+        writer.close()
+        self.assertEqual(self.written_records(up_api), ["p1", "p2", "p3"])
+        self.assertEqual(os.listdir(spill_dir), [])
+
+    def test_close_does_not_flush_while_a_write_is_in_flight(self):
+        spill_dir = self.spill_dir()
+        release = threading.Event()
+        slow_api = mock.MagicMock()
+        slow_api.write.side_effect = lambda **kwargs: release.wait(5)
+        writer = BatchingWriter(slow_api, batch_size=1, flush_interval=60, spill_dir=spill_dir)
+        writer.write(bucket="iot_bucket", record="p1")
+        self.wait_for(lambda: slow_api.write.called)
+        writer.write(bucket="iot_bucket", record=["p2", "p3"])
+        with self.assertLogs('iot_common.influx_writer', level='ERROR'):
+            writer.close(timeout=0.05)
+        release.set()
+        self.wait_for(lambda: writer.written == 1)
+        self.assertEqual(self.written_records(slow_api), ["p1"])
+        self.assertEqual(writer.spilled, 2)
+
+        up_api = mock.MagicMock()
+        writer = BatchingWriter(up_api, spill_dir=spill_dir, background=False)
+        writer.flush()
+        self.assertEqual(self.written_records(up_api), ["p2", "p3"])
+
+    def test_retries_are_capped_then_spilled_in_order(self):
+        spill_dir = self.spill_dir()
+        down_api = mock.MagicMock()
+        down_api.write.side_effect = Exception("timeout")
+        writer = BatchingWriter(down_api, batch_size=2, flush_interval=60, retry_initial=0.001,
+                                max_retries=2, spill_dir=spill_dir)
+        with self.assertLogs('iot_common.influx_writer', level='WARNING'):
+            writer.write(bucket="iot_bucket", record=["p1", "p2"])
+            self.wait_for(lambda: writer.spilled == 2)
+            writer.write(bucket="iot_bucket", record="p3")
+            writer.close()
+        self.assertGreaterEqual(down_api.write.call_count, 3)
+        self.assertEqual((writer.failed, writer.spilled), (0, 3))
+
+        up_api = mock.MagicMock()
+        writer = BatchingWriter(up_api, spill_dir=spill_dir, background=False)
+        writer.flush()
+        self.assertEqual(self.written_records(up_api), ["p1", "p2", "p3"])
+
+    def test_retries_are_capped_without_spill(self):
+        down_api = mock.MagicMock()
+        down_api.write.side_effect = Exception("timeout")
+        writer = BatchingWriter(down_api, batch_size=2, flush_interval=60, retry_initial=0.001, max_retries=2)
+        with self.assertLogs('iot_common.influx_writer', level='WARNING'):
+            writer.write(bucket="iot_bucket", record=["p1", "p2"])
+            self.wait_for(lambda: writer.failed == 2)
+            writer.close()
+        self.assertEqual(down_api.write.call_count, 3)
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_batch_metrics(self):
+        errors = self.sample("influx_write_errors_total")
+        batches = self.sample("influx_batch_points_count")
+        mock_api = mock.MagicMock()
+        mock_api.write.side_effect = [None, Exception("influx down")]
+        writer = BatchingWriter(mock_api, batch_size=10, flush_interval=60)
+        writer.write(bucket="iot_bucket", record=["p1", "p2"])
+        writer.write(bucket="other_bucket", record="p3")
+        with self.assertLogs('iot_common.influx_writer', level='ERROR'):
+            writer.close()
+        self.assertEqual(self.sample("influx_batch_points_count") - batches, 2)
+        self.assertEqual(self.sample("influx_write_errors_total") - errors, 1)
+
+class TestLogSetup(unittest.TestCase):
+    def record(self, lineno=10, level=logging.INFO, msg="Received data: %s", args=("x",)):
+        return logging.LogRecord("iot", level, "/app/iot_controller.py", lineno, msg, args, None)
+
+    def test_rate_limit_per_call_site(self):
+        log_filter = RateLimitFilter(rate=0.001, burst=3)
+        passed = [log_filter.filter(self.record()) for _ in range(10)]
+        self.assertEqual(passed.count(True), 3)
+        # Another call site has its own budget
+        self.assertTrue(log_filter.filter(self.record(lineno=20)))
+        suppressed = log_filter.take_suppressed()
+        self.assertEqual(suppressed, [(("/app/iot_controller.py", 10), 7, "Received data: %s")])
+        self.assertEqual(log_filter.take_suppressed(), [])
+
+    def test_errors_are_never_limited(self):
+        log_filter = RateLimitFilter(rate=0.001, burst=1)
+        self.assertTrue(all(log_filter.filter(self.record(level=logging.ERROR)) for _ in range(5)))
+        self.assertTrue(log_filter.filter(self.record(level=logging.WARNING)))
+        self.assertFalse(log_filter.filter(self.record(level=logging.WARNING)))
+
+    def test_sampling(self):
+        log_filter = RateLimitFilter(rate=0, sample_every=10)
+        passed = [log_filter.filter(self.record()) for _ in range(100)]
+        self.assertEqual(passed.count(True), 10)
+        self.assertTrue(passed[0])
+
+    def test_summary_lists_busiest_call_sites(self):
+        text = summarize([(("/app/a.py", 1), 3, "a"), (("/app/b.py", 2), 40, "b")], 60)
+        self.assertTrue(text.startswith("Suppressed 43 log records in the last 60s"))
+        self.assertLess(text.index("b.py:2 x40"), text.index("a.py:1 x3"))
+
+    def test_full_queue_drops(self):
+        before = REGISTRY.get_sample_value("log_records_suppressed_total", {"reason": "queue_full"}) or 0
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+        handler.handle(self.record())
+        handler.handle(self.record())
+        self.assertEqual(handler.queue.qsize(), 1)
+        after = REGISTRY.get_sample_value("log_records_suppressed_total", {"reason": "queue_full"})
+        self.assertEqual(after - before, 1)
+
+    def test_records_are_formatted_by_the_listener(self):
+        stream = io.StringIO()
+        root = logging.getLogger()
+        level = root.level
+        setup = configure_logging('INFO', stream=stream, rate=0.001, burst=2, summary_interval=0)
+        try:
+            test_logger = logging.getLogger("log_setup_test")
+            for i in range(5):
+                test_logger.info("Reading %d", i)
+            setup.listener.stop()
+            self.assertEqual(stream.getvalue().splitlines(),
+                             ["INFO:log_setup_test:Reading 0", "INFO:log_setup_test:Reading 1"])
+            setup.listener.start()
+            setup.flush_summary(60)
+        finally:
+            root.removeHandler(setup.handler)
+            root.setLevel(level)
+            setup.stop()
+        self.assertIn("Suppressed 3 log records", stream.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
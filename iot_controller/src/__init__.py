@@ -1,2 +1,2 @@
 # IoT Controller package
-from .iot_controller.iot_controller import validate_data, on_message, on_connect, on_disconnect, setup_mqtt, write_api, logger
+from .iot_controller import on_message, on_connect, on_disconnect, setup_mqtt, write_api, logger
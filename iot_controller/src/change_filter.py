@@ -0,0 +1,69 @@
+import time
+from collections import OrderedDict
+
+
+class ChangeFilter:
+    """Suppresses readings that do not change a device's state.
+
+    A reading passes when it is the first one of its device, when ``free_spots`` moved
+    more than ``deadband`` away from the last value that passed, when the lot becomes
+    full or stops being full, when ``total_capacity`` changes, or when ``heartbeat``
+    seconds of reading time have passed since the device last got through. With the
+    default ``deadband=0`` every change passes and only repeats are dropped.
+
+    A device whose last forwarded reading is older than ``heartbeat`` is forgotten: its
+    next reading passes anyway. Reading time is capped by the wall clock, so a device
+    with a clock running ahead cannot expire the others. Past ``max_devices`` the device
+    that got through least recently is forgotten too, and its next reading passes.
+
+    State is per process. With MQTT_SHARED_GROUP every replica sees only part of the
+    readings of a device and compares with its own last forwarded value, so which
+    readings inside the deadband are dropped depends on how the broker spread them.
+
+    Not locked: the pipeline hands every device to a single worker, splitting batches
+    that mix devices of several workers.
+    """
+
+    def __init__(self, deadband=0, heartbeat=60.0, max_devices=0):
+        self.deadband = deadband
+        self.heartbeat_ns = int(heartbeat * 1e9)
+        self.max_devices = max_devices
+        self.evicted = 0
+        # device_id -> (free_spots, total_capacity, timestamp), least recently forwarded first
+        self._last = OrderedDict()
+
+    def accept(self, data):
+        device_id = data.get("device_id")
+        free_spots = int(data.get("free_spots"))
+        capacity = data.get("total_capacity")
+        timestamp = data.get("timestamp")
+        if timestamp is None:
+            timestamp = time.time_ns()
+        self._expire(min(timestamp, time.time_ns()) - self.heartbeat_ns)
+        last = self._last.get(device_id)
+        if last is not None:
+            last_free, last_capacity, last_timestamp = last
+            if (abs(free_spots - last_free) <= self.deadband
+                    and (free_spots == 0) == (last_free == 0)
+                    and capacity == last_capacity
+                    and timestamp - last_timestamp < self.heartbeat_ns):
+                return False
+            self._last.move_to_end(device_id)
+        elif self.max_devices and len(self._last) >= self.max_devices:
+            self._last.popitem(last=False)
+            self.evicted += 1
+        self._last[device_id] = (free_spots, capacity, timestamp)
+        return True
+
+    def _expire(self, cutoff):
+        last = self._last
+        # Least recently forwarded first, so this stops at the first live device
+        while last:
+            device_id, state = next(iter(last.items()))
+            if state[2] > cutoff:
+                break
+            del last[device_id]
+            self.evicted += 1
+
+    def devices(self):
+        return len(self._last)
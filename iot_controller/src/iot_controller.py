@@ -1,68 +1,297 @@
 import paho.mqtt.client as mqtt
-from influxdb_client import InfluxDBClient, Point, WritePrecision
+from influxdb_client import BucketRetentionRules, InfluxDBClient, Point, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
 import json
 import logging
 import time
 import os
+import signal
+import socket
+import zlib
+import multiprocessing
+import redis
+from iot_common.influx_writer import BatchingWriter
+from redis_state import LastValueWriter
+from change_filter import ChangeFilter
+from rollup import RollupAggregator
+from pipeline import ShardedPipeline, MODE_PROCESS
+from iot_common.codec import decode_readings, encode_readings, to_reading
+from iot_common.log_setup import configure_logging
+from iot_common.metrics import (MESSAGES_RECEIVED, MESSAGES_PUBLISHED, READINGS_RECEIVED, READINGS_PUBLISHED,
+                                DECODE_SECONDS, VALIDATE_SECONDS, WRITE_SECONDS, DROPPED_DECODE_ERROR,
+                                DROPPED_INVALID, READINGS_SUPPRESSED, ROLLUP_SECONDS, ROLLUP_OPEN_WINDOWS,
+                                QUEUE_DEPTH, start_metrics_server)
 
-logging.basicConfig(level=logging.INFO)
+# Only when run as the service: tests and the benchmark keep their own logging setup
+if __name__ == '__main__':
+    configure_logging()
 logger = logging.getLogger(__name__)
 
 MQTT_HOST = os.getenv('MQTT_HOST', 'mosquitto')
 MQTT_PORT = 1883
 MQTT_TOPIC = 'iot_topic'
+RULE_ENGINE_TOPIC = 'rule_engine_topic'
+
+# Horizontal scaling: replicas in the same shared-subscription group split iot_topic
+# between them (MQTT v5 $share). Empty group keeps a plain subscription.
+MQTT_SHARED_GROUP = os.getenv('MQTT_SHARED_GROUP', '')
+MQTT_CLIENT_ID = os.getenv('MQTT_CLIENT_ID', f"iot-controller-{socket.gethostname()}-{os.getpid()}")
+# With N > 0 partitions readings go to rule_engine_topic/<crc32(device_id) % N>,
+# so every device always reaches the rule engine instance that holds its state
+RULE_ENGINE_PARTITIONS = int(os.getenv('RULE_ENGINE_PARTITIONS', '0'))
+# Payload format for batches forwarded to the rule engine: json | msgpack | struct
+# (single readings are always forwarded as a plain JSON object)
+RULE_ENGINE_FORMAT = os.getenv('RULE_ENGINE_FORMAT', 'json')
 
 # InfluxDB connection from environment variables
 INFLUXDB_URL = os.getenv('INFLUXDB_URL', 'http://influxdb:8086')
 INFLUXDB_TOKEN = os.getenv('INFLUXDB_TOKEN', 'super-secret-token')
 INFLUXDB_ORG = os.getenv('INFLUXDB_ORG', 'iot_org')
 
+# Batched writes: points are queued here and written by a background thread
+INFLUX_BATCH_SIZE = int(os.getenv('INFLUX_BATCH_SIZE', '500'))
+INFLUX_FLUSH_INTERVAL = float(os.getenv('INFLUX_FLUSH_INTERVAL', '1.0'))  # seconds
+INFLUX_QUEUE_SIZE = int(os.getenv('INFLUX_QUEUE_SIZE', '10000'))
+INFLUX_OVERFLOW_POLICY = os.getenv('INFLUX_OVERFLOW_POLICY', 'drop_oldest')  # drop_oldest | drop_newest | block
+# Failed writes are retried with exponential backoff, up to INFLUX_MAX_RETRIES times. With
+# INFLUX_SPILL_DIR set, points that do not fit in the queue (or ran out of retries) go to
+# write-ahead files there (instead of the overflow policy) and are written back in order
+# when InfluxDB recovers.
+INFLUX_RETRY_INITIAL = float(os.getenv('INFLUX_RETRY_INITIAL', '0.5'))  # seconds
+INFLUX_RETRY_MAX = float(os.getenv('INFLUX_RETRY_MAX', '30'))  # seconds
+INFLUX_MAX_RETRIES = int(os.getenv('INFLUX_MAX_RETRIES', '10'))  # then spill (or drop) the batch, 0 - no limit
+INFLUX_SPILL_DIR = os.getenv('INFLUX_SPILL_DIR', '')
+INFLUX_SPILL_MAX_MB = int(os.getenv('INFLUX_SPILL_MAX_MB', '1024'))
+
+# Write-through of the current device state to Redis for ParkingApi; empty host disables it
+REDIS_HOST = os.getenv('REDIS_HOST', '')
+REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+REDIS_PASSWORD = os.getenv('REDIS_PASSWORD') or None
+REDIS_DB = int(os.getenv('REDIS_DB', '0'))
+REDIS_POOL_SIZE = int(os.getenv('REDIS_POOL_SIZE', '4'))
+REDIS_FLUSH_INTERVAL = float(os.getenv('REDIS_FLUSH_INTERVAL', '0.2'))  # seconds
+REDIS_STATE_TTL = int(os.getenv('REDIS_STATE_TTL', '0'))  # seconds, 0 keeps states of silent devices
+REDIS_KEY_PREFIX = os.getenv('REDIS_KEY_PREFIX', 'parking:state:')
+
+# Change-only forwarding: readings whose free_spots stayed within CHANGE_DEADBAND of the last
+# forwarded value are neither published nor stored, except one per device every
+# CHANGE_HEARTBEAT_SECONDS. A lot becoming full or free again always passes. Devices silent
+# for a heartbeat are forgotten, and past CHANGE_FILTER_MAX_DEVICES (0 = no limit) the least
+# recently forwarded one is. With MQTT_SHARED_GROUP each replica filters against its own
+# share of a device's readings, so deadband suppression differs from run to run.
+CHANGE_FILTER = os.getenv('CHANGE_FILTER', 'false').lower() == 'true'
+CHANGE_DEADBAND = int(os.getenv('CHANGE_DEADBAND', '0'))
+CHANGE_HEARTBEAT_SECONDS = float(os.getenv('CHANGE_HEARTBEAT_SECONDS', '60'))
+CHANGE_FILTER_MAX_DEVICES = int(os.getenv('CHANGE_FILTER_MAX_DEVICES', '100000'))
+
+# Streaming rollups: count, min, max, mean and last of free_spots per device in tumbling
+# windows of ROLLUP_WINDOWS seconds (comma-separated, empty disables), written to
+# ROLLUP_BUCKET as "parking_rollup" points when a window closes. They are computed
+# before the change filter, so they cover every valid reading. A window needs every
+# reading of its device in one process, so rollups stay off with MQTT_SHARED_GROUP.
+ROLLUP_WINDOWS = [int(seconds) for seconds in os.getenv('ROLLUP_WINDOWS', '').split(',') if seconds.strip()]
+ROLLUP_BUCKET = os.getenv('ROLLUP_BUCKET', 'iot_rollup')
+ROLLUP_GRACE_SECONDS = float(os.getenv('ROLLUP_GRACE_SECONDS', '10'))
+ROLLUP_RETENTION_DAYS = int(os.getenv('ROLLUP_RETENTION_DAYS', '0'))  # for a bucket created on startup, 0 - forever
+
+# Pipeline mode: the MQTT thread only enqueues payloads, workers do the rest.
+# 0 workers keeps everything on the MQTT network thread.
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', '0'))
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'thread')  # thread | process
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '10000'))  # per worker
+
+# Prometheus /metrics port, 0 disables it. In process pipeline mode the decode,
+# validate and write metrics and the writer, Redis and rollup gauges stay in the
+# worker processes and are not exported; the parent only reports what it receives
+# and the pipeline queue depth.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9101'))
+
+def create_write_api(client, spill_dir=INFLUX_SPILL_DIR):
+    return BatchingWriter(
+        client.write_api(write_options=SYNCHRONOUS),
+        batch_size=INFLUX_BATCH_SIZE,
+        flush_interval=INFLUX_FLUSH_INTERVAL,
+        max_queue_size=INFLUX_QUEUE_SIZE,
+        overflow_policy=INFLUX_OVERFLOW_POLICY,
+        retry_initial=INFLUX_RETRY_INITIAL,
+        retry_max=INFLUX_RETRY_MAX,
+        max_retries=INFLUX_MAX_RETRIES,
+        spill_dir=spill_dir or None,
+        spill_max_bytes=INFLUX_SPILL_MAX_MB * 1024 * 1024,
+    )
+
+def create_state_writer():
+    if not REDIS_HOST:
+        return None
+    pool = redis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD, db=REDIS_DB,
+                                max_connections=REDIS_POOL_SIZE, socket_timeout=5, health_check_interval=30)
+    return LastValueWriter(redis.Redis(connection_pool=pool), flush_interval=REDIS_FLUSH_INTERVAL,
+                           key_prefix=REDIS_KEY_PREFIX, ttl=REDIS_STATE_TTL)
+
+def create_rollups():
+    if not ROLLUP_WINDOWS:
+        return None
+    if MQTT_SHARED_GROUP:
+        # Every replica would store its own partial window under the same point
+        logger.warning(f"ROLLUP_WINDOWS ignored: MQTT_SHARED_GROUP={MQTT_SHARED_GROUP} spreads "
+                       "the readings of one device over several controllers")
+        return None
+    return RollupAggregator(ROLLUP_WINDOWS, grace=ROLLUP_GRACE_SECONDS)
+
+def ensure_bucket(name, retention_days=0):
+    """Create an InfluxDB bucket unless it exists; the init setup only creates iot_bucket."""
+    try:
+        buckets_api = influx_client.buckets_api()
+        if buckets_api.find_bucket_by_name(name) is not None:
+            return
+        retention_rules = []
+        if retention_days > 0:
+            retention_rules.append(BucketRetentionRules(type="expire", every_seconds=retention_days * 86400))
+        buckets_api.create_bucket(bucket_name=name, retention_rules=retention_rules, org=INFLUXDB_ORG)
+        logger.info(f"Created InfluxDB bucket {name}")
+    except Exception as e:
+        logger.error(f"Error creating InfluxDB bucket {name}: {e}")
+
 influx_client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
 query_api = influx_client.query_api()
-write_api = influx_client.write_api(write_options=SYNCHRONOUS)
+write_api = create_write_api(influx_client)
+state_writer = create_state_writer()
+change_filter = (ChangeFilter(CHANGE_DEADBAND, CHANGE_HEARTBEAT_SECONDS, CHANGE_FILTER_MAX_DEVICES)
+                 if CHANGE_FILTER else None)
+rollups = create_rollups()
+pipeline = None
 
 def on_message(client, userdata, message):
+    MESSAGES_RECEIVED.inc()
+    if pipeline is not None:
+        pipeline.submit(message.payload)
+        return
+    process_payload(client, message.payload)
+
+def process_payload(client, payload):
+    started = time.perf_counter()
+    try:
+        readings, batched = decode_readings(payload)
+    except Exception as e:
+        DROPPED_DECODE_ERROR.inc()
+        logger.error("Error processing message: %s", e)
+        return
+    decoded = time.perf_counter()
+    DECODE_SECONDS.observe(decoded - started)
+    READINGS_RECEIVED.inc(len(readings))
     try:
-        data = json.loads(message.payload.decode())
-        device_id = data.get("device_id")
-        free_spots = data.get("free_spots")
-        timestamp = data.get("timestamp")
-        
-        if validate_data(data):
-            data_rule = {
-                "device_id": device_id,
-                "free_spots": free_spots,
-            }
-            payload_rule = json.dumps(data_rule)
-            client.publish("rule_engine_topic", payload_rule)
-            # Save to InfluxDB
-            point = Point("parking_data") \
-                .tag("device_id", device_id) \
-                .field("free_spots", free_spots) \
-                .time(timestamp, WritePrecision.NS)
+        valid = []
+        for data in readings:
             try:
-                write_api.write(bucket="iot_bucket", record=point)
-                logger.info(f"Data written to InfluxDB: {data}")
-            except Exception as e:
-                logger.error(f"Error writing data to InfluxDB: {e}")
+                valid.append(to_reading(data))
+            except ValueError as e:
+                # One broken reading must not drop the rest of the batch
+                logger.error("Invalid data: %s", e)
+        VALIDATE_SECONDS.observe(time.perf_counter() - decoded)
+        if len(valid) < len(readings):
+            DROPPED_INVALID.inc(len(readings) - len(valid))
+        if rollups is not None and valid:
+            rolled_up = time.perf_counter()
+            write_rollups(rollups.add(valid))
+            ROLLUP_SECONDS.observe(time.perf_counter() - rolled_up)
+        if change_filter is not None and valid:
+            changed = [data for data in valid if change_filter.accept(data)]
+            if len(changed) < len(valid):
+                READINGS_SUPPRESSED.inc(len(valid) - len(changed))
+            valid = changed
+        if not valid:
+            return
+        forward_readings(client, valid, batched)
+        if state_writer is not None:
+            state_writer.update(valid)
+        forwarded = time.perf_counter()
+        # Save to InfluxDB: a batch goes to the writer as one list
+        points = [
+            Point("parking_data")
+            .tag("device_id", reading.device_id)
+            .field("free_spots", reading.free_spots)
+            .time(reading.timestamp, WritePrecision.NS)
+            for reading in valid
+        ]
+        try:
+            write_api.write(bucket="iot_bucket", record=points if batched else points[0])
+            WRITE_SECONDS.observe(time.perf_counter() - forwarded)
+            if batched:
+                logger.debug("Batch of %d readings queued for InfluxDB", len(points))
+            else:
+                logger.debug("Data queued for InfluxDB: %s", valid[0])
+        except Exception as e:
+            logger.error("Error queueing data for InfluxDB: %s", e)
     except Exception as e:
-        logger.error(f"Error processing message: {e}")
-    
-def validate_data(data):
-    free_spots = int(data.get("free_spots", -1))
-    if free_spots < 0:
-        logger.error(f"Invalid data: free_spots={free_spots} (must be >= 0)")
-    return free_spots >= 0
+        logger.error("Error processing message: %s", e)
+
+def write_rollups(closed):
+    if not closed:
+        return
+    points = [
+        Point("parking_rollup")
+        .tag("device_id", window.device_id)
+        .tag("window", window.window)
+        .field("count", window.count)
+        .field("min", window.min)
+        .field("max", window.max)
+        .field("mean", window.mean)
+        .field("last", window.last)
+        .time(window.start, WritePrecision.NS)
+        for window in closed
+    ]
+    try:
+        write_api.write(bucket=ROLLUP_BUCKET, record=points)
+    except Exception as e:
+        logger.error(f"Error queueing rollups for InfluxDB: {e}")
+
+def rule_engine_data(reading):
+    data_rule = {
+        "device_id": reading.device_id,
+        "free_spots": reading.free_spots,
+    }
+    # Occupancy rules in the rule engine need the lot size
+    if reading.total_capacity is not None:
+        data_rule["total_capacity"] = reading.total_capacity
+    return data_rule
+
+def forward_readings(client, readings, batched):
+    if not batched:
+        reading = readings[0]
+        client.publish(rule_engine_topic_for(reading.device_id), json.dumps(rule_engine_data(reading)))
+        MESSAGES_PUBLISHED.inc()
+        READINGS_PUBLISHED.inc()
+        return
+    # One message per rule engine topic (several with partitioning)
+    by_topic = {}
+    for reading in readings:
+        by_topic.setdefault(rule_engine_topic_for(reading.device_id), []).append(rule_engine_data(reading))
+    for topic, group in by_topic.items():
+        client.publish(topic, encode_readings(group, RULE_ENGINE_FORMAT))
+        MESSAGES_PUBLISHED.inc()
+        READINGS_PUBLISHED.inc(len(group))
+
+def partition_for(device_id, partitions):
+    return zlib.crc32(str(device_id).encode()) % partitions
 
-def on_connect(client, userdata, flags, rc):
+def rule_engine_topic_for(device_id):
+    if RULE_ENGINE_PARTITIONS > 0:
+        return f"{RULE_ENGINE_TOPIC}/{partition_for(device_id, RULE_ENGINE_PARTITIONS)}"
+    return RULE_ENGINE_TOPIC
+
+def subscription_topic():
+    if MQTT_SHARED_GROUP:
+        return f"$share/{MQTT_SHARED_GROUP}/{MQTT_TOPIC}"
+    return MQTT_TOPIC
+
+def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
         logger.info("Connected to MQTT Broker!")
-        client.subscribe(MQTT_TOPIC)
+        client.subscribe(subscription_topic())
     else:
         logger.error(f"Failed to connect, return code {rc}")
 
-def on_disconnect(client, userdata, rc):
+def on_disconnect(client, userdata, rc, properties=None):
     logger.warning(f"Disconnected from MQTT Broker. Reason: {rc}")
     while True:
         try:
@@ -73,9 +302,14 @@ def on_disconnect(client, userdata, rc):
             logger.error(f"Reconnection failed: {e}")
             time.sleep(5)
 
+def create_mqtt_client(client_id=MQTT_CLIENT_ID):
+    # Shared subscriptions are an MQTT v5 feature
+    protocol = mqtt.MQTTv5 if MQTT_SHARED_GROUP else mqtt.MQTTv311
+    return mqtt.Client(client_id=client_id, protocol=protocol)
+
 def setup_mqtt(client=None):
     if client is None:
-        client = mqtt.Client()
+        client = create_mqtt_client()
     client.on_message = on_message
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
@@ -88,17 +322,89 @@ def setup_mqtt(client=None):
         logger.error(f"Error connecting to MQTT broker: {e}")
         return None
 
-    client.subscribe(MQTT_TOPIC)
+    client.subscribe(subscription_topic())
     
     return client
 
+def process_worker_init():
+    """Runs inside every pipeline worker process: connections are not shared across fork."""
+    global influx_client, write_api, state_writer, rollups
+    influx_client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
+    # Every worker spills to its own directory, named after the worker so that a restart replays it
+    spill_dir = os.path.join(INFLUX_SPILL_DIR, multiprocessing.current_process().name) if INFLUX_SPILL_DIR else ''
+    write_api = create_write_api(influx_client, spill_dir)
+    state_writer = create_state_writer()
+    # Devices are sharded by worker, so every worker rolls up its own devices
+    rollups = create_rollups()
+    worker_client = create_mqtt_client(f"{MQTT_CLIENT_ID}-worker-{os.getpid()}")
+    worker_client.connect(MQTT_HOST, MQTT_PORT)
+    worker_client.loop_start()
+
+    def cleanup():
+        if rollups is not None:
+            write_rollups(rollups.close())
+        write_api.close()
+        if state_writer is not None:
+            state_writer.close()
+        influx_client.close()
+        worker_client.loop_stop()
+        worker_client.disconnect()
+
+    return (lambda payload: process_payload(worker_client, payload)), cleanup
+
+def start_pipeline(client):
+    if PIPELINE_MODE == MODE_PROCESS:
+        return ShardedPipeline(PIPELINE_WORKERS, mode=MODE_PROCESS, queue_size=PIPELINE_QUEUE_SIZE,
+                               worker_init=process_worker_init).start()
+    return ShardedPipeline(PIPELINE_WORKERS, mode=PIPELINE_MODE, queue_size=PIPELINE_QUEUE_SIZE,
+                           handler=lambda payload: process_payload(client, payload)).start()
+
+def register_gauges():
+    QUEUE_DEPTH.labels(queue='influx_writer').set_function(write_api.queue_size)
+    if state_writer is not None:
+        QUEUE_DEPTH.labels(queue='redis_state').set_function(state_writer.pending_size)
+    if rollups is not None:
+        ROLLUP_OPEN_WINDOWS.set_function(rollups.open_windows)
+
+def shutdown(client):
+    client.on_disconnect = None
+    client.disconnect()
+
 def main():
+    global pipeline
     client = setup_mqtt()
     if not client:
         logger.error("Exiting: Unable to connect to MQTT broker.")
         return
 
-    client.loop_forever()
+    if PIPELINE_WORKERS > 0:
+        pipeline = start_pipeline(client)
+        QUEUE_DEPTH.labels(queue='pipeline').set_function(pipeline.pending)
+    if rollups is not None:
+        ensure_bucket(ROLLUP_BUCKET, ROLLUP_RETENTION_DAYS)
+    if pipeline is None or pipeline.mode != MODE_PROCESS:
+        # Process workers own their writer, Redis state and rollups; the parent's stay
+        # empty and would only ever report zero
+        register_gauges()
+    start_metrics_server(METRICS_PORT)
+
+    # docker stop sends SIGTERM: leave the MQTT loop and flush pending points
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutdown(client))
+    try:
+        client.loop_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pipeline is not None:
+            # Drain queued payloads so their points are in the writer before the final flush
+            pipeline.close()
+        if rollups is not None:
+            # Partial windows: a restart inside a window rewrites them with the later part only
+            write_rollups(rollups.close())
+        write_api.close()
+        if state_writer is not None:
+            state_writer.close()
+        influx_client.close()
 
 if __name__ == '__main__':
     main()
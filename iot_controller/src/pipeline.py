@@ -0,0 +1,198 @@
+"""Fan-out of raw MQTT payloads to sharded workers.
+
+The MQTT network thread only puts raw payloads on a bounded inbox. A single router
+thread takes them in arrival order and hands them to the workers (``split_by_shard``).
+
+Ordering guarantee: every device is owned by exactly one worker, and its readings are
+handled in the order they arrived. Batches holding devices of several shards are split
+per shard by the router, so per-device state in the workers (ChangeFilter, rollups)
+never sees a device from two threads. Readings of different devices in one batch may be
+handled out of order relative to each other.
+"""
+import json
+import logging
+import multiprocessing
+import queue
+import re
+import threading
+import zlib
+from iot_common.codec import (STRUCT_MAGIC, STRUCT_HEADER, STRUCT_RECORD, STRUCT_VERSION, decode_readings,
+                              encode_readings)
+
+logger = logging.getLogger(__name__)
+
+MODE_THREAD = 'thread'
+MODE_PROCESS = 'process'
+
+# Pulls the device id (a JSON string literal or a bare value) out of a raw JSON payload
+# without decoding the whole message
+DEVICE_ID_RE = re.compile(rb'"device_id"\s*:\s*("(?:[^"\\]|\\.)*"|[^,}\]\s]*)')
+
+_STOP = None
+
+
+def _shard(device_key, shards):
+    # device_key is str(device_id).encode() of the decoded id, whatever the payload format
+    return zlib.crc32(device_key) % shards
+
+
+def _device_key(raw):
+    """``str(device_id).encode()`` for the raw JSON value of a device id."""
+    if raw[:1] == b'"':
+        if b'\\' not in raw:
+            return raw[1:-1]
+    elif raw.isdigit():
+        return raw
+    try:
+        return str(json.loads(raw)).encode()
+    except ValueError:
+        return raw
+
+
+def split_by_shard(payload, shards):
+    """Route a raw payload: ``[(shard, payload), ...]``, one entry per shard it touches.
+
+    A single reading, or a batch whose devices all share a shard, is passed on as is.
+    A mixed batch is re-encoded as one JSON batch per shard, keeping the reading order.
+    Payloads that cannot be read go to shard 0 untouched, where the worker reports them.
+    """
+    if shards == 1:
+        return [(0, payload)]
+    if payload[:2] == STRUCT_MAGIC:
+        return _split_struct(payload, shards)
+    first = payload[:1]
+    if first == b'{' or first == b'[' or first.isspace():
+        targets = {_shard(_device_key(match.group(1)), shards) for match in DEVICE_ID_RE.finditer(payload)}
+        if len(targets) <= 1:
+            return [(targets.pop() if targets else 0, payload)]
+    # Mixed JSON batch, or msgpack whose ids cannot be found without decoding
+    try:
+        readings, _ = decode_readings(payload)
+    except Exception:
+        return [(0, payload)]
+    groups = {}
+    for reading in readings:
+        device_id = reading.get("device_id") if isinstance(reading, dict) else None
+        groups.setdefault(_shard(str(device_id).encode(), shards), []).append(reading)
+    if len(groups) <= 1:
+        return [(next(iter(groups), 0), payload)]
+    try:
+        return [(shard, encode_readings(group)) for shard, group in groups.items()]
+    except (TypeError, ValueError):
+        # Not representable in JSON: the worker rejects it anyway
+        return [(0, payload)]
+
+
+def _split_struct(payload, shards):
+    if len(payload) < STRUCT_HEADER.size:
+        return [(0, payload)]
+    _, version, count = STRUCT_HEADER.unpack_from(payload)
+    if version != STRUCT_VERSION or len(payload) != STRUCT_HEADER.size + count * STRUCT_RECORD.size:
+        return [(0, payload)]
+    groups = {}
+    offset = STRUCT_HEADER.size
+    for (device_id, *_) in STRUCT_RECORD.iter_unpack(memoryview(payload)[offset:]):
+        groups.setdefault(_shard(str(device_id).encode(), shards), []).append(offset)
+        offset += STRUCT_RECORD.size
+    if len(groups) <= 1:
+        return [(next(iter(groups), 0), payload)]
+    return [(shard, STRUCT_HEADER.pack(STRUCT_MAGIC, STRUCT_VERSION, len(offsets))
+             + b''.join(payload[start:start + STRUCT_RECORD.size] for start in offsets))
+            for shard, offsets in groups.items()]
+
+
+def _thread_worker(shard_queue, handler):
+    while True:
+        payload = shard_queue.get()
+        if payload is _STOP:
+            return
+        handler(payload)
+
+
+def _process_worker(shard_queue, worker_init):
+    handler, cleanup = worker_init()
+    try:
+        _thread_worker(shard_queue, handler)
+    finally:
+        cleanup()
+
+
+def _route(inbox, queues):
+    shards = len(queues)
+    while True:
+        payload = inbox.get()
+        if payload is _STOP:
+            return
+        for shard, part in split_by_shard(payload, shards):
+            queues[shard].put(part)
+
+
+class ShardedPipeline:
+    """Fans raw MQTT payloads out to a pool of worker threads or processes.
+
+    Every worker owns one bounded queue; payloads are routed by device_id (see
+    ``split_by_shard``), so readings of one device are handled in order by a single
+    worker. With several workers ``submit`` only enqueues the payload for the router
+    thread; it blocks when the queues are full, pushing back on the MQTT loop.
+
+    Thread workers call ``handler(payload)``. Process workers call
+    ``worker_init()`` once after start; it must return ``(handler, cleanup)``.
+    """
+
+    def __init__(self, workers, mode=MODE_THREAD, queue_size=10000, handler=None, worker_init=None):
+        if workers < 1:
+            raise ValueError("Pipeline needs at least one worker")
+        if mode not in (MODE_THREAD, MODE_PROCESS):
+            raise ValueError(f"Unknown pipeline mode: {mode}")
+        if mode == MODE_THREAD and handler is None:
+            raise ValueError("Thread pipeline needs a handler")
+        if mode == MODE_PROCESS and worker_init is None:
+            raise ValueError("Process pipeline needs a worker_init")
+        self.mode = mode
+        self.workers = []
+        self.queues = []
+        for i in range(workers):
+            if mode == MODE_THREAD:
+                shard_queue = queue.Queue(maxsize=queue_size)
+                worker = threading.Thread(target=_thread_worker, args=(shard_queue, handler),
+                                          name=f"pipeline-worker-{i}", daemon=True)
+            else:
+                shard_queue = multiprocessing.Queue(maxsize=queue_size)
+                worker = multiprocessing.Process(target=_process_worker, args=(shard_queue, worker_init),
+                                                 name=f"pipeline-worker-{i}", daemon=True)
+            self.queues.append(shard_queue)
+            self.workers.append(worker)
+        self.inbox = None
+        self.router = None
+        if workers > 1:
+            self.inbox = queue.Queue(maxsize=queue_size)
+            self.router = threading.Thread(target=_route, args=(self.inbox, self.queues),
+                                           name="pipeline-router", daemon=True)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        if self.router is not None:
+            self.router.start()
+        logger.info(f"Started {len(self.workers)} {self.mode} pipeline workers")
+        return self
+
+    def submit(self, payload):
+        (self.inbox or self.queues[0]).put(payload)
+
+    def pending(self):
+        """Payloads waiting in the inbox and the worker queues."""
+        waiting = sum(shard_queue.qsize() for shard_queue in self.queues)
+        return waiting + (self.inbox.qsize() if self.inbox is not None else 0)
+
+    def close(self, timeout=10):
+        """Let the workers drain their queues and stop them."""
+        if self.router is not None:
+            # Routed first: the stop markers must come after the last payload
+            self.inbox.put(_STOP)
+            self.router.join(timeout)
+        for shard_queue in self.queues:
+            shard_queue.put(_STOP)
+        for worker in self.workers:
+            worker.join(timeout)
+        logger.info("Pipeline workers stopped")
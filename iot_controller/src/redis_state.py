@@ -0,0 +1,150 @@
+import threading
+import time
+import logging
+from iot_common.metrics import (REDIS_DEVICES_WRITTEN, REDIS_FLUSH_SECONDS, REDIS_READINGS_COALESCED,
+                                REDIS_WRITE_ERRORS)
+
+logger = logging.getLogger(__name__)
+
+# Hash fields copied from a reading when present
+STATE_FIELDS = ("free_spots", "total_capacity", "occupied_spots")
+
+# Writes the hash only if it is not newer than the reading, so a late reading from another
+# controller replica (shared subscription) never overwrites fresher state.
+# KEYS: state hash, device index set. ARGV: timestamp, ttl, device_id, field, value, ...
+SET_IF_NEWER = """
+local current = redis.call('HGET', KEYS[1], 'timestamp')
+if current and tonumber(current) > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'device_id', ARGV[3], 'timestamp', ARGV[1], unpack(ARGV, 4))
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+redis.call('SADD', KEYS[2], ARGV[3])
+return 1
+"""
+
+
+class LastValueWriter:
+    """Keeps the current state of every device in Redis (write-through cache for ParkingApi).
+
+    ``update()`` only records the latest reading per device; a background thread writes
+    whatever changed once per ``flush_interval`` in one pipelined round trip. Several
+    readings of a device inside a window therefore cost a single write.
+
+    Layout: hash ``<key_prefix><device_id>`` with device_id, free_spots, total_capacity,
+    occupied_spots and timestamp (ns), plus the set ``<key_prefix>devices`` of device ids.
+    """
+
+    def __init__(self, redis_client, flush_interval=0.2, key_prefix='parking:state:', ttl=0):
+        self.redis = redis_client
+        self.flush_interval = flush_interval
+        self.key_prefix = key_prefix
+        self.index_key = f"{key_prefix}devices"
+        self.ttl = int(ttl)
+        self._script = redis_client.register_script(SET_IF_NEWER)
+
+        self._pending = {}  # device_id -> (timestamp, reading)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._closed = False
+
+        self.written = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def update(self, readings):
+        """Record the latest state of the devices in ``readings`` (validated reading dicts)."""
+        if self._thread is None:
+            self.start()
+        now = time.time_ns()
+        coalesced = 0
+        with self._lock:
+            pending = self._pending
+            for data in readings:
+                device_id = data.get("device_id")
+                timestamp = data.get("timestamp") or now
+                previous = pending.get(device_id)
+                if previous is not None:
+                    coalesced += 1
+                    if previous[0] > timestamp:
+                        continue
+                pending[device_id] = (timestamp, data)
+        if coalesced:
+            self.coalesced += coalesced
+            REDIS_READINGS_COALESCED.inc(coalesced)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="redis-state-writer", daemon=True)
+            self._thread.start()
+
+    def flush(self):
+        """Synchronously write the pending states."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            self._write(pending)
+
+    def close(self, timeout=10):
+        """Stop the background thread and write the remaining states."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wakeup.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+        logger.info(f"Redis state writer closed: written={self.written}, coalesced={self.coalesced}, "
+                    f"failed={self.failed}")
+
+    def pending_size(self):
+        return len(self._pending)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._closed:
+                    self._wakeup.wait(self.flush_interval)
+                if self._closed:
+                    return
+            self.flush()
+
+    def _args(self, device_id, timestamp, data):
+        args = [timestamp, self.ttl, device_id]
+        for field in STATE_FIELDS:
+            value = data.get(field)
+            if value is not None:
+                args += (field, value)
+        return args
+
+    def _write(self, pending):
+        started = time.perf_counter()
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for device_id, (timestamp, data) in pending.items():
+                self._script(keys=[f"{self.key_prefix}{device_id}", self.index_key],
+                             args=self._args(device_id, timestamp, data), client=pipe)
+            pipe.execute()
+        except Exception as e:
+            REDIS_WRITE_ERRORS.inc()
+            self.failed += len(pending)
+            logger.error(f"Error writing state of {len(pending)} devices to Redis: {e}")
+            self._requeue(pending)
+            return
+        REDIS_FLUSH_SECONDS.observe(time.perf_counter() - started)
+        REDIS_DEVICES_WRITTEN.inc(len(pending))
+        self.written += len(pending)
+
+    def _requeue(self, pending):
+        # Retried with the next flush unless a newer reading has arrived meanwhile
+        with self._lock:
+            if self._closed:
+                return
+            for device_id, entry in pending.items():
+                self._pending.setdefault(device_id, entry)
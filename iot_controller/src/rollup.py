@@ -0,0 +1,117 @@
+import threading
+import time
+from collections import namedtuple
+from iot_common.metrics import ROLLUP_LATE_READINGS, ROLLUP_WINDOWS_CLOSED
+
+# A finished tumbling window of one device; ``start`` is in ns, ``window`` a label like "1m"
+ClosedWindow = namedtuple('ClosedWindow', 'window device_id start count min max mean last')
+
+
+def window_label(seconds):
+    if seconds % 3600 == 0:
+        return f"{seconds // 3600}h"
+    if seconds % 60 == 0:
+        return f"{seconds // 60}m"
+    return f"{seconds}s"
+
+
+class RollupAggregator:
+    """Running count, min, max, mean and last of ``free_spots`` per device in tumbling windows.
+
+    Windows are aligned to the epoch and use reading time, so replayed or accelerated
+    data rolls up the same way as live traffic. A device's window closes when one of its
+    readings falls into a later window, or when the newest reading time seen so far (the
+    watermark) is ``grace`` seconds past the window end, which covers devices that went
+    silent. ``add()`` returns the windows it closed; only those are meant to be stored.
+
+    A closed window is never reopened: readings that fall into it, into an older window,
+    or into any window that ended more than ``grace`` before the watermark are counted in
+    ``late`` and skipped, so a stored rollup point is not overwritten by a partial one.
+    Readings more than ``grace`` ahead of the wall clock are aggregated but do not move
+    the watermark, so one device with a skewed clock cannot close everybody's windows.
+
+    Safe to share between pipeline threads.
+    """
+
+    def __init__(self, windows=(60, 3600), grace=10.0):
+        self.grace_ns = int(grace * 1e9)
+        # [size_ns, label, {device_id: [start, count, min, max, sum, last]}, next sweep watermark,
+        #  {device_id: start of the device's last closed window}]
+        self._windows = [[int(seconds) * 1_000_000_000, window_label(int(seconds)), {}, 0, {}]
+                         for seconds in windows]
+        self.watermark = 0
+        self.late = {window[1]: 0 for window in self._windows}
+        self._late_counters = {label: ROLLUP_LATE_READINGS.labels(window=label) for label in self.late}
+        self._closed_counters = {label: ROLLUP_WINDOWS_CLOSED.labels(window=label) for label in self.late}
+        self._lock = threading.Lock()
+
+    def add(self, readings):
+        now = time.time_ns()
+        horizon = now + self.grace_ns  # readings past it do not advance the watermark
+        closed = []
+        with self._lock:
+            watermark = self.watermark
+            for reading in readings:
+                timestamp = reading.timestamp
+                if timestamp is None:
+                    timestamp = now
+                if watermark < timestamp <= horizon:
+                    watermark = timestamp
+                device_id = reading.device_id
+                value = reading.free_spots
+                expired = watermark - self.grace_ns
+                for size, label, open_windows, _, closed_upto in self._windows:
+                    start = timestamp - timestamp % size
+                    state = open_windows.get(device_id)
+                    if state is not None and state[0] == start:
+                        state[1] += 1
+                        if value < state[2]:
+                            state[2] = value
+                        elif value > state[3]:
+                            state[3] = value
+                        state[4] += value
+                        state[5] = value
+                        continue
+                    if ((state is not None and start < state[0]) or start + size <= expired
+                            or start <= closed_upto.get(device_id, -1)):
+                        self.late[label] += 1
+                        self._late_counters[label].inc()
+                        continue
+                    if state is not None:
+                        closed.append(self._close(label, device_id, state))
+                        closed_upto[device_id] = state[0]
+                    open_windows[device_id] = [start, 1, value, value, value, value]
+            self.watermark = watermark
+            for window in self._windows:
+                if watermark >= window[3]:
+                    closed += self._sweep(window, watermark)
+        return closed
+
+    def close(self):
+        """Close and return every open window (on shutdown)."""
+        with self._lock:
+            closed = []
+            for _, label, open_windows, _, closed_upto in self._windows:
+                closed += [self._close(label, device_id, state) for device_id, state in open_windows.items()]
+                open_windows.clear()
+                closed_upto.clear()
+        return closed
+
+    def open_windows(self):
+        return sum(len(window[2]) for window in self._windows)
+
+    def _sweep(self, window, watermark):
+        size, label, open_windows, _, closed_upto = window
+        # A full pass over the devices at most once per 1/60 of the window
+        window[3] = watermark + max(size // 60, 1_000_000_000)
+        cutoff = watermark - self.grace_ns - size
+        # Windows up to the cutoff count as expired in add(), their markers are not needed
+        for device_id in [device_id for device_id, start in closed_upto.items() if start <= cutoff]:
+            del closed_upto[device_id]
+        expired = [device_id for device_id, state in open_windows.items() if state[0] <= cutoff]
+        return [self._close(label, device_id, open_windows.pop(device_id)) for device_id in expired]
+
+    def _close(self, label, device_id, state):
+        start, count, minimum, maximum, total, last = state
+        self._closed_counters[label].inc()
+        return ClosedWindow(label, device_id, start, count, minimum, maximum, total / count, last)
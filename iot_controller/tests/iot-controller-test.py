@@ -1,35 +1,22 @@
 import unittest
 from unittest import mock
-from iot_controller.iot_controller import validate_data, on_message, on_connect, on_disconnect, setup_mqtt, write_api, logger
+from iot_controller.iot_controller import on_message, on_connect, on_disconnect, setup_mqtt, write_api, logger
+from iot_controller.iot_controller import partition_for, main, create_rollups
+from redis_state import LastValueWriter
+from change_filter import ChangeFilter
+from rollup import RollupAggregator, ClosedWindow, window_label
+from iot_common.codec import decode_readings, encode_readings, to_reading
+from iot_common.log_setup import NonBlockingQueueHandler
+from prometheus_client import REGISTRY
 import time
-
-class TestValidateData(unittest.TestCase):
-    def test_valid_integer(self):
-        data = {"free_spots": 5}
-        self.assertTrue(validate_data(data))
-
-    def test_valid_string_integer(self):
-        data = {"free_spots": "5"}
-        self.assertTrue(validate_data(data))
-
-    def test_invalid_negative(self):
-        data = {"free_spots": -1}
-        self.assertFalse(validate_data(data))
-
-    def test_missing_free_spots(self):
-        data = {}
-        self.assertFalse(validate_data(data))
-
-    def test_invalid_string(self):
-        data = {"free_spots": "five"}
-        with self.assertRaises(ValueError):
-            validate_data(data)
+import json
+import logging
 
 class TestOnMessage(unittest.TestCase):
     @mock.patch('iot_controller.iot_controller.write_api')
     def test_valid_message(self, mock_write_api):
         message = mock.MagicMock()
-        message.payload.decode.return_value = '{"device_id": "dev1", "free_spots": 5, "timestamp": 1234567890}'
+        message.payload = b'{"device_id": "dev1", "free_spots": 5, "timestamp": 1234567890}'
         mock_client = mock.MagicMock()
         mock_client.publish = mock.MagicMock()
         
@@ -38,10 +25,19 @@ class TestOnMessage(unittest.TestCase):
         mock_client.publish.assert_called_once_with("rule_engine_topic", '{"device_id": "dev1", "free_spots": 5}')
         mock_write_api.write.assert_called_once_with(bucket="iot_bucket", record=mock.ANY)
 
+    @mock.patch('iot_controller.iot_controller.state_writer')
+    @mock.patch('iot_controller.iot_controller.write_api')
+    def test_valid_message_updates_state(self, mock_write_api, mock_state_writer):
+        message = mock.MagicMock()
+        message.payload = b'{"device_id": "dev1", "free_spots": 5, "timestamp": 1234567890}'
+        on_message(mock.MagicMock(), None, message)
+        mock_state_writer.update.assert_called_once_with(
+            [{"device_id": "dev1", "free_spots": 5, "timestamp": 1234567890}])
+
     @mock.patch('iot_controller.iot_controller.write_api')
     def test_invalid_message(self, mock_write_api):
         message = mock.MagicMock()
-        message.payload.decode.return_value = '{"device_id": "dev1", "free_spots": -1, "timestamp": 1234567890}'
+        message.payload = b'{"device_id": "dev1", "free_spots": -1, "timestamp": 1234567890}'
         mock_client = mock.MagicMock()
         with self.assertLogs(logger, level='ERROR') as cm:
             on_message(mock_client, None, message)
@@ -52,7 +48,7 @@ class TestOnMessage(unittest.TestCase):
     @mock.patch('iot_controller.iot_controller.write_api')
     def test_malformed_json(self, mock_write_api):
         message = mock.MagicMock()
-        message.payload.decode.return_value = 'invalid json'
+        message.payload = b'invalid json'
         mock_client = mock.MagicMock()
         with self.assertLogs(logger, level='ERROR') as cm:
             on_message(mock_client, None, message)
@@ -61,6 +57,86 @@ class TestOnMessage(unittest.TestCase):
         mock_client.publish.assert_not_called()
         mock_write_api.write.assert_not_called()
 
+    @mock.patch('iot_controller.iot_controller.write_api')
+    def test_batch_message(self, mock_write_api):
+        message = mock.MagicMock()
+        message.payload = encode_readings([
+            {"device_id": 1, "free_spots": 5, "total_capacity": 50, "timestamp": 1234567890},
+            {"device_id": 2, "free_spots": -1, "timestamp": 1234567890},
+            {"device_id": 3, "free_spots": 7, "timestamp": 1234567890},
+        ])
+        mock_client = mock.MagicMock()
+        with self.assertLogs(logger, level='ERROR'):
+            on_message(mock_client, None, message)
+        # The valid part of the batch is forwarded as one message and written in one call
+        mock_client.publish.assert_called_once()
+        topic, payload = mock_client.publish.call_args.args
+        self.assertEqual(topic, "rule_engine_topic")
+        self.assertEqual(decode_readings(payload), ([
+            {"device_id": 1, "free_spots": 5, "total_capacity": 50},
+            {"device_id": 3, "free_spots": 7},
+        ], True))
+        mock_write_api.write.assert_called_once()
+        self.assertEqual(len(mock_write_api.write.call_args.kwargs["record"]), 2)
+
+    @mock.patch('iot_controller.iot_controller.write_api')
+    def test_struct_batch_message(self, mock_write_api):
+        message = mock.MagicMock()
+        message.payload = encode_readings([{"device_id": 1, "free_spots": 5}, {"device_id": 2, "free_spots": 0}],
+                                          fmt='struct')
+        mock_client = mock.MagicMock()
+        on_message(mock_client, None, message)
+        mock_client.publish.assert_called_once()
+        self.assertEqual(len(mock_write_api.write.call_args.kwargs["record"]), 2)
+
+    @mock.patch('iot_controller.iot_controller.process_payload')
+    @mock.patch('iot_controller.iot_controller.pipeline')
+    def test_pipeline_mode_only_enqueues(self, mock_pipeline, mock_process_payload):
+        message = mock.MagicMock()
+        message.payload = b'{"device_id": "dev1", "free_spots": 5, "timestamp": 1234567890}'
+        on_message(mock.MagicMock(), None, message)
+        mock_pipeline.submit.assert_called_once_with(message.payload)
+        mock_process_payload.assert_not_called()
+
+class TestScaling(unittest.TestCase):
+    @mock.patch('iot_controller.iot_controller.MQTT_SHARED_GROUP', 'controllers')
+    def test_shared_subscription_topic(self):
+        mock_client = mock.MagicMock()
+        on_connect(mock_client, None, None, 0, None)
+        mock_client.subscribe.assert_called_once_with('$share/controllers/iot_topic')
+
+    @mock.patch('iot_controller.iot_controller.RULE_ENGINE_PARTITIONS', 8)
+    @mock.patch('iot_controller.iot_controller.write_api')
+    def test_partitioned_rule_engine_topic(self, mock_write_api):
+        message = mock.MagicMock()
+        message.payload = b'{"device_id": "dev1", "free_spots": 5, "timestamp": 1234567890}'
+        mock_client = mock.MagicMock()
+        on_message(mock_client, None, message)
+        expected = f"rule_engine_topic/{partition_for('dev1', 8)}"
+        mock_client.publish.assert_called_once_with(expected, mock.ANY)
+        self.assertEqual(partition_for(42, 8), partition_for("42", 8))
+
+    def run_main(self, workers, mode):
+        with mock.patch.multiple('iot_controller.iot_controller', PIPELINE_WORKERS=workers, PIPELINE_MODE=mode,
+                                 pipeline=None, state_writer=None, rollups=None, setup_mqtt=mock.DEFAULT,
+                                 start_pipeline=mock.DEFAULT, register_gauges=mock.DEFAULT,
+                                 start_metrics_server=mock.DEFAULT, write_api=mock.DEFAULT,
+                                 influx_client=mock.DEFAULT) as mocks, \
+                mock.patch('signal.signal'):
+            mocks['start_pipeline'].return_value.mode = mode
+            main()
+        return mocks
+
+    def test_process_mode_does_not_export_parent_gauges(self):
+        mocks = self.run_main(2, 'process')
+        mocks['register_gauges'].assert_not_called()
+        mocks['start_metrics_server'].assert_called_once()
+        mocks['start_pipeline'].return_value.close.assert_called_once()
+
+    def test_thread_mode_exports_gauges(self):
+        for workers, mode in ((0, 'thread'), (2, 'thread')):
+            self.run_main(workers, mode)['register_gauges'].assert_called_once_with()
+
 class TestOnConnect(unittest.TestCase):
     def test_successful_connection(self):
         mock_client = mock.MagicMock()
@@ -115,5 +191,238 @@ class TestSetupMQTT(unittest.TestCase):
         self.assertIsNone(result)
         self.assertTrue(any("Error connecting to MQTT broker" in msg for msg in cm.output))
 
+class TestChangeFilter(unittest.TestCase):
+    def reading(self, free_spots, seconds, device_id=1, total_capacity=10):
+        return {"device_id": device_id, "free_spots": free_spots, "total_capacity": total_capacity,
+                "timestamp": int(seconds * 1e9)}
+
+    def test_repeats_are_suppressed_until_heartbeat(self):
+        change_filter = ChangeFilter(heartbeat=60)
+        passed = [change_filter.accept(self.reading(5, t)) for t in (0, 10, 20, 60, 70)]
+        self.assertEqual(passed, [True, False, False, True, False])
+
+    def test_every_change_passes_without_deadband(self):
+        change_filter = ChangeFilter()
+        passed = [change_filter.accept(self.reading(free, t)) for t, free in enumerate((5, 6, 6, 5))]
+        self.assertEqual(passed, [True, True, False, True])
+
+    def test_deadband_compares_with_last_forwarded_value(self):
+        change_filter = ChangeFilter(deadband=2)
+        passed = [change_filter.accept(self.reading(free, t)) for t, free in enumerate((5, 6, 7, 8, 8))]
+        self.assertEqual(passed, [True, False, False, True, False])
+
+    def test_lot_becoming_full_always_passes(self):
+        change_filter = ChangeFilter(deadband=5)
+        passed = [change_filter.accept(self.reading(free, t)) for t, free in enumerate((2, 0, 1))]
+        self.assertEqual(passed, [True, True, True])
+
+    def test_devices_are_independent(self):
+        change_filter = ChangeFilter()
+        self.assertTrue(change_filter.accept(self.reading(5, 0, device_id=1)))
+        self.assertTrue(change_filter.accept(self.reading(5, 0, device_id=2)))
+        self.assertEqual(change_filter.devices(), 2)
+
+    def test_devices_silent_for_a_heartbeat_are_forgotten(self):
+        change_filter = ChangeFilter(heartbeat=60)
+        change_filter.accept(self.reading(5, 0, device_id=1))
+        change_filter.accept(self.reading(5, 30, device_id=2))
+        self.assertFalse(change_filter.accept(self.reading(5, 59, device_id=2)))
+        self.assertEqual(change_filter.devices(), 2)
+        change_filter.accept(self.reading(5, 61, device_id=3))
+        self.assertEqual((change_filter.devices(), change_filter.evicted), (2, 1))
+
+    def test_future_reading_does_not_expire_other_devices(self):
+        now = time.time()
+        change_filter = ChangeFilter(heartbeat=60)
+        change_filter.accept(self.reading(5, now, device_id=1))
+        change_filter.accept(self.reading(5, now + 3600, device_id=2))
+        self.assertFalse(change_filter.accept(self.reading(5, now + 1, device_id=1)))
+
+    def test_least_recently_forwarded_device_makes_room(self):
+        change_filter = ChangeFilter(max_devices=2)
+        for device_id, free, seconds in ((1, 5, 0), (2, 5, 1), (1, 6, 2)):
+            self.assertTrue(change_filter.accept(self.reading(free, seconds, device_id=device_id)))
+        self.assertTrue(change_filter.accept(self.reading(5, 3, device_id=3)))
+        self.assertEqual((change_filter.devices(), change_filter.evicted), (2, 1))
+        self.assertFalse(change_filter.accept(self.reading(6, 4, device_id=1)))
+        self.assertTrue(change_filter.accept(self.reading(5, 5, device_id=2)))
+
+    @mock.patch('iot_controller.iot_controller.change_filter', new_callable=ChangeFilter)
+    @mock.patch('iot_controller.iot_controller.write_api')
+    def test_unchanged_readings_are_not_forwarded(self, mock_write_api, _change_filter):
+        batch = [self.reading(5, 0), self.reading(5, 1), self.reading(4, 2)]
+        message = mock.MagicMock()
+        message.payload = encode_readings(batch)
+        mock_client = mock.MagicMock()
+        on_message(mock_client, None, message)
+        forwarded, _ = decode_readings(mock_client.publish.call_args[0][1])
+        self.assertEqual([data["free_spots"] for data in forwarded], [5, 4])
+        self.assertEqual(len(mock_write_api.write.call_args.kwargs["record"]), 2)
+
+class TestRollup(unittest.TestCase):
+    def reading(self, free_spots, seconds, device_id=1):
+        return to_reading({"device_id": device_id, "free_spots": free_spots, "timestamp": int(seconds * 1e9)})
+
+    def test_window_labels(self):
+        self.assertEqual([window_label(s) for s in (60, 3600, 90, 7200)], ["1m", "1h", "90s", "2h"])
+
+    def test_window_closes_on_next_window(self):
+        rollups = RollupAggregator(windows=(60,))
+        self.assertEqual(rollups.add([self.reading(v, t) for t, v in ((0, 5), (10, 2), (20, 9), (30, 4))]), [])
+        closed = rollups.add([self.reading(7, 61)])
+        self.assertEqual(closed, [ClosedWindow("1m", 1, 0, 4, 2, 9, 5.0, 4)])
+        self.assertEqual(rollups.open_windows(), 1)
+
+    def test_silent_device_closes_after_grace(self):
+        rollups = RollupAggregator(windows=(60,), grace=10)
+        rollups.add([self.reading(5, 0, device_id=1)])
+        self.assertEqual(rollups.add([self.reading(5, 65, device_id=2)]), [])
+        closed = rollups.add([self.reading(5, 71, device_id=2)])
+        self.assertEqual([(w.device_id, w.start, w.count) for w in closed], [(1, 0, 1)])
+
+    def test_late_readings_are_skipped(self):
+        rollups = RollupAggregator(windows=(60, 3600))
+        rollups.add([self.reading(5, 61)])
+        self.assertEqual(rollups.add([self.reading(1, 30)]), [])
+        self.assertEqual(rollups.late, {"1m": 1, "1h": 0})
+        hourly = [w for w in rollups.close() if w.window == "1h"]
+        self.assertEqual([(w.count, w.min) for w in hourly], [(2, 1)])
+        self.assertEqual(rollups.open_windows(), 0)
+
+    def test_closed_window_is_not_reopened(self):
+        rollups = RollupAggregator(windows=(60,), grace=10)
+        rollups.add([self.reading(5, 10), self.reading(6, 61)])
+        # Back in the window that was just closed
+        self.assertEqual(rollups.add([self.reading(1, 50)]), [])
+        self.assertEqual(rollups.late, {"1m": 1})
+        self.assertEqual([(w.start, w.count) for w in rollups.close()], [(60 * 10**9, 1)])
+
+    def test_swept_window_is_not_reopened(self):
+        rollups = RollupAggregator(windows=(60,), grace=10)
+        rollups.add([self.reading(5, 10, device_id=1)])
+        closed = rollups.add([self.reading(5, 75, device_id=2)])
+        self.assertEqual([(w.device_id, w.count) for w in closed], [(1, 1)])
+        self.assertEqual(rollups.add([self.reading(3, 50, device_id=1)]), [])
+        self.assertEqual(rollups.late, {"1m": 1})
+        self.assertEqual([w.device_id for w in rollups.close()], [2])
+
+    def test_future_reading_does_not_sweep_other_devices(self):
+        rollups = RollupAggregator(windows=(60,), grace=10)
+        now = time.time() // 60 * 60
+        rollups.add([self.reading(5, now, device_id=1)])
+        # A device whose clock is a day ahead
+        self.assertEqual(rollups.add([self.reading(5, now + 86400, device_id=2)]), [])
+        self.assertLess(rollups.watermark, (now + 60) * 1e9)
+        rollups.add([self.reading(4, now + 1, device_id=1)])
+        self.assertEqual(rollups.late, {"1m": 0})
+        self.assertEqual(sorted((w.device_id, w.count) for w in rollups.close()), [(1, 2), (2, 1)])
+
+    @mock.patch('iot_controller.iot_controller.ROLLUP_WINDOWS', [60])
+    def test_rollups_are_off_with_a_shared_subscription(self):
+        with mock.patch('iot_controller.iot_controller.MQTT_SHARED_GROUP', 'controllers'):
+            with self.assertLogs(logger, level='WARNING'):
+                self.assertIsNone(create_rollups())
+        self.assertIsInstance(create_rollups(), RollupAggregator)
+
+    @mock.patch('iot_controller.iot_controller.write_api')
+    def test_closed_windows_are_written(self, mock_write_api):
+        with mock.patch('iot_controller.iot_controller.rollups', RollupAggregator(windows=(60,))):
+            for t in (0, 30, 60):
+                message = mock.MagicMock()
+                message.payload = json.dumps({"device_id": "dev1", "free_spots": 3, "timestamp": t * 10**9}).encode()
+                on_message(mock.MagicMock(), None, message)
+        rollup_writes = [c for c in mock_write_api.write.call_args_list if c.kwargs["bucket"] == "iot_rollup"]
+        self.assertEqual(len(rollup_writes), 1)
+        point = rollup_writes[0].kwargs["record"][0]
+        self.assertEqual((point._name, point._tags, point._fields["count"]),
+                         ("parking_rollup", {"device_id": "dev1", "window": "1m"}, 2))
+
+class TestLastValueWriter(unittest.TestCase):
+    def setUp(self):
+        self.redis = mock.MagicMock()
+        self.script = self.redis.register_script.return_value
+        self.pipe = self.redis.pipeline.return_value
+        self.writer = LastValueWriter(self.redis, flush_interval=60)
+        self.addCleanup(self.writer.close)
+
+    def written(self):
+        return {call.kwargs["keys"][0]: call.kwargs["args"] for call in self.script.call_args_list}
+
+    def test_readings_coalesce_per_device(self):
+        self.writer.update([{"device_id": 1, "free_spots": 5, "total_capacity": 10, "timestamp": 100},
+                            {"device_id": 2, "free_spots": 7, "timestamp": 100}])
+        self.writer.update([{"device_id": 1, "free_spots": 4, "total_capacity": 10, "timestamp": 200}])
+        self.writer.flush()
+        self.redis.pipeline.assert_called_once_with(transaction=False)
+        self.pipe.execute.assert_called_once()
+        self.assertEqual(self.written(), {
+            "parking:state:1": [200, 0, 1, "free_spots", 4, "total_capacity", 10],
+            "parking:state:2": [100, 0, 2, "free_spots", 7],
+        })
+        self.assertEqual(self.writer.coalesced, 1)
+        self.assertEqual(self.writer.pending_size(), 0)
+
+    def test_older_reading_does_not_replace_pending_state(self):
+        self.writer.update([{"device_id": 1, "free_spots": 4, "timestamp": 200}])
+        self.writer.update([{"device_id": 1, "free_spots": 9, "timestamp": 100}])
+        self.writer.flush()
+        self.assertEqual(self.written()["parking:state:1"][:5], [200, 0, 1, "free_spots", 4])
+
+    def test_failed_flush_is_retried(self):
+        self.pipe.execute.side_effect = [Exception("redis down"), None]
+        self.writer.update([{"device_id": 1, "free_spots": 4, "timestamp": 200}])
+        with self.assertLogs('redis_state', level='ERROR'):
+            self.writer.flush()
+        self.assertEqual(self.writer.pending_size(), 1)
+        self.writer.flush()
+        self.assertEqual(self.writer.written, 1)
+
+class TestLogging(unittest.TestCase):
+    def test_import_leaves_logging_alone(self):
+        # The service configures logging in __main__ only
+        self.assertFalse(any(isinstance(handler, NonBlockingQueueHandler)
+                             for handler in logging.getLogger().handlers))
+
+class TestMetrics(unittest.TestCase):
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    @mock.patch('iot_controller.iot_controller.write_api')
+    def test_message_counters(self, mock_write_api):
+        before = {
+            "received": self.sample("mqtt_messages_received_total"),
+            "readings": self.sample("readings_received_total"),
+            "published": self.sample("readings_published_total"),
+            "invalid": self.sample("readings_dropped_total", reason="invalid"),
+            "decode": self.sample("stage_duration_seconds_count", stage="decode"),
+        }
+        message = mock.MagicMock()
+        message.payload = encode_readings([
+            {"device_id": 1, "free_spots": 5, "timestamp": 1234567890},
+            {"device_id": 2, "free_spots": -1, "timestamp": 1234567890},
+        ])
+        with self.assertLogs(logger, level='ERROR'):
+            on_message(mock.MagicMock(), None, message)
+        self.assertEqual(self.sample("mqtt_messages_received_total") - before["received"], 1)
+        self.assertEqual(self.sample("readings_received_total") - before["readings"], 2)
+        self.assertEqual(self.sample("readings_published_total") - before["published"], 1)
+        self.assertEqual(self.sample("readings_dropped_total", reason="invalid") - before["invalid"], 1)
+        self.assertEqual(self.sample("stage_duration_seconds_count", stage="decode") - before["decode"], 1)
+
+    @mock.patch('iot_controller.iot_controller.write_api')
+    def test_booleans_and_fractions_are_dropped_as_invalid(self, mock_write_api):
+        invalid = self.sample("readings_dropped_total", reason="invalid")
+        message = mock.MagicMock()
+        message.payload = encode_readings([
+            {"device_id": 1, "free_spots": True},
+            {"device_id": 2, "free_spots": 2.5},
+            {"device_id": 3, "free_spots": 4},
+        ])
+        with self.assertLogs(logger, level='ERROR'):
+            on_message(mock.MagicMock(), None, message)
+        self.assertEqual(self.sample("readings_dropped_total", reason="invalid") - invalid, 2)
+        points = mock_write_api.write.call_args.kwargs["record"]
+        self.assertEqual([point._tags["device_id"] for point in points], [3])
+
 if __name__ == '__main__':
     unittest.main()
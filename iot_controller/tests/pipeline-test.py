@@ -0,0 +1,118 @@
+import unittest
+from unittest import mock
+from pipeline import ShardedPipeline, split_by_shard
+from iot_common.codec import decode_readings, encode_readings
+import threading
+import json
+
+class TestPipeline(unittest.TestCase):
+    @staticmethod
+    def shard_of(payload, shards=8):
+        (shard, part), = split_by_shard(payload, shards)
+        assert part is payload
+        return shard
+
+    def test_same_device_same_shard(self):
+        first = self.shard_of(b'{"device_id": "dev42", "free_spots": 1}')
+        second = self.shard_of(b'{"free_spots": 7, "device_id": "dev42"}')
+        self.assertEqual(first, second)
+        self.assertEqual(self.shard_of(b'{"device_id": 42}'), self.shard_of(b'{"device_id":42,"x":1}'))
+        # A packed reading of device 42 goes where its JSON readings go
+        self.assertEqual(self.shard_of(encode_readings([{"device_id": 42, "free_spots": 1}], fmt='struct')),
+                         self.shard_of(b'{"device_id": 42}'))
+
+    def test_single_shard_batch_is_passed_on_as_is(self):
+        batch = encode_readings([{"device_id": 5, "free_spots": 1}, {"device_id": 5, "free_spots": 2}])
+        self.assertEqual(self.shard_of(batch), self.shard_of(b'{"device_id": 5}'))
+
+    def test_mixed_batches_are_split_per_shard(self):
+        readings = [{"device_id": device_id, "free_spots": seq} for seq in range(3) for device_id in range(20)]
+        for fmt in ('json', 'struct'):
+            parts = split_by_shard(encode_readings(readings, fmt=fmt), 4)
+            self.assertGreater(len(parts), 1)
+            self.assertEqual(len({shard for shard, _ in parts}), len(parts))
+            received = []
+            for shard, part in parts:
+                part_readings, batched = decode_readings(part)
+                self.assertTrue(batched)
+                for reading in part_readings:
+                    self.assertEqual(self.shard_of(encode_readings([reading], batched=False), 4), shard)
+                received += part_readings
+            self.assertEqual(sorted(received, key=lambda r: (r["device_id"], r["free_spots"])),
+                             sorted(readings, key=lambda r: (r["device_id"], r["free_spots"])))
+
+    def test_fast_and_slow_path_agree_on_ids(self):
+        for device_id in ("lot 1", 'a"b', "a\\b", "ü", 7, -3):
+            alone = self.shard_of(encode_readings([{"device_id": device_id, "free_spots": 1}], batched=False))
+            mixed = [{"device_id": other, "free_spots": 1} for other in range(8)] + [
+                {"device_id": device_id, "free_spots": 2}]
+            parts = split_by_shard(encode_readings(mixed), 8)
+            owner = [shard for shard, part in parts
+                     if {"device_id": device_id, "free_spots": 2} in decode_readings(part)[0]]
+            self.assertEqual(owner, [alone], device_id)
+
+    def test_unparseable_payload_goes_to_first_shard(self):
+        for payload in (b'invalid json', b'{"readings": [{"device_id": 1}, {"device_id": 2', b'PK\x01'):
+            self.assertEqual(split_by_shard(payload, 4), [(0, payload)])
+
+    def test_thread_workers_keep_per_device_order(self):
+        seen = {}
+        lock = threading.Lock()
+
+        def handler(payload):
+            data = json.loads(payload)
+            with lock:
+                seen.setdefault(data["device_id"], []).append(data["seq"])
+
+        pipe = ShardedPipeline(4, handler=handler).start()
+        for seq in range(50):
+            for device in ("a", "b", "c"):
+                pipe.submit(json.dumps({"device_id": device, "seq": seq}).encode())
+        pipe.close()
+        self.assertEqual(seen, {device: list(range(50)) for device in ("a", "b", "c")})
+
+    def test_mixed_batches_keep_each_device_on_one_worker(self):
+        workers = {}
+        seen = {}
+        lock = threading.Lock()
+
+        def handler(payload):
+            readings, _ = decode_readings(payload)
+            with lock:
+                for reading in readings:
+                    workers.setdefault(reading["device_id"], set()).add(threading.current_thread().name)
+                    seen.setdefault(reading["device_id"], []).append(reading["free_spots"])
+
+        devices = range(12)
+        pipe = ShardedPipeline(4, handler=handler).start()
+        for seq in range(30):
+            # Every batch starts with a different device and mixes all shards
+            order = list(devices)[seq % 12:] + list(devices)[:seq % 12]
+            pipe.submit(encode_readings([{"device_id": device_id, "free_spots": seq} for device_id in order],
+                                        fmt='struct' if seq % 2 else 'json'))
+        pipe.close()
+        self.assertEqual(seen, {device_id: list(range(30)) for device_id in devices})
+        self.assertTrue(all(len(names) == 1 for names in workers.values()), workers)
+        self.assertGreater(len(set.union(*workers.values())), 1)
+
+    def test_batches_are_split_off_the_submitting_thread(self):
+        threads = set()
+
+        def split(payload, shards):
+            threads.add(threading.current_thread().name)
+            return split_by_shard(payload, shards)
+
+        pipe = ShardedPipeline(2, handler=lambda payload: None)
+        with mock.patch('pipeline.split_by_shard', split):
+            pipe.start()
+            pipe.submit(encode_readings([{"device_id": device_id, "free_spots": 1} for device_id in range(4)]))
+            pipe.close()
+        self.assertEqual(threads, {"pipeline-router"})
+        self.assertEqual(pipe.pending(), 0)
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            ShardedPipeline(2, mode='fiber', handler=lambda payload: None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import logging
+import os
+import threading
+import time
+import msgpack
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+
+
+class Checkpointer:
+    """Snapshots the per-device rule state to a local file for warm restarts.
+
+    ``maybe_save()`` is called from the message loop, so a snapshot never sees a
+    half-evaluated reading, and it saves at most once per ``interval`` seconds. Only
+    copying the state arrays happens on that thread; encoding and writing the file run
+    in the background. The arrays are dumped as raw bytes in one msgpack document that
+    replaces the previous file atomically. Window match counters are recounted on load, so a
+    checkpoint taken with other thresholds still restores the windows correctly.
+    """
+
+    def __init__(self, rule_set, path, interval=30.0):
+        self.rule_set = rule_set
+        self.path = path
+        self.interval = interval
+        self.saved_at = None  # time.time() of the last successful save
+        self.size = 0
+        self._next_save = time.monotonic() + interval
+        self._writer = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def load(self):
+        """Restore the state from the checkpoint file; returns the number of devices restored."""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            logger.info(f"No checkpoint at {self.path}, starting with empty rule state")
+            return 0
+        except OSError as e:
+            logger.error(f"Error reading checkpoint {self.path}: {e}")
+            return 0
+        started = time.perf_counter()
+        try:
+            checkpoint = msgpack.unpackb(data)
+            if checkpoint.get('version') != CHECKPOINT_VERSION:
+                raise ValueError(f"unsupported version {checkpoint.get('version')}")
+            self.rule_set.restore(checkpoint['state'])
+        except Exception as e:
+            logger.error(f"Ignoring checkpoint {self.path}: {e}")
+            return 0
+        devices = len(self.rule_set.index)
+        logger.info(f"Restored rule state of {devices} devices from {self.path} in "
+                    f"{time.perf_counter() - started:.2f}s, checkpoint is "
+                    f"{time.time() - checkpoint['created_at']:.0f}s old")
+        return devices
+
+    def maybe_save(self):
+        if time.monotonic() < self._next_save:
+            return
+        self._next_save = time.monotonic() + self.interval
+        if self._writer is not None and self._writer.is_alive():
+            logger.warning("Previous checkpoint is still being written, skipping this one")
+            return
+        snapshot = self.snapshot()
+        self._writer = threading.Thread(target=self.write, args=(snapshot,), name="checkpoint-writer", daemon=True)
+        self._writer.start()
+
+    def save(self):
+        """Write a checkpoint now (on shutdown); returns False when it could not be written."""
+        if self._writer is not None:
+            self._writer.join()
+        return self.write(self.snapshot())
+
+    def snapshot(self):
+        return {'version': CHECKPOINT_VERSION, 'created_at': time.time(), 'state': self.rule_set.snapshot()}
+
+    def write(self, snapshot):
+        started = time.perf_counter()
+        data = msgpack.packb(snapshot)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Error writing checkpoint {self.path}: {e}")
+            return False
+        self.saved_at = snapshot['created_at']
+        self.size = len(data)
+        logger.debug(f"Checkpoint of {len(snapshot['state']['index']['devices'])} devices written to "
+                     f"{self.path}: {len(data)} bytes in {time.perf_counter() - started:.3f}s")
+        return True
+
+    def age(self):
+        """Seconds since the last successful save, 0 before the first one."""
+        return time.time() - self.saved_at if self.saved_at is not None else 0
@@ -0,0 +1,262 @@
+import sys
+from array import array
+from collections import OrderedDict
+
+# Why a device left the index
+EVICT_IDLE = 'idle'
+EVICT_CAPACITY = 'capacity'
+
+
+class DeviceIndex:
+    """Maps device ids to dense slot numbers shared by all state stores.
+
+    Stores keep their per-device state in flat arrays indexed by slot, so one
+    dictionary lookup per message serves every rule.
+
+    The index can be bounded: a device not seen for ``ttl`` seconds is evicted, and
+    so is the least recently seen one when a new device would exceed ``max_devices``.
+    ``on_evict(device_id, slot, reason)`` is called so the stores can clear the slot,
+    which then goes to the next new device. The arrays never hold more than
+    ``max_devices`` slots. Without a TTL, idle devices only leave at the capacity limit.
+    """
+
+    def __init__(self, max_devices=0, ttl=0, on_evict=None):
+        self.slots = OrderedDict()  # device_id -> slot, least recently seen first
+        self.last_seen = array('d')  # by slot
+        self.free = []  # slots released by evicted devices
+        self.max_devices = max_devices
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.evicted = 0
+        self._bounded = bool(max_devices or ttl)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, device_id):
+        return device_id in self.slots
+
+    def slot(self, device_id, now=0.0):
+        """Slot of a device, allocated on first sight; ``now`` (seconds) marks it as seen."""
+        slots = self.slots
+        if self.ttl:
+            self.expire(now)
+        slot = slots.get(device_id)
+        if slot is not None:
+            if self._bounded:
+                slots.move_to_end(device_id)
+                self.last_seen[slot] = now
+            return slot
+        if self.max_devices and len(slots) >= self.max_devices:
+            self._evict(next(iter(slots)), EVICT_CAPACITY)
+        if self.free:
+            slot = self.free.pop()
+            self.last_seen[slot] = now
+        else:
+            slot = len(self.last_seen)
+            self.last_seen.append(now)
+        slots[device_id] = slot
+        return slot
+
+    def expire(self, now):
+        """Evict the devices not seen for ``ttl`` seconds; returns how many were evicted."""
+        slots = self.slots
+        last_seen = self.last_seen
+        cutoff = now - self.ttl
+        evicted = 0
+        # Least recently seen first, so this stops at the first live device
+        while slots:
+            device_id = next(iter(slots))
+            if last_seen[slots[device_id]] > cutoff:
+                break
+            self._evict(device_id, EVICT_IDLE)
+            evicted += 1
+        return evicted
+
+    def state_bytes(self):
+        return sys.getsizeof(self.slots) + len(self.last_seen) * self.last_seen.itemsize
+
+    def snapshot(self):
+        return {'devices': list(self.slots.items()), 'last_seen': self.last_seen.tobytes(), 'free': list(self.free)}
+
+    def restore(self, state):
+        """Load a snapshot taken by ``snapshot()``; slot numbers are kept as they were."""
+        last_seen = array('d')
+        last_seen.frombytes(state['last_seen'])
+        slots = OrderedDict((device_id, slot) for device_id, slot in state['devices'])
+        if any(slot >= len(last_seen) for slot in slots.values()):
+            raise ValueError("Device slot outside of the snapshot arrays")
+        self.slots = slots
+        self.last_seen = last_seen
+        self.free = list(state['free'])
+        # The limit may have been lowered since the snapshot
+        while self.max_devices and len(self.slots) > self.max_devices:
+            self._evict(next(iter(self.slots)), EVICT_CAPACITY)
+
+    def _evict(self, device_id, reason):
+        slot = self.slots.pop(device_id)
+        self.free.append(slot)
+        self.evicted += 1
+        if self.on_evict is not None:
+            self.on_evict(device_id, slot, reason)
+
+
+class WindowStore:
+    """Last ``window`` readings of one field for every device, with running match counts.
+
+    Device slot ``i`` owns ``values[i * window:(i + 1) * window]`` as a ring buffer,
+    plus one entry in ``pos`` and ``filled``. Every registered condition keeps its own
+    counter of readings in the window that satisfy it; an update overwrites the oldest
+    reading and adjusts the counters, so a window check is O(1) per packet no matter
+    how long the window is. Rules over the same field and window share one store.
+    """
+
+    def __init__(self, window=10):
+        if window < 1:
+            raise ValueError("Window must hold at least one reading")
+        self.window = window
+        self.values = array('d')
+        self.pos = array('L')  # next ring position to overwrite
+        self.filled = array('L')
+        self.conditions = []
+        self.matches = []  # one array('L') of counters per condition
+        self._empty_ring = array('d', [0.0]) * window
+
+    def add_condition(self, predicate):
+        """Register ``predicate(value) -> bool``; returns its index for ``count``."""
+        self.conditions.append(predicate)
+        self.matches.append(array('L', [0]) * len(self.pos))
+        return len(self.conditions) - 1
+
+    def _grow(self, slot):
+        missing = slot + 1 - len(self.pos)
+        self.values.extend(self._empty_ring * missing)
+        zeros = array('L', [0]) * missing
+        self.pos.extend(zeros)
+        self.filled.extend(zeros)
+        for counters in self.matches:
+            counters.extend(zeros)
+
+    def update(self, slot, value):
+        if slot >= len(self.pos):
+            self._grow(slot)
+        window = self.window
+        pos = self.pos[slot]
+        index = slot * window + pos
+        if self.filled[slot] == window:
+            old = self.values[index]
+            for predicate, counters in zip(self.conditions, self.matches):
+                counters[slot] += predicate(value) - predicate(old)
+        else:
+            self.filled[slot] += 1
+            for predicate, counters in zip(self.conditions, self.matches):
+                if predicate(value):
+                    counters[slot] += 1
+        self.values[index] = value
+        self.pos[slot] = pos + 1 if pos + 1 < window else 0
+
+    def reset(self, slot):
+        """Forget the readings of a slot; stale ring values are overwritten before they are read."""
+        if slot < len(self.pos):
+            self.pos[slot] = 0
+            self.filled[slot] = 0
+            for counters in self.matches:
+                counters[slot] = 0
+
+    def state_bytes(self):
+        arrays = [self.values, self.pos, self.filled] + self.matches
+        return sum(len(a) * a.itemsize for a in arrays)
+
+    def snapshot(self):
+        # Match counters are not saved: they are recounted on restore, so changed
+        # rule thresholds apply to the restored windows
+        return {'window': self.window, 'values': self.values.tobytes(),
+                'pos': self.pos.tobytes(), 'filled': self.filled.tobytes()}
+
+    def restore(self, state):
+        if state['window'] != self.window:
+            raise ValueError(f"Snapshot window {state['window']} != {self.window}")
+        values, pos, filled = array('d'), array('L'), array('L')
+        values.frombytes(state['values'])
+        pos.frombytes(state['pos'])
+        filled.frombytes(state['filled'])
+        if len(values) != len(pos) * self.window or len(filled) != len(pos):
+            raise ValueError("Inconsistent window snapshot")
+        # In place: compiled rules hold references to these arrays
+        self.values[:] = values
+        self.pos[:] = pos
+        self.filled[:] = filled
+        window = self.window
+        for predicate, counters in zip(self.conditions, self.matches):
+            counters[:] = array('L', [0]) * len(pos)
+            for slot in range(len(pos)):
+                # Readings sit in ring positions 0..filled-1 until the ring is full
+                base = slot * window
+                counters[slot] = sum(1 for value in values[base:base + filled[slot]] if predicate(value))
+
+    def is_full(self, slot):
+        return slot < len(self.filled) and self.filled[slot] == self.window
+
+    def count(self, slot, condition):
+        """Readings in the device's window that satisfy a registered condition."""
+        return self.matches[condition][slot] if slot < len(self.pos) else 0
+
+    def readings(self, slot):
+        """Readings of a device in arrival order (oldest first)."""
+        if slot >= len(self.pos):
+            return []
+        window = self.window
+        base = slot * window
+        filled = self.filled[slot]
+        start = self.pos[slot] if filled == window else 0
+        return [self.values[base + (start + i) % window] for i in range(filled)]
+
+
+class LastValueStore:
+    """Previous reading of one field per device and the change the latest reading made."""
+
+    def __init__(self):
+        self.last = array('d')
+        self.delta = array('d')
+        self.seen = bytearray()  # 0 - no readings, 1 - one reading, 2 - delta is valid
+
+    def _grow(self, slot):
+        missing = slot + 1 - len(self.last)
+        zeros = array('d', [0.0]) * missing
+        self.last.extend(zeros)
+        self.delta.extend(zeros)
+        self.seen.extend(bytes(missing))
+
+    def update(self, slot, value):
+        if slot >= len(self.last):
+            self._grow(slot)
+        if self.seen[slot]:
+            self.delta[slot] = value - self.last[slot]
+            self.seen[slot] = 2
+        else:
+            self.seen[slot] = 1
+        self.last[slot] = value
+
+    def has_delta(self, slot):
+        return slot < len(self.seen) and self.seen[slot] == 2
+
+    def reset(self, slot):
+        if slot < len(self.seen):
+            self.seen[slot] = 0
+
+    def state_bytes(self):
+        return (len(self.last) + len(self.delta)) * self.last.itemsize + len(self.seen)
+
+    def snapshot(self):
+        return {'last': self.last.tobytes(), 'delta': self.delta.tobytes(), 'seen': bytes(self.seen)}
+
+    def restore(self, state):
+        last, delta = array('d'), array('d')
+        last.frombytes(state['last'])
+        delta.frombytes(state['delta'])
+        if len(delta) != len(last) or len(state['seen']) != len(last):
+            raise ValueError("Inconsistent last value snapshot")
+        # In place: compiled rules hold references to these arrays
+        self.last[:] = last
+        self.delta[:] = delta
+        self.seen[:] = state['seen']
@@ -0,0 +1,104 @@
+import json
+import threading
+
+
+class Totals:
+    """Occupancy totals over a set of lots; readings are applied as +/- deltas."""
+
+    __slots__ = ('lots', 'free_spots', 'lots_with_space', 'capacity', 'free_with_capacity')
+
+    def __init__(self):
+        self.lots = 0
+        self.free_spots = 0
+        self.lots_with_space = 0
+        # Occupancy only counts lots that reported total_capacity
+        self.capacity = 0
+        self.free_with_capacity = 0
+
+    def apply(self, free_spots, capacity, sign):
+        self.lots += sign
+        self.free_spots += sign * free_spots
+        if free_spots > 0:
+            self.lots_with_space += sign
+        if capacity:
+            self.capacity += sign * capacity
+            self.free_with_capacity += sign * free_spots
+
+    def as_dict(self):
+        occupied = self.capacity - self.free_with_capacity
+        return {
+            "lots": self.lots,
+            "lots_with_space": self.lots_with_space,
+            "free_spots": self.free_spots,
+            "total_capacity": self.capacity,
+            "occupied_spots": occupied,
+            "occupancy_pct": round(occupied * 100.0 / self.capacity, 2) if self.capacity else None,
+        }
+
+
+class FleetAggregator:
+    """Fleet-wide and per-zone occupancy, kept up to date one reading at a time.
+
+    Every device's last free_spots and capacity are remembered; a new reading takes the
+    old values out of the fleet and zone totals and adds the new ones, so ``summary()``
+    costs O(zones) no matter how many devices report. ``zones`` maps device ids (as
+    strings) to zone names; devices outside it only count towards the fleet.
+    """
+
+    def __init__(self, zones=None):
+        self.zones = zones or {}
+        self.fleet = Totals()
+        self.zone_totals = {zone: Totals() for zone in set(self.zones.values())}
+        self._devices = {}  # device_id -> (free_spots, capacity, zone totals or None)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def update(self, device_id, free_spots, capacity=None):
+        with self._lock:
+            previous = self._devices.get(device_id)
+            if previous is not None:
+                old_free, old_capacity, zone = previous
+                self.fleet.apply(old_free, old_capacity, -1)
+                if zone is not None:
+                    zone.apply(old_free, old_capacity, -1)
+                if capacity is None:
+                    # Capacity is optional in readings, keep the last known one
+                    capacity = old_capacity
+            else:
+                name = self.zones.get(str(device_id))
+                zone = self.zone_totals[name] if name is not None else None
+            self.fleet.apply(free_spots, capacity, 1)
+            if zone is not None:
+                zone.apply(free_spots, capacity, 1)
+            self._devices[device_id] = (free_spots, capacity, zone)
+
+    def remove(self, device_id):
+        """Take a device out of the totals (its rule state was evicted)."""
+        with self._lock:
+            previous = self._devices.pop(device_id, None)
+            if previous is None:
+                return
+            free_spots, capacity, zone = previous
+            self.fleet.apply(free_spots, capacity, -1)
+            if zone is not None:
+                zone.apply(free_spots, capacity, -1)
+
+    def summary(self):
+        with self._lock:
+            return {
+                "fleet": self.fleet.as_dict(),
+                "zones": {name: totals.as_dict() for name, totals in self.zone_totals.items()},
+            }
+
+
+def load_zones(path):
+    """Read ``{"zone": [device_id, ...], ...}`` into a device id -> zone mapping."""
+    with open(path) as f:
+        config = json.load(f)
+    zones = {}
+    for zone, device_ids in config.items():
+        for device_id in device_ids:
+            zones[str(device_id)] = zone
+    return zones
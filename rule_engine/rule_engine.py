@@ -1,33 +1,190 @@
 import paho.mqtt.client as mqtt
 from influxdb_client import InfluxDBClient, Point, WritePrecision
-from collections import defaultdict
 from influxdb_client.client.write_api import SYNCHRONOUS
 import json
 import logging
 import time
+import os
+import signal
+import socket
+import threading
+import redis
+from prometheus_client import Counter, Gauge
+from rules import RuleSet, load_rules
+from checkpoint import Checkpointer
+from fleet import FleetAggregator, load_zones
+from iot_common.codec import decode_readings, to_reading
+from iot_common.influx_writer import BatchingWriter
+from iot_common.log_setup import configure_logging
+from iot_common.metrics import (MESSAGES_RECEIVED, READINGS_RECEIVED, DECODE_SECONDS, STAGE_SECONDS,
+                                DROPPED_DECODE_ERROR, DROPPED_INVALID, QUEUE_DEPTH, start_metrics_server)
 
-logging.basicConfig(level=logging.INFO)
+# Only when run as the service: tests and the benchmark keep their own logging setup
+if __name__ == '__main__':
+    configure_logging()
 logger = logging.getLogger(__name__)
 
 # Конфигурация MQTT
-MQTT_HOST = 'mosquitto'
+MQTT_HOST = os.getenv('MQTT_HOST', 'mosquitto')
 MQTT_PORT = 1883
 MQTT_TOPIC = 'rule_engine_topic'
+MQTT_CLIENT_ID = os.getenv('MQTT_CLIENT_ID', f"rule-engine-{socket.gethostname()}-{os.getpid()}")
+# Stateless scaling: replicas in one MQTT v5 shared-subscription group split the topic.
+# Lasting rules keep per-device state, so for them use partitions instead.
+MQTT_SHARED_GROUP = os.getenv('MQTT_SHARED_GROUP', '')
+# Device affinity: iot_controller publishes to rule_engine_topic/<crc32(device_id) % N>
+# and this instance consumes the partitions p with p % INSTANCE_COUNT == INSTANCE_INDEX
+RULE_ENGINE_PARTITIONS = int(os.getenv('RULE_ENGINE_PARTITIONS', '0'))
+RULE_ENGINE_INSTANCE_INDEX = int(os.getenv('RULE_ENGINE_INSTANCE_INDEX', '0'))
+RULE_ENGINE_INSTANCE_COUNT = int(os.getenv('RULE_ENGINE_INSTANCE_COUNT', '1'))
+
+# Rules are read from RULES_FILE (JSON, see rules.example.json). Without it the
+# built-in rules apply: instant - free_spots > INSTANT_THRESHOLD,
+# lasting - free_spots > LASTING_THRESHOLD for LASTING_WINDOW packets in a row
+RULES_FILE = os.getenv('RULES_FILE', '')
+INSTANT_THRESHOLD = int(os.getenv('INSTANT_THRESHOLD', '5'))
+LASTING_THRESHOLD = int(os.getenv('LASTING_THRESHOLD', '5'))
+LASTING_WINDOW = int(os.getenv('LASTING_WINDOW', '10'))
+
+# Alerts are edge-triggered: written when a rule starts firing for a device and when
+# it resolves, plus every ALERT_RENOTIFY_SECONDS while it stays active (0 - never).
+# ALERT_HYSTERESIS is how far a value has to move back past the threshold to resolve.
+# Rules can override these with "edge", "renotify_seconds" and "hysteresis".
+ALERT_EDGE_TRIGGERED = os.getenv('ALERT_EDGE_TRIGGERED', 'true').lower() == 'true'
+ALERT_RENOTIFY_SECONDS = float(os.getenv('ALERT_RENOTIFY_SECONDS', '0'))
+ALERT_HYSTERESIS = float(os.getenv('ALERT_HYSTERESIS', '0'))
+
+# Per-device rule state is bounded: a device silent for RULE_STATE_TTL_SECONDS is
+# forgotten, and past RULE_STATE_MAX_DEVICES the least recently seen one makes room
+# (0 disables either limit). An evicted device starts with empty windows.
+RULE_STATE_MAX_DEVICES = int(os.getenv('RULE_STATE_MAX_DEVICES', '100000'))
+RULE_STATE_TTL_SECONDS = float(os.getenv('RULE_STATE_TTL_SECONDS', '86400'))
+# Warm restart: the state is saved to RULE_STATE_CHECKPOINT_FILE every
+# RULE_STATE_CHECKPOINT_INTERVAL seconds and on shutdown, and loaded on startup
+RULE_STATE_CHECKPOINT_FILE = os.getenv('RULE_STATE_CHECKPOINT_FILE', '')
+RULE_STATE_CHECKPOINT_INTERVAL = float(os.getenv('RULE_STATE_CHECKPOINT_INTERVAL', '30'))
+
+# Fleet-wide and per-zone occupancy totals, updated incrementally from every reading and
+# published every FLEET_SUMMARY_INTERVAL seconds (0 disables) as a retained JSON message
+# on FLEET_SUMMARY_TOPIC and, with REDIS_HOST, as the Redis string FLEET_SUMMARY_KEY.
+# ZONES_FILE is JSON {"zone": [device_id, ...]}. With partitions every instance publishes
+# the totals of its own devices under /<instance index> (":<instance index>" in Redis).
+FLEET_SUMMARY_INTERVAL = float(os.getenv('FLEET_SUMMARY_INTERVAL', '5'))
+FLEET_SUMMARY_TOPIC = os.getenv('FLEET_SUMMARY_TOPIC', 'parking/summary')
+FLEET_SUMMARY_KEY = os.getenv('FLEET_SUMMARY_KEY', 'parking:summary')
+ZONES_FILE = os.getenv('ZONES_FILE', '')
+REDIS_HOST = os.getenv('REDIS_HOST', '')
+REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+REDIS_PASSWORD = os.getenv('REDIS_PASSWORD') or None
+REDIS_DB = int(os.getenv('REDIS_DB', '0'))
+
+# Alert points go through the same batching writer as in iot_controller: failed writes
+# are retried with backoff and, with INFLUX_SPILL_DIR, overflow is spilled to disk
+INFLUX_BATCH_SIZE = int(os.getenv('INFLUX_BATCH_SIZE', '500'))
+INFLUX_FLUSH_INTERVAL = float(os.getenv('INFLUX_FLUSH_INTERVAL', '1.0'))  # seconds
+INFLUX_QUEUE_SIZE = int(os.getenv('INFLUX_QUEUE_SIZE', '10000'))
+INFLUX_OVERFLOW_POLICY = os.getenv('INFLUX_OVERFLOW_POLICY', 'drop_oldest')  # drop_oldest | drop_newest | block
+INFLUX_RETRY_INITIAL = float(os.getenv('INFLUX_RETRY_INITIAL', '0.5'))  # seconds
+INFLUX_RETRY_MAX = float(os.getenv('INFLUX_RETRY_MAX', '30'))  # seconds
+INFLUX_MAX_RETRIES = int(os.getenv('INFLUX_MAX_RETRIES', '10'))  # then spill (or drop) the batch, 0 - no limit
+INFLUX_SPILL_DIR = os.getenv('INFLUX_SPILL_DIR', '')
+INFLUX_SPILL_MAX_MB = int(os.getenv('INFLUX_SPILL_MAX_MB', '1024'))
+
+# Prometheus /metrics port, 0 disables it
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9103'))
+
+DEFAULT_RULES = [
+    {"name": "instant", "type": "threshold", "field": "free_spots", "op": ">", "value": INSTANT_THRESHOLD,
+     "measurement": "rule_instant", "alert_type": "instant"},
+    {"name": "lasting", "type": "window", "field": "free_spots", "op": ">", "value": LASTING_THRESHOLD,
+     "window": LASTING_WINDOW, "measurement": "rule_lasting", "alert_type": "lasting"},
+]
 
 # InfluxDB connection
 influx_client = InfluxDBClient(url="http://influxdb:8086", token="super-secret-token", org="iot_org")
 query_api = influx_client.query_api()
-write_api = influx_client.write_api(write_options=SYNCHRONOUS)
-device_state = defaultdict(list)
+write_api = BatchingWriter(
+    influx_client.write_api(write_options=SYNCHRONOUS),
+    batch_size=INFLUX_BATCH_SIZE,
+    flush_interval=INFLUX_FLUSH_INTERVAL,
+    max_queue_size=INFLUX_QUEUE_SIZE,
+    overflow_policy=INFLUX_OVERFLOW_POLICY,
+    retry_initial=INFLUX_RETRY_INITIAL,
+    retry_max=INFLUX_RETRY_MAX,
+    max_retries=INFLUX_MAX_RETRIES,
+    spill_dir=INFLUX_SPILL_DIR or None,
+    spill_max_bytes=INFLUX_SPILL_MAX_MB * 1024 * 1024,
+)
+
+fleet = FleetAggregator(load_zones(ZONES_FILE) if ZONES_FILE else None)
+redis_client = (redis.Redis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD, db=REDIS_DB,
+                            socket_timeout=5) if REDIS_HOST else None)
+
+def device_evicted(device_id, reason):
+    DEVICE_EVICTIONS.labels(reason=reason).inc()
+    # A forgotten device no longer counts towards the fleet totals either
+    fleet.remove(device_id)
+    logger.debug("Evicted rule state of device %s (%s)", device_id, reason)
+
+rule_set = RuleSet(
+    load_rules(RULES_FILE) if RULES_FILE else DEFAULT_RULES,
+    edge=ALERT_EDGE_TRIGGERED,
+    renotify_seconds=ALERT_RENOTIFY_SECONDS,
+    hysteresis=ALERT_HYSTERESIS,
+    max_devices=RULE_STATE_MAX_DEVICES,
+    device_ttl=RULE_STATE_TTL_SECONDS,
+    on_evict=device_evicted,
+)
+checkpointer = (Checkpointer(rule_set, RULE_STATE_CHECKPOINT_FILE, RULE_STATE_CHECKPOINT_INTERVAL)
+                if RULE_STATE_CHECKPOINT_FILE else None)
+
+EVALUATE_SECONDS = STAGE_SECONDS.labels(stage='evaluate')
+RULE_EVALUATIONS = Counter('rule_evaluations_total', 'Rule checks run against readings')
+ALERTS_EMITTED = Counter('alerts_total', 'Alert points emitted', ['rule', 'state'])
+DEVICES_TRACKED = Gauge('rule_engine_devices', 'Devices with per-device rule state')
+ACTIVE_ALERTS = Gauge('rule_engine_active_alerts', 'Alerts currently firing')
+DEVICE_EVICTIONS = Counter('rule_engine_device_evictions_total', 'Devices whose rule state was evicted', ['reason'])
+STATE_BYTES = Gauge('rule_engine_state_bytes', 'Approximate memory held by per-device rule state')
+CHECKPOINT_AGE = Gauge('rule_engine_checkpoint_age_seconds', 'Time since the last rule state checkpoint')
+CHECKPOINT_BYTES = Gauge('rule_engine_checkpoint_bytes', 'Size of the last rule state checkpoint')
+FLEET_FREE_SPOTS = Gauge('rule_engine_fleet_free_spots', 'Free spots over all lots of this instance')
+FLEET_LOTS_WITH_SPACE = Gauge('rule_engine_fleet_lots_with_space', 'Lots of this instance with free spots')
+DEVICES_TRACKED.set_function(lambda: len(rule_set.index))
+FLEET_FREE_SPOTS.set_function(lambda: fleet.fleet.free_spots)
+FLEET_LOTS_WITH_SPACE.set_function(lambda: fleet.fleet.lots_with_space)
+STATE_BYTES.set_function(lambda: rule_set.state_bytes())
+ACTIVE_ALERTS.set_function(lambda: rule_set.active_alerts())
+alert_counters = {}  # (rule name, state) -> bound ALERTS_EMITTED child
+
+def alert_counter(rule, state):
+    counter = alert_counters.get((rule.name, state))
+    if counter is None:
+        counter = alert_counters[rule.name, state] = ALERTS_EMITTED.labels(rule=rule.name, state=state)
+    return counter
+
+def subscription_topics():
+    if RULE_ENGINE_PARTITIONS > 0:
+        topics = [f"{MQTT_TOPIC}/{p}" for p in range(RULE_ENGINE_PARTITIONS)
+                  if p % RULE_ENGINE_INSTANCE_COUNT == RULE_ENGINE_INSTANCE_INDEX]
+    else:
+        topics = [MQTT_TOPIC]
+    if MQTT_SHARED_GROUP:
+        topics = [f"$share/{MQTT_SHARED_GROUP}/{topic}" for topic in topics]
+    return topics
+
+def subscribe(client):
+    topics = subscription_topics()
+    client.subscribe([(topic, 0) for topic in topics])
+    logger.info(f"Subscribed to {topics}")
 
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
         logger.info("Connected to MQTT Broker!")
-        client.subscribe(MQTT_TOPIC)
+        subscribe(client)
     else:
         logger.error(f"Failed to connect, return code {rc}")
 
-def on_disconnect(client, userdata, rc):
+def on_disconnect(client, userdata, rc, properties=None):
     logger.warning(f"Disconnected from MQTT Broker. Reason: {rc}")
     while True:
         try:
@@ -39,40 +196,73 @@ def on_disconnect(client, userdata, rc):
             time.sleep(5)
 
 def on_message(client, userdata, message):
+    MESSAGES_RECEIVED.inc()
+    started = time.perf_counter()
     try:
-        data = json.loads(message.payload.decode())
-        logger.info(f"Received data: {data}")
-        
-        device_id = data.get("device_id")
-        free_spots = data.get("free_spots")
-
-        # Instant rule: free_spots > 5
-        if free_spots > 5:
-            logger.info(f"Alert: Device {device_id} has {free_spots} free spots.")
-            point = Point("rule_instant") \
-                .tag("device_id", device_id) \
-                .field("free_spots", free_spots) \
-                .field("alert_type", "instant") \
-                .time(time.time_ns(), WritePrecision.NS)
-            write_api.write(bucket="rule_engine_bucket", record=point)
-
-        # Lasting rule: free_spots > 5 for 10 packets
-        device_state[device_id].append(free_spots)
-        if len(device_state[device_id]) >= 10:
-            if all(x > 5 for x in device_state[device_id][-10:]):
-                logger.info(f"Alert: Device {device_id} has >5 free spots for 10 packets.")
-                point = Point("rule_lasting") \
-                    .tag("device_id", device_id) \
-                    .field("free_spots", free_spots) \
-                    .field("alert_type", "lasting") \
-                    .time(time.time_ns(), WritePrecision.NS)
-                write_api.write(bucket="rule_engine_bucket", record=point)
-            device_state[device_id].pop(0)
+        readings, batched = decode_readings(message.payload)
     except Exception as e:
-        logger.error(f"Error processing message: {e}")
+        DROPPED_DECODE_ERROR.inc()
+        logger.error("Error processing message: %s", e)
+        return
+    decoded = time.perf_counter()
+    DECODE_SECONDS.observe(decoded - started)
+    READINGS_RECEIVED.inc(len(readings))
+    try:
+        if batched:
+            logger.debug("Received batch of %d readings", len(readings))
+        else:
+            logger.debug("Received data: %s", readings[0])
+
+        points = []
+        evaluated = 0
+        for data in readings:
+            try:
+                reading = to_reading(data)
+            except ValueError as e:
+                DROPPED_INVALID.inc()
+                logger.error("Invalid reading %s: %s", data, e)
+                continue
+            evaluated += 1
+            try:
+                points.extend(evaluate_reading(reading))
+            except Exception as e:
+                if not batched:
+                    raise
+                logger.error("Error processing reading %s: %s", data, e)
+        EVALUATE_SECONDS.observe(time.perf_counter() - decoded)
+        RULE_EVALUATIONS.inc(evaluated * len(rule_set))
+        # All alerts of a message (a whole batch) are queued together
+        if points:
+            write_api.write(bucket="rule_engine_bucket", record=points)
+    except Exception as e:
+        logger.error("Error processing message: %s", e)
+    # Between messages, so the snapshot is consistent
+    if checkpointer is not None:
+        checkpointer.maybe_save()
+
+def evaluate_reading(data):
+    device_id = data.get("device_id")
+    emitted = rule_set.evaluate(device_id, data)
+    # After evaluate: a device back after the TTL is evicted there first, and the
+    # eviction takes it out of the fleet totals
+    fleet.update(device_id, data.get("free_spots"), data.get("total_capacity"))
+    points = []
+    for rule, value, state in emitted:
+        logger.info("Alert %s: Device %s rule %s: %s=%s", state, device_id, rule.name, rule.value_field, value)
+        alert_counter(rule, state).inc()
+        point = Point(rule.measurement) \
+            .tag("device_id", device_id) \
+            .field(rule.value_field, value) \
+            .field("alert_type", rule.alert_type) \
+            .field("state", state) \
+            .time(time.time_ns(), WritePrecision.NS)
+        points.append(point)
+    return points
 
 def setup_mqtt():
-    rule_engine_client = mqtt.Client()
+    # Shared subscriptions are an MQTT v5 feature
+    protocol = mqtt.MQTTv5 if MQTT_SHARED_GROUP else mqtt.MQTTv311
+    rule_engine_client = mqtt.Client(client_id=MQTT_CLIENT_ID, protocol=protocol)
     rule_engine_client.on_message = on_message
     rule_engine_client.on_connect = on_connect
     rule_engine_client.on_disconnect = on_disconnect
@@ -85,16 +275,71 @@ def setup_mqtt():
         logger.error(f"Error connecting to MQTT broker: {e}")
         return None
 
-    rule_engine_client.subscribe(MQTT_TOPIC)
+    subscribe(rule_engine_client)
     
     return rule_engine_client
 
+def summary_destination():
+    if RULE_ENGINE_PARTITIONS > 0 and RULE_ENGINE_INSTANCE_COUNT > 1:
+        return f"{FLEET_SUMMARY_TOPIC}/{RULE_ENGINE_INSTANCE_INDEX}", f"{FLEET_SUMMARY_KEY}:{RULE_ENGINE_INSTANCE_INDEX}"
+    return FLEET_SUMMARY_TOPIC, FLEET_SUMMARY_KEY
+
+def publish_summary(client):
+    summary = fleet.summary()
+    summary["timestamp"] = time.time_ns()
+    payload = json.dumps(summary)
+    topic, key = summary_destination()
+    # Retained: a new subscriber gets the current totals right away
+    client.publish(topic, payload, retain=True)
+    if redis_client is not None:
+        try:
+            redis_client.set(key, payload)
+        except Exception as e:
+            logger.error(f"Error writing fleet summary to Redis: {e}")
+
+def start_summary_publisher(client):
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(FLEET_SUMMARY_INTERVAL):
+            publish_summary(client)
+
+    threading.Thread(target=run, name="fleet-summary", daemon=True).start()
+    return stop
+
+def shutdown(client):
+    client.on_disconnect = None
+    client.disconnect()
+
 def main():
+    # Before subscribing, so that the first messages already see the restored windows
+    if checkpointer is not None:
+        checkpointer.load()
     rule_engine_client = setup_mqtt()
     if not rule_engine_client:
         logger.error("Exiting: Unable to connect to MQTT broker.")
         return
-    rule_engine_client.loop_forever()
+    QUEUE_DEPTH.labels(queue='influx_writer').set_function(write_api.queue_size)
+    if checkpointer is not None:
+        CHECKPOINT_AGE.set_function(checkpointer.age)
+        CHECKPOINT_BYTES.set_function(lambda: checkpointer.size)
+    start_metrics_server(METRICS_PORT)
+
+    summary_stop = start_summary_publisher(rule_engine_client) if FLEET_SUMMARY_INTERVAL > 0 else None
+
+    # docker stop sends SIGTERM: leave the MQTT loop and flush pending alerts
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutdown(rule_engine_client))
+    try:
+        rule_engine_client.loop_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if summary_stop is not None:
+            summary_stop.set()
+        if checkpointer is not None:
+            checkpointer.save()
+        write_api.close()
+        influx_client.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,319 @@
+import json
+import operator
+import logging
+import time
+from array import array
+from device_state import DeviceIndex, WindowStore, LastValueStore
+
+logger = logging.getLogger(__name__)
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+RULE_THRESHOLD = 'threshold'
+RULE_WINDOW = 'window'
+RULE_RATE_OF_CHANGE = 'rate_of_change'
+RULE_OCCUPANCY = 'occupancy'
+
+# Derived field: share of occupied spots, needs total_capacity in the reading
+OCCUPANCY_FIELD = 'occupancy_pct'
+
+
+def occupancy_pct(values):
+    capacity = values.get("total_capacity")
+    free_spots = values.get("free_spots")
+    if not capacity or free_spots is None:
+        return None
+    return (capacity - free_spots) * 100.0 / capacity
+
+
+# Alert states written with every alert point
+ALERT_FIRING = 'firing'
+ALERT_RESOLVED = 'resolved'
+
+
+def relaxed_threshold(op_name, threshold, hysteresis):
+    """Threshold an active alert has to cross back over before it resolves."""
+    if op_name in ('>', '>='):
+        return threshold - hysteresis
+    if op_name in ('<', '<='):
+        return threshold + hysteresis
+    return threshold
+
+
+class Rule:
+    """A compiled rule.
+
+    ``check(slot, values)`` returns the observed value when the rule condition holds,
+    else None; ``hold`` is the same check against the hysteresis-relaxed threshold and
+    decides when an active alert resolves; ``current`` returns the observed value
+    unconditionally. All three assume ``values[field]`` is present.
+    Per-device alert state lives in ``active`` / ``notified_at``, indexed by slot.
+    """
+
+    __slots__ = ('name', 'type', 'field', 'value_field', 'measurement', 'alert_type',
+                 'check', 'hold', 'current', 'edge', 'renotify_seconds', 'active', 'notified_at')
+
+    def __init__(self, name, rule_type, field, value_field, measurement, alert_type,
+                 check, hold, current, edge=True, renotify_seconds=0):
+        self.name = name
+        self.type = rule_type
+        self.field = field
+        self.value_field = value_field
+        self.measurement = measurement
+        self.alert_type = alert_type
+        self.check = check
+        self.hold = hold
+        self.current = current
+        self.edge = edge
+        self.renotify_seconds = renotify_seconds
+        self.active = bytearray()
+        self.notified_at = array('d')
+
+    def __repr__(self):
+        return f"Rule({self.name!r}, {self.type})"
+
+    def _grow(self, slot):
+        missing = slot + 1 - len(self.active)
+        self.active.extend(bytes(missing))
+        self.notified_at.extend(array('d', [0.0]) * missing)
+
+    def reset(self, slot):
+        if slot < len(self.active):
+            self.active[slot] = 0
+            self.notified_at[slot] = 0.0
+
+    def state_bytes(self):
+        return len(self.active) + len(self.notified_at) * self.notified_at.itemsize
+
+    def transition(self, slot, values, now):
+        """Evaluate the rule for a device; returns ``(value, state)`` to emit or None."""
+        value = self.check(slot, values)
+        if not self.edge:
+            return None if value is None else (value, ALERT_FIRING)
+        if slot >= len(self.active):
+            self._grow(slot)
+        if not self.active[slot]:
+            if value is None:
+                return None
+            self.active[slot] = 1
+            self.notified_at[slot] = now
+            return value, ALERT_FIRING
+        if value is None:
+            held = self.hold(slot, values)
+            if held is None:
+                self.active[slot] = 0
+                return self.current(slot, values), ALERT_RESOLVED
+            value = held
+        if self.renotify_seconds and now - self.notified_at[slot] >= self.renotify_seconds:
+            self.notified_at[slot] = now
+            return value, ALERT_FIRING
+        return None
+
+
+class RuleSet:
+    """Rules compiled once at startup and evaluated together in one pass per message.
+
+    Rules over the same field and window share a WindowStore, rate-of-change rules
+    over the same field share a LastValueStore, and all stores share one DeviceIndex,
+    so a message costs one dictionary lookup plus one update per distinct store.
+
+    Alerts are edge-triggered by default: a rule emits when it starts firing for a
+    device and when it resolves, optionally re-notifying every ``renotify_seconds``
+    while it stays active. Rules with ``"edge": false`` emit on every matching packet.
+
+    ``max_devices`` and ``device_ttl`` (seconds) bound the per-device state, see
+    DeviceIndex. An evicted device starts over: empty windows and no active alerts,
+    so an alert that was firing is dropped without a resolved point.
+    ``on_evict(device_id, reason)`` is called for every eviction.
+    """
+
+    def __init__(self, configs, edge=True, renotify_seconds=0, hysteresis=0,
+                 max_devices=0, device_ttl=0, on_evict=None):
+        self.defaults = {'edge': edge, 'renotify_seconds': renotify_seconds, 'hysteresis': hysteresis}
+        self.on_evict = on_evict
+        self.index = DeviceIndex(max_devices, device_ttl, on_evict=self._evicted)
+        self.window_stores = {}  # (field, window) -> WindowStore
+        self.last_value_stores = {}  # field -> LastValueStore
+        self.rules = [self._compile(config) for config in configs]
+        self._stores = [(field, store) for (field, _), store in self.window_stores.items()]
+        self._stores += list(self.last_value_stores.items())
+        self._needs_occupancy = any(rule.field == OCCUPANCY_FIELD for rule in self.rules)
+        logger.info(f"Compiled {len(self.rules)} rules using {len(self._stores)} shared state stores")
+
+    def __len__(self):
+        return len(self.rules)
+
+    def evaluate(self, device_id, values, now=None):
+        """Update per-device state with a reading and return ``[(rule, value, state), ...]`` to emit."""
+        if now is None:
+            now = time.time()
+        if self._needs_occupancy:
+            values = dict(values)
+            values[OCCUPANCY_FIELD] = occupancy_pct(values)
+        slot = self.index.slot(device_id, now)
+        for field, store in self._stores:
+            value = values.get(field)
+            if value is not None:
+                store.update(slot, value)
+        emitted = []
+        for rule in self.rules:
+            if values.get(rule.field) is None:
+                continue
+            result = rule.transition(slot, values, now)
+            if result is not None:
+                emitted.append((rule, result[0], result[1]))
+        return emitted
+
+    def active_alerts(self):
+        return sum(sum(rule.active) for rule in self.rules)
+
+    def state_bytes(self):
+        """Approximate memory held by the per-device state."""
+        return (self.index.state_bytes() + sum(store.state_bytes() for _, store in self._stores)
+                + sum(rule.state_bytes() for rule in self.rules))
+
+    def snapshot(self):
+        """Per-device state as plain values and bytes, restorable by a RuleSet with the same rules."""
+        return {
+            'index': self.index.snapshot(),
+            'windows': [[field, window, store.snapshot()] for (field, window), store in self.window_stores.items()],
+            'last_values': [[field, store.snapshot()] for field, store in self.last_value_stores.items()],
+            'rules': [[rule.name, bytes(rule.active), rule.notified_at.tobytes()] for rule in self.rules],
+        }
+
+    def restore(self, state):
+        """Load a ``snapshot()``. State of rules and stores missing from it starts empty;
+        on an invalid snapshot all state is cleared and ValueError is raised."""
+        self.clear()
+        try:
+            self._restore(state)
+        except (KeyError, TypeError, ValueError) as e:
+            self.clear()
+            raise ValueError(f"Invalid rule state snapshot: {e}")
+
+    def clear(self):
+        """Forget the state of all devices."""
+        self._restore({
+            'index': DeviceIndex().snapshot(),
+            'windows': [[field, window, WindowStore(window).snapshot()] for field, window in self.window_stores],
+            'last_values': [[field, LastValueStore().snapshot()] for field in self.last_value_stores],
+            'rules': [[rule.name, b'', b''] for rule in self.rules],
+        })
+
+    def _restore(self, state):
+        for field, window, store_state in state['windows']:
+            store = self.window_stores.get((field, window))
+            if store is not None:
+                store.restore(store_state)
+        for field, store_state in state['last_values']:
+            store = self.last_value_stores.get(field)
+            if store is not None:
+                store.restore(store_state)
+        rules = {rule.name: rule for rule in self.rules}
+        for name, active, notified_at in state['rules']:
+            rule = rules.get(name)
+            if rule is None:
+                continue
+            times = array('d')
+            times.frombytes(notified_at)
+            if len(times) != len(active):
+                raise ValueError(f"Inconsistent alert state of rule {name}")
+            rule.active[:] = active
+            rule.notified_at[:] = times
+        # Last: trimming the index to max_devices resets slots in the restored stores
+        self.index.restore(state['index'])
+
+    def _evicted(self, device_id, slot, reason):
+        for _, store in self._stores:
+            store.reset(slot)
+        for rule in self.rules:
+            rule.reset(slot)
+        if self.on_evict is not None:
+            self.on_evict(device_id, reason)
+
+    def _compile(self, config):
+        try:
+            name = config['name']
+            rule_type = config['type']
+            if rule_type == RULE_OCCUPANCY:
+                field = OCCUPANCY_FIELD
+            else:
+                field = config['field']
+            op_name = config.get('op', '>')
+            op = OPERATORS[op_name]
+            threshold = config['value']
+        except KeyError as e:
+            raise ValueError(f"Invalid rule {config}: missing or unknown {e}")
+        measurement = config.get('measurement', f"rule_{name}")
+        alert_type = config.get('alert_type', name)
+        edge = bool(config.get('edge', self.defaults['edge']))
+        renotify_seconds = float(config.get('renotify_seconds', self.defaults['renotify_seconds']))
+        hysteresis = float(config.get('hysteresis', self.defaults['hysteresis']))
+        relaxed = relaxed_threshold(op_name, threshold, hysteresis)
+        value_field = field
+
+        def current(slot, values):
+            return values[field]
+
+        if rule_type in (RULE_THRESHOLD, RULE_OCCUPANCY):
+            def make_check(limit):
+                def check(slot, values):
+                    value = values[field]
+                    if op(value, limit):
+                        return value
+                return check
+        elif rule_type == RULE_WINDOW:
+            window = int(config.get('window', 10))
+            min_matches = int(config.get('min_matches', window))
+            if not 0 < min_matches <= window:
+                raise ValueError(f"Rule {name}: min_matches must be between 1 and window")
+            store = self.window_stores.get((field, window))
+            if store is None:
+                store = self.window_stores[(field, window)] = WindowStore(window)
+            filled = store.filled
+
+            def make_check(limit):
+                matches = store.matches[store.add_condition(lambda value: op(value, limit))]
+
+                def check(slot, values):
+                    if filled[slot] == window and matches[slot] >= min_matches:
+                        return values[field]
+                return check
+        elif rule_type == RULE_RATE_OF_CHANGE:
+            store = self.last_value_stores.get(field)
+            if store is None:
+                store = self.last_value_stores[field] = LastValueStore()
+            seen, delta = store.seen, store.delta
+            value_field = f"{field}_delta"
+
+            def current(slot, values):
+                return delta[slot]
+
+            def make_check(limit):
+                def check(slot, values):
+                    if seen[slot] == 2 and op(delta[slot], limit):
+                        return delta[slot]
+                return check
+        else:
+            raise ValueError(f"Rule {name}: unknown type {rule_type}")
+
+        check = make_check(threshold)
+        hold = check if relaxed == threshold else make_check(relaxed)
+        return Rule(name, rule_type, field, value_field, measurement, alert_type,
+                    check, hold, current, edge=edge, renotify_seconds=renotify_seconds)
+
+
+def load_rules(path):
+    """Read rule definitions from a JSON file: a list or ``{"rules": [...]}``."""
+    with open(path) as f:
+        config = json.load(f)
+    if isinstance(config, dict):
+        config = config.get('rules', [])
+    return config
@@ -0,0 +1,452 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from prometheus_client import REGISTRY
+from rule_engine import (on_message, on_connect, subscription_topics, publish_summary, device_evicted, logger,
+                         DEFAULT_RULES)
+from device_state import DeviceIndex, WindowStore, LastValueStore
+from rules import RuleSet
+from checkpoint import Checkpointer
+from fleet import FleetAggregator, load_zones
+from iot_common.codec import encode_readings
+
+
+def make_message(payload):
+    message = mock.MagicMock()
+    message.payload = payload.encode() if isinstance(payload, str) else payload
+    return message
+
+
+def written_points(mock_write_api):
+    points = []
+    for c in mock_write_api.write.call_args_list:
+        record = c.kwargs["record"]
+        points.extend(record if isinstance(record, list) else [record])
+    return points
+
+
+class TestWindowStore(unittest.TestCase):
+    def test_counts_matches_in_window(self):
+        store = WindowStore(window=3)
+        above = store.add_condition(lambda value: value > 5)
+        for value in (6, 7, 8):
+            store.update(0, value)
+        self.assertTrue(store.is_full(0))
+        self.assertEqual(store.count(0, above), 3)
+        store.update(0, 2)
+        self.assertEqual(store.count(0, above), 2)
+        for value in (9, 9):
+            store.update(0, value)
+        self.assertEqual(store.count(0, above), 2)
+        store.update(0, 9)
+        self.assertEqual(store.count(0, above), 3)
+
+    def test_devices_are_independent(self):
+        store = WindowStore(window=2)
+        above = store.add_condition(lambda value: value > 5)
+        store.update(0, 10)
+        store.update(3, 1)
+        store.update(0, 10)
+        store.update(3, 10)
+        self.assertEqual(store.count(0, above), 2)
+        self.assertEqual(store.count(3, above), 1)
+        self.assertEqual(store.count(1, above), 0)
+
+    def test_readings_in_arrival_order(self):
+        store = WindowStore(window=3)
+        for value in (1, 2, 3, 4):
+            store.update(0, value)
+        self.assertEqual(store.readings(0), [2.0, 3.0, 4.0])
+        self.assertEqual(store.readings(5), [])
+
+    def test_invalid_window(self):
+        with self.assertRaises(ValueError):
+            WindowStore(window=0)
+
+    def test_last_value_delta(self):
+        store = LastValueStore()
+        store.update(0, 10)
+        self.assertFalse(store.has_delta(0))
+        store.update(0, 4)
+        self.assertTrue(store.has_delta(0))
+        self.assertEqual(store.delta[0], -6)
+
+
+class TestDeviceIndex(unittest.TestCase):
+    def test_unbounded_slots_are_dense(self):
+        index = DeviceIndex()
+        self.assertEqual([index.slot(d) for d in ("a", "b", "a", "c")], [0, 1, 0, 2])
+        self.assertEqual(len(index), 3)
+
+    def test_capacity_evicts_least_recently_seen(self):
+        evicted = []
+        index = DeviceIndex(max_devices=2, on_evict=lambda *args: evicted.append(args))
+        index.slot("a", now=1)
+        index.slot("b", now=2)
+        index.slot("a", now=3)
+        self.assertEqual(index.slot("c", now=4), 1)
+        self.assertEqual(evicted, [("b", 1, "capacity")])
+        self.assertNotIn("b", index)
+        self.assertEqual(len(index.last_seen), 2)
+
+    def test_idle_devices_expire(self):
+        evicted = []
+        index = DeviceIndex(ttl=10, on_evict=lambda device_id, slot, reason: evicted.append((device_id, reason)))
+        index.slot("a", now=0)
+        index.slot("b", now=5)
+        index.slot("b", now=12)
+        self.assertEqual(evicted, [("a", "idle")])
+        self.assertEqual(index.slot("c", now=13), 0)
+        self.assertEqual(index.expire(now=100), 2)
+        self.assertEqual(len(index), 0)
+
+
+class TestRuleSet(unittest.TestCase):
+    def fired(self, rule_set, device_id, **values):
+        return [rule.name for rule, _, _ in rule_set.evaluate(device_id, values)]
+
+    def test_threshold_and_occupancy(self):
+        rule_set = RuleSet(edge=False, configs=[
+            {"name": "busy", "type": "threshold", "field": "free_spots", "op": "<", "value": 3},
+            {"name": "almost_full", "type": "occupancy", "op": ">=", "value": 90},
+        ])
+        self.assertEqual(self.fired(rule_set, "d", free_spots=50, total_capacity=100), [])
+        self.assertEqual(self.fired(rule_set, "d", free_spots=5, total_capacity=50), ["almost_full"])
+        self.assertEqual(self.fired(rule_set, "d", free_spots=2, total_capacity=100), ["busy", "almost_full"])
+        # No capacity in the reading: occupancy rules stay silent
+        self.assertEqual(self.fired(rule_set, "d", free_spots=50), [])
+
+    def test_window_min_matches(self):
+        rule_set = RuleSet(edge=False, configs=[
+            {"name": "mostly_full", "type": "window", "field": "free_spots", "op": "<=", "value": 2,
+             "window": 4, "min_matches": 3},
+        ])
+        results = [self.fired(rule_set, "d", free_spots=v) for v in (1, 9, 1, 1, 9, 9)]
+        self.assertEqual(results, [[], [], [], ["mostly_full"], [], []])
+
+    def test_rate_of_change(self):
+        rule_set = RuleSet(edge=False, configs=[
+            {"name": "filling_fast", "type": "rate_of_change", "field": "free_spots", "op": "<=", "value": -20},
+        ])
+        self.assertEqual(self.fired(rule_set, "d", free_spots=100), [])
+        self.assertEqual(self.fired(rule_set, "d", free_spots=90), [])
+        fired = rule_set.evaluate("d", {"free_spots": 60})
+        self.assertEqual([(rule.value_field, value) for rule, value, _ in fired], [("free_spots_delta", -30)])
+
+    def test_rules_share_state(self):
+        rule_set = RuleSet([
+            {"name": "a", "type": "window", "field": "free_spots", "op": ">", "value": 5, "window": 10},
+            {"name": "b", "type": "window", "field": "free_spots", "op": "<", "value": 2, "window": 10},
+            {"name": "c", "type": "window", "field": "free_spots", "op": ">", "value": 5, "window": 5},
+            {"name": "d", "type": "rate_of_change", "field": "free_spots", "value": 0},
+            {"name": "e", "type": "rate_of_change", "field": "free_spots", "op": "<", "value": 0},
+        ])
+        self.assertEqual(len(rule_set.window_stores), 2)
+        self.assertEqual(len(rule_set.last_value_stores), 1)
+
+    def test_edge_triggered_firing_and_resolve(self):
+        rule_set = RuleSet([{"name": "busy", "type": "threshold", "field": "free_spots", "op": "<", "value": 3}])
+        states = [[(rule.name, value, state) for rule, value, state in rule_set.evaluate("d", {"free_spots": v})]
+                  for v in (5, 2, 1, 0, 4, 5)]
+        self.assertEqual(states, [[], [("busy", 2, "firing")], [], [], [("busy", 4, "resolved")], []])
+        self.assertEqual(rule_set.active_alerts(), 0)
+
+    def test_renotify_interval(self):
+        rule_set = RuleSet([{"name": "busy", "type": "threshold", "field": "free_spots", "op": "<", "value": 3}],
+                           renotify_seconds=60)
+        emitted = [len(rule_set.evaluate("d", {"free_spots": 1}, now=t)) for t in (0, 30, 59, 60, 90, 121)]
+        self.assertEqual(emitted, [1, 0, 0, 1, 0, 1])
+
+    def test_hysteresis(self):
+        rule_set = RuleSet([{"name": "free", "type": "threshold", "field": "free_spots", "op": ">", "value": 5,
+                             "hysteresis": 2}])
+        emitted = [[state for _, _, state in rule_set.evaluate("d", {"free_spots": v})]
+                   for v in (6, 5, 4, 6, 3, 4)]
+        self.assertEqual(emitted, [["firing"], [], [], [], ["resolved"], []])
+
+    def test_edge_triggered_window(self):
+        rule_set = RuleSet([{"name": "lasting", "type": "window", "field": "free_spots", "op": ">", "value": 5,
+                             "window": 3}])
+        emitted = [[state for _, _, state in rule_set.evaluate("d", {"free_spots": v})]
+                   for v in (9, 9, 9, 9, 9, 1, 9)]
+        self.assertEqual(emitted, [[], [], ["firing"], [], [], ["resolved"], []])
+
+    def test_evicted_device_starts_over(self):
+        evicted = []
+        rule_set = RuleSet([{"name": "lasting", "type": "window", "field": "free_spots", "op": ">", "value": 5,
+                             "window": 2}], max_devices=1, on_evict=lambda *args: evicted.append(args))
+        states = [[state for _, _, state in rule_set.evaluate(d, {"free_spots": 9}, now=t)]
+                  for t, d in enumerate(("a", "a", "b", "a", "a"))]
+        self.assertEqual(states, [[], ["firing"], [], [], ["firing"]])
+        self.assertEqual(evicted, [("a", "capacity"), ("b", "capacity")])
+        self.assertEqual(rule_set.active_alerts(), 1)
+        size = rule_set.state_bytes()
+        for t in range(100):
+            rule_set.evaluate(f"dev{t}", {"free_spots": 9}, now=10 + t)
+        self.assertEqual(rule_set.state_bytes(), size)
+
+    def test_device_ttl(self):
+        rule_set = RuleSet([{"name": "fast", "type": "rate_of_change", "field": "free_spots", "value": 5}],
+                           edge=False, device_ttl=60)
+        deltas = [[value for _, value, _ in rule_set.evaluate("d", {"free_spots": v}, now=t)]
+                  for t, v in ((0, 0), (30, 10), (3600, 30), (3610, 40))]
+        # After an hour of silence the previous value is forgotten, so there is no delta
+        self.assertEqual(deltas, [[], [10], [], [10]])
+        self.assertEqual(len(rule_set.index), 1)
+
+    def test_invalid_rules(self):
+        with self.assertRaises(ValueError):
+            RuleSet([{"name": "x", "type": "threshold", "field": "free_spots", "op": "~", "value": 1}])
+        with self.assertRaises(ValueError):
+            RuleSet([{"name": "x", "type": "magic", "field": "free_spots", "value": 1}])
+        with self.assertRaises(ValueError):
+            RuleSet([{"name": "x", "type": "window", "field": "free_spots", "value": 1, "window": 3, "min_matches": 4}])
+
+
+class TestCheckpoint(unittest.TestCase):
+    RULES = [
+        {"name": "lasting", "type": "window", "field": "free_spots", "op": ">", "value": 5, "window": 3},
+        {"name": "fast", "type": "rate_of_change", "field": "free_spots", "value": 5},
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "state", "rule_engine.ckpt")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def feed(self, rule_set, device_id, *values):
+        return [[(rule.name, state) for rule, _, state in rule_set.evaluate(device_id, {"free_spots": v}, now=1)]
+                for v in values]
+
+    def test_warm_restart(self):
+        before = RuleSet(self.RULES)
+        self.feed(before, "a", 9, 9, 9)
+        self.feed(before, "b", 9, 9)
+        self.assertTrue(Checkpointer(before, self.path).save())
+
+        after = RuleSet(self.RULES)
+        self.assertEqual(Checkpointer(after, self.path).load(), 2)
+        self.assertEqual(after.active_alerts(), 1)
+        # "b" had two readings in its window, the third one fires without a cold start
+        self.assertEqual(self.feed(after, "b", 9), [[("lasting", "firing")]])
+        self.assertEqual(self.feed(after, "a", 1), [[("lasting", "resolved")]])
+        self.assertEqual(self.feed(after, "c", 9), [[]])
+
+    def test_scheduled_save_in_background(self):
+        rule_set = RuleSet(self.RULES)
+        checkpointer = Checkpointer(rule_set, self.path, interval=0)
+        self.feed(rule_set, "a", 9)
+        checkpointer.maybe_save()
+        # The snapshot is taken before maybe_save returns; later readings are not in it
+        self.feed(rule_set, "b", 9)
+        checkpointer._writer.join()
+        self.assertGreater(checkpointer.size, 0)
+        restored = RuleSet(self.RULES)
+        self.assertEqual(Checkpointer(restored, self.path).load(), 1)
+
+    def test_changed_threshold_recounts_windows(self):
+        before = RuleSet(self.RULES)
+        self.feed(before, "a", 7, 7)
+        Checkpointer(before, self.path).save()
+        after = RuleSet([dict(self.RULES[0], value=8)])
+        Checkpointer(after, self.path).load()
+        store = after.window_stores["free_spots", 3]
+        self.assertEqual(store.count(after.index.slot("a"), 0), 0)
+        self.assertEqual(store.readings(after.index.slot("a")), [7.0, 7.0])
+
+    def test_max_devices_lowered(self):
+        before = RuleSet(self.RULES)
+        for device_id in ("a", "b", "c"):
+            self.feed(before, device_id, 9)
+        Checkpointer(before, self.path).save()
+        after = RuleSet(self.RULES, max_devices=2)
+        self.assertEqual(Checkpointer(after, self.path).load(), 2)
+        self.assertNotIn("a", after.index)
+        self.assertEqual(self.feed(after, "d", 9, 9, 9)[2], [("lasting", "firing")])
+
+    def test_missing_or_corrupt_checkpoint(self):
+        rule_set = RuleSet(self.RULES)
+        self.assertEqual(Checkpointer(rule_set, self.path).load(), 0)
+        with open(self.path, "wb") as f:
+            f.write(b"not a checkpoint")
+        with self.assertLogs("checkpoint", level="ERROR"):
+            self.assertEqual(Checkpointer(rule_set, self.path).load(), 0)
+        self.assertEqual(len(rule_set.index), 0)
+
+
+class TestFleet(unittest.TestCase):
+    def test_readings_apply_deltas(self):
+        fleet = FleetAggregator()
+        fleet.update(1, 10, 40)
+        fleet.update(2, 0, 60)
+        fleet.update(1, 4)
+        self.assertEqual(fleet.summary()["fleet"], {
+            "lots": 2, "lots_with_space": 1, "free_spots": 4, "total_capacity": 100,
+            "occupied_spots": 96, "occupancy_pct": 96.0,
+        })
+        fleet.update(2, 30, 60)
+        self.assertEqual(fleet.summary()["fleet"]["lots_with_space"], 2)
+        self.assertEqual(fleet.summary()["fleet"]["free_spots"], 34)
+
+    def test_unknown_capacity_is_left_out_of_occupancy(self):
+        fleet = FleetAggregator()
+        fleet.update("a", 5)
+        totals = fleet.summary()["fleet"]
+        self.assertEqual((totals["free_spots"], totals["occupancy_pct"]), (5, None))
+
+    def test_zones_and_removal(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "zones.json")
+        with open(path, "w") as f:
+            json.dump({"center": [1, 2], "north": ["3"]}, f)
+        fleet = FleetAggregator(load_zones(path))
+        for device_id, free in ((1, 2), (2, 3), (3, 0), (4, 7)):
+            fleet.update(device_id, free, 10)
+        summary = fleet.summary()
+        self.assertEqual(summary["fleet"]["free_spots"], 12)
+        self.assertEqual(summary["zones"]["center"]["free_spots"], 5)
+        self.assertEqual(summary["zones"]["north"]["lots_with_space"], 0)
+        fleet.remove(2)
+        fleet.remove(99)
+        summary = fleet.summary()
+        self.assertEqual((summary["fleet"]["lots"], summary["zones"]["center"]["free_spots"]), (3, 2))
+
+    def test_device_back_after_ttl_stays_counted(self):
+        fleet = FleetAggregator({"1": "center"})
+        rule_set = RuleSet(DEFAULT_RULES, device_ttl=60, on_evict=device_evicted)
+        with mock.patch('rule_engine.fleet', fleet), mock.patch('rule_engine.rule_set', rule_set), \
+                mock.patch('rule_engine.write_api'), mock.patch('rules.time.time') as now:
+            now.return_value = 1000.0
+            on_message(None, None, make_message('{"device_id": 1, "free_spots": 3, "total_capacity": 10}'))
+            now.return_value = 2000.0
+            on_message(None, None, make_message('{"device_id": 1, "free_spots": 4, "total_capacity": 10}'))
+        self.assertEqual(len(rule_set.index), 1)
+        summary = fleet.summary()
+        self.assertEqual((summary["fleet"]["lots"], summary["fleet"]["free_spots"]), (1, 4))
+        self.assertEqual((summary["zones"]["center"]["lots"], summary["zones"]["center"]["free_spots"]), (1, 4))
+
+    def test_summary_is_published(self):
+        fleet = FleetAggregator()
+        client = mock.MagicMock()
+        with mock.patch('rule_engine.fleet', fleet), mock.patch('rule_engine.rule_set', RuleSet(DEFAULT_RULES)), \
+                mock.patch('rule_engine.write_api'):
+            on_message(None, None, make_message(encode_readings([
+                {"device_id": 1, "free_spots": 3, "total_capacity": 10},
+                {"device_id": 2, "free_spots": 0, "total_capacity": 10},
+            ])))
+            publish_summary(client)
+        topic, payload = client.publish.call_args[0]
+        self.assertEqual(topic, "parking/summary")
+        self.assertTrue(client.publish.call_args.kwargs["retain"])
+        summary = json.loads(payload)
+        self.assertEqual((summary["fleet"]["free_spots"], summary["fleet"]["occupancy_pct"]), (3, 85.0))
+
+
+class TestOnMessage(unittest.TestCase):
+    @mock.patch('rule_engine.rule_set', RuleSet(DEFAULT_RULES))
+    @mock.patch('rule_engine.write_api')
+    def test_instant_and_lasting_alerts(self, mock_write_api):
+        for _ in range(9):
+            on_message(None, None, make_message('{"device_id": "dev1", "free_spots": 8}'))
+        # Edge-triggered: the instant alert is written once, not per packet
+        measurements = [p._name for p in written_points(mock_write_api)]
+        self.assertEqual(measurements, ["rule_instant"])
+
+        on_message(None, None, make_message('{"device_id": "dev1", "free_spots": 8}'))
+        self.assertEqual([p._name for p in written_points(mock_write_api)], ["rule_instant", "rule_lasting"])
+
+        on_message(None, None, make_message('{"device_id": "dev1", "free_spots": 1}'))
+        resolved = written_points(mock_write_api)[2:]
+        self.assertEqual(sorted(p._name for p in resolved), ["rule_instant", "rule_lasting"])
+        self.assertTrue(all(p._fields["state"] == "resolved" for p in resolved))
+
+    @mock.patch('rule_engine.rule_set', RuleSet(DEFAULT_RULES))
+    @mock.patch('rule_engine.write_api')
+    def test_batch_is_written_once(self, mock_write_api):
+        readings = [{"device_id": f"dev{i}", "free_spots": 9} for i in range(5)]
+        on_message(None, None, make_message(encode_readings(readings)))
+        mock_write_api.write.assert_called_once()
+        self.assertEqual(len(written_points(mock_write_api)), 5)
+
+    @mock.patch('rule_engine.rule_set', RuleSet(DEFAULT_RULES))
+    @mock.patch('rule_engine.write_api')
+    def test_bad_reading_does_not_drop_batch(self, mock_write_api):
+        payload = b'{"readings": [{"device_id": "a", "free_spots": "x"}, {"device_id": "b", "free_spots": 9}]}'
+        with self.assertLogs(logger, level='ERROR'):
+            on_message(None, None, make_message(payload))
+        self.assertEqual([p._tags["device_id"] for p in written_points(mock_write_api)], ["b"])
+
+    @mock.patch('rule_engine.rule_set', RuleSet(DEFAULT_RULES))
+    @mock.patch('rule_engine.write_api')
+    def test_booleans_and_fractions_are_dropped_as_invalid(self, mock_write_api):
+        invalid = REGISTRY.get_sample_value("readings_dropped_total", {"reason": "invalid"}) or 0
+        payload = b'{"readings": [{"device_id": "a", "free_spots": true}, {"device_id": "b", "free_spots": 8.5}]}'
+        with self.assertLogs(logger, level='ERROR'):
+            on_message(None, None, make_message(payload))
+        self.assertEqual(REGISTRY.get_sample_value("readings_dropped_total", {"reason": "invalid"}) - invalid, 2)
+        mock_write_api.write.assert_not_called()
+
+    @mock.patch('rule_engine.write_api')
+    def test_no_alert_below_threshold(self, mock_write_api):
+        on_message(None, None, make_message('{"device_id": "dev2", "free_spots": 3}'))
+        mock_write_api.write.assert_not_called()
+
+    @mock.patch('rule_engine.write_api')
+    def test_malformed_json(self, mock_write_api):
+        with self.assertLogs(logger, level='ERROR') as cm:
+            on_message(None, None, make_message('invalid json'))
+        self.assertTrue(any("Error processing message" in msg for msg in cm.output))
+        mock_write_api.write.assert_not_called()
+
+
+class TestMetrics(unittest.TestCase):
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    @mock.patch('rule_engine.write_api')
+    def test_alert_and_evaluation_counters(self, mock_write_api):
+        fired = self.sample("alerts_total", rule="instant", state="firing")
+        evaluations = self.sample("rule_evaluations_total")
+        on_message(None, None, make_message(encode_readings([
+            {"device_id": "metrics-1", "free_spots": 50},
+            {"device_id": "metrics-2", "free_spots": 1},
+        ])))
+        self.assertEqual(self.sample("alerts_total", rule="instant", state="firing") - fired, 1)
+        self.assertEqual(self.sample("rule_evaluations_total") - evaluations, 2 * len(DEFAULT_RULES))
+        self.assertEqual(len(written_points(mock_write_api)), 1)
+        self.assertGreaterEqual(self.sample("rule_engine_devices"), 2)
+
+    @mock.patch('rule_engine.write_api')
+    def test_invalid_readings_are_not_evaluated(self, _mock_write_api):
+        evaluations = self.sample("rule_evaluations_total")
+        payload = b'{"readings": [{"device_id": "metrics-3", "free_spots": 4}, {"device_id": "metrics-4"}]}'
+        with self.assertLogs(logger, level='ERROR'):
+            on_message(None, None, make_message(payload))
+        self.assertEqual(self.sample("rule_evaluations_total") - evaluations, len(DEFAULT_RULES))
+
+
+class TestSubscriptions(unittest.TestCase):
+    def test_plain_topic(self):
+        mock_client = mock.MagicMock()
+        on_connect(mock_client, None, None, 0)
+        mock_client.subscribe.assert_called_once_with([('rule_engine_topic', 0)])
+
+    @mock.patch('rule_engine.RULE_ENGINE_PARTITIONS', 6)
+    @mock.patch('rule_engine.RULE_ENGINE_INSTANCE_COUNT', 2)
+    @mock.patch('rule_engine.RULE_ENGINE_INSTANCE_INDEX', 1)
+    def test_partitions_of_instance(self):
+        self.assertEqual(subscription_topics(),
+                         ['rule_engine_topic/1', 'rule_engine_topic/3', 'rule_engine_topic/5'])
+
+    @mock.patch('rule_engine.MQTT_SHARED_GROUP', 'engines')
+    def test_shared_subscription(self):
+        self.assertEqual(subscription_topics(), ['$share/engines/rule_engine_topic'])
+
+
+if __name__ == '__main__':
+    unittest.main()
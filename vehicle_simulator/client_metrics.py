@@ -0,0 +1,182 @@
+import json
+import logging
+import math
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger('client_metrics')
+
+# Границы бакетов, которые отдаются в Prometheus, секунды
+PROMETHEUS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Внутренние логарифмические бакеты для перцентилей: от 0.1 мс, шаг 5%
+FINE_MIN = 0.0001
+FINE_GROWTH = 1.05
+FINE_BUCKETS = 300  # покрывает задержки до ~4 минут
+
+OUTCOME_SUCCESS = 'success'
+OUTCOME_CONFLICT = 'conflict'  # 409, например место уже занято
+OUTCOME_ERROR = 'error'
+OUTCOMES = (OUTCOME_SUCCESS, OUTCOME_CONFLICT, OUTCOME_ERROR)
+
+
+def outcome_for_status(status):
+    if status < 400:
+        return OUTCOME_SUCCESS
+    return OUTCOME_CONFLICT if status == 409 else OUTCOME_ERROR
+
+
+class LatencyHistogram:
+    """Гистограмма задержек: точные (до 5%) перцентили и бакеты для Prometheus."""
+
+    def __init__(self):
+        self.fine = [0] * FINE_BUCKETS
+        self.buckets = [0] * (len(PROMETHEUS_BUCKETS) + 1)  # последний - +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._log_growth = math.log(FINE_GROWTH)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[bisect_left(PROMETHEUS_BUCKETS, seconds)] += 1
+        if seconds <= FINE_MIN:
+            index = 0
+        else:
+            index = min(FINE_BUCKETS - 1, int(math.log(seconds / FINE_MIN) / self._log_growth) + 1)
+        self.fine[index] += 1
+
+    def percentile(self, q):
+        """Верхняя граница бакета, в который попадает q-й перцентиль (0 < q <= 100)."""
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * q / 100.0)
+        seen = 0
+        for index, hits in enumerate(self.fine):
+            seen += hits
+            if seen >= rank:
+                return min(FINE_MIN * FINE_GROWTH ** index, self.max)
+        return self.max
+
+    def summary(self):
+        ms = 1000.0
+        return {
+            "count": self.count,
+            "mean_ms": round(self.sum / self.count * ms, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50) * ms, 3),
+            "p95_ms": round(self.percentile(95) * ms, 3),
+            "p99_ms": round(self.percentile(99) * ms, 3),
+            "max_ms": round(self.max * ms, 3),
+        }
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+
+    def record(self, seconds, outcome):
+        self.latency.observe(seconds)
+        self.outcomes[outcome] += 1
+
+
+class ClientMetrics:
+    """Задержки и исходы запросов симулятора к API по эндпоинтам.
+
+    Отдается в формате Prometheus (``render``) и итоговым JSON при завершении
+    (``summary`` / ``write_summary``), чтобы прогоны можно было сравнивать между
+    собой и с отчетами Tsung.
+    """
+
+    def __init__(self, prefix='vehicle_simulator'):
+        self.prefix = prefix
+        self.endpoints = {}
+        self.gauges = {}  # имя -> (описание, функция без аргументов)
+        self.started = time.time()
+        self._started_perf = time.perf_counter()
+        self._last_report = self._started_perf
+        self._last_counts = {}
+
+    def endpoint(self, name):
+        stats = self.endpoints.get(name)
+        if stats is None:
+            stats = self.endpoints[name] = EndpointStats()
+        return stats
+
+    def record(self, endpoint, seconds, outcome):
+        self.endpoint(endpoint).record(seconds, outcome)
+
+    def add_gauge(self, name, description, read):
+        self.gauges[name] = (description, read)
+
+    def elapsed(self):
+        return max(time.perf_counter() - self._started_perf, 1e-9)
+
+    def render(self):
+        """Текст для /metrics в формате Prometheus."""
+        name = f"{self.prefix}_request_duration_seconds"
+        lines = [f"# HELP {name} Client-side latency of API requests",
+                 f"# TYPE {name} histogram"]
+        for endpoint, stats in sorted(self.endpoints.items()):
+            latency = stats.latency
+            cumulative = 0
+            for bound, hits in zip(PROMETHEUS_BUCKETS, latency.buckets):
+                cumulative += hits
+                lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {latency.count}')
+            lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {latency.sum}')
+            lines.append(f'{name}_count{{endpoint="{endpoint}"}} {latency.count}')
+        name = f"{self.prefix}_requests_total"
+        lines += [f"# HELP {name} API requests by endpoint and outcome",
+                  f"# TYPE {name} counter"]
+        for endpoint, stats in sorted(self.endpoints.items()):
+            for outcome, count in stats.outcomes.items():
+                lines.append(f'{name}{{endpoint="{endpoint}",outcome="{outcome}"}} {count}')
+        for gauge, (description, read) in sorted(self.gauges.items()):
+            name = f"{self.prefix}_{gauge}"
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge", f"{name} {read()}"]
+        return "\n".join(lines) + "\n"
+
+    def summary(self, **run_info):
+        elapsed = self.elapsed()
+        endpoints = {}
+        for endpoint, stats in sorted(self.endpoints.items()):
+            endpoints[endpoint] = {
+                **stats.latency.summary(),
+                **stats.outcomes,
+                "requests_per_second": round(stats.latency.count / elapsed, 2),
+            }
+        total = sum(stats.latency.count for stats in self.endpoints.values())
+        return {
+            "started_at": self.started,
+            "seconds": round(elapsed, 3),
+            "requests": total,
+            "requests_per_second": round(total / elapsed, 2),
+            "endpoints": endpoints,
+            "gauges": {gauge: read() for gauge, (_, read) in self.gauges.items()},
+            "run": run_info,
+        }
+
+    def write_summary(self, path, **run_info):
+        summary = self.summary(**run_info)
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        logger.info(f"Client metrics summary written to {path}")
+        return summary
+
+    def report(self):
+        """Пишет в лог rps и p95 по эндпоинтам с прошлого вызова."""
+        now = time.perf_counter()
+        elapsed = max(now - self._last_report, 1e-9)
+        parts = []
+        for endpoint, stats in sorted(self.endpoints.items()):
+            count = stats.latency.count
+            rate = (count - self._last_counts.get(endpoint, 0)) / elapsed
+            self._last_counts[endpoint] = count
+            parts.append(f"{endpoint} {rate:.1f} req/s p95={stats.latency.percentile(95) * 1000:.1f}ms")
+        self._last_report = now
+        if parts:
+            logger.info("Client rates: " + ", ".join(parts))
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import random
+import time
+
+logger = logging.getLogger('status_snapshot')
+
+
+class WeightedIndex:
+    """Дерево Фенвика над весами: взвешенный выбор и обновление веса за O(log N)."""
+
+    def __init__(self, weights=()):
+        self.weights = list(weights)
+        n = len(self.weights)
+        tree = [0] * (n + 1)
+        for i, weight in enumerate(self.weights, 1):
+            tree[i] += weight
+            parent = i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self.tree = tree
+        self.total = sum(self.weights)
+        self._top = 1 << (n.bit_length() - 1) if n else 0  # старшая степень двойки <= n
+
+    def __len__(self):
+        return len(self.weights)
+
+    def update(self, i, weight):
+        delta = weight - self.weights[i]
+        if not delta:
+            return
+        self.weights[i] = weight
+        self.total += delta
+        tree = self.tree
+        i += 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def find(self, target):
+        """Индекс элемента, в чей отрезок накопленных весов попадает 0 <= target < total."""
+        tree = self.tree
+        n = len(tree) - 1
+        pos = 0
+        step = self._top
+        while step:
+            nxt = pos + step
+            if nxt <= n and tree[nxt] <= target:
+                pos = nxt
+                target -= tree[nxt]
+            step >>= 1
+        return pos
+
+    def pick(self, rng=random):
+        if self.total <= 0:
+            return None
+        return self.find(rng.random() * self.total)
+
+
+class StatusSnapshot:
+    """Общий для всех машин снимок /parking/status.
+
+    Список парковок запрашивается одним фоновым циклом раз в ``refresh_interval``
+    секунд, а не каждой машиной. Между обновлениями снимок получает push-обновления
+    (бронирование занимает место, освобождение возвращает), вес парковки - число
+    свободных мест.
+    """
+
+    def __init__(self, fetch, refresh_interval=5.0):
+        self.fetch = fetch  # async () -> список парковок
+        self.refresh_interval = refresh_interval
+        self.lots = []
+        self.positions = {}  # parking_id -> индекс в lots
+        self.index = WeightedIndex()
+        self.updated_at = None
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self.lots)
+
+    def load(self, parking_lots):
+        lots = [p for p in parking_lots if p.get("id") is not None]
+        self.lots = lots
+        self.positions = {p["id"]: i for i, p in enumerate(lots)}
+        self.index = WeightedIndex([max(0, p.get("freeSpots", 0)) for p in lots])
+        self.updated_at = time.monotonic()
+        self.ready.set()
+
+    def free_spots(self, parking_id):
+        i = self.positions.get(parking_id)
+        return None if i is None else self.index.weights[i]
+
+    def update(self, parking_id, free_spots):
+        i = self.positions.get(parking_id)
+        if i is None:
+            return
+        free_spots = max(0, free_spots)
+        self.lots[i]["freeSpots"] = free_spots
+        self.index.update(i, free_spots)
+
+    def adjust(self, parking_id, delta):
+        current = self.free_spots(parking_id)
+        if current is not None:
+            self.update(parking_id, current + delta)
+
+    def pick(self):
+        """Парковка, выбранная с весом по свободным местам, или None, если мест нет."""
+        i = self.index.pick()
+        return None if i is None else self.lots[i]
+
+    async def refresh(self):
+        self.load(await self.fetch() or [])
+        logger.debug(f"Status snapshot: {len(self.lots)} parking lots, {self.index.total} free spots")
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Оставляем предыдущий снимок, машины продолжают работать по нему
+                logger.error(f"Error refreshing parking status: {e}")
+            await asyncio.sleep(self.refresh_interval)
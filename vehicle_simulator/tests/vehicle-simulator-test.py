@@ -0,0 +1,155 @@
+import unittest
+from unittest import mock
+import asyncio
+import random
+from bisect import bisect_right
+from itertools import accumulate
+from status_snapshot import WeightedIndex, StatusSnapshot
+from client_metrics import (ClientMetrics, LatencyHistogram, OUTCOME_SUCCESS, OUTCOME_CONFLICT, OUTCOME_ERROR,
+                            outcome_for_status)
+from vehicle_simulator import ReleaseScheduler
+
+class TestWeightedIndex(unittest.TestCase):
+    def assert_matches_prefix_sums(self, index):
+        prefix = list(accumulate(index.weights))
+        self.assertEqual(index.total, prefix[-1] if prefix else 0)
+        for target in range(index.total):
+            # Index of the first prefix sum above target: zero weights are never found
+            self.assertEqual(index.find(target), bisect_right(prefix, target), (index.weights, target))
+
+    def test_find_matches_prefix_sums(self):
+        rng = random.Random(3)
+        for size in (1, 2, 5, 8, 13, 64, 100):
+            weights = [rng.choice((0, 1, 2, 7)) for _ in range(size)]
+            self.assert_matches_prefix_sums(WeightedIndex(weights))
+
+    def test_update_keeps_prefix_sums(self):
+        rng = random.Random(5)
+        index = WeightedIndex([rng.randint(0, 5) for _ in range(37)])
+        for _ in range(200):
+            index.update(rng.randrange(len(index)), rng.randint(0, 5))
+        self.assert_matches_prefix_sums(index)
+        self.assertEqual(index.tree, WeightedIndex(index.weights).tree)
+
+    def test_pick(self):
+        self.assertIsNone(WeightedIndex().pick())
+        self.assertIsNone(WeightedIndex([0, 0]).pick())
+        index = WeightedIndex([0, 3, 0, 1])
+        rng = mock.Mock()
+        rng.random.return_value = 0.5
+        self.assertEqual(index.pick(rng), 1)
+        rng.random.return_value = 0.99
+        self.assertEqual(index.pick(rng), 3)
+
+class TestStatusSnapshot(unittest.TestCase):
+    LOTS = [{"id": 1, "freeSpots": 4}, {"id": 2, "freeSpots": -2}, {"freeSpots": 9}, {"id": 3, "freeSpots": 0}]
+
+    def snapshot(self):
+        snapshot = StatusSnapshot(fetch=None)
+        snapshot.load([dict(lot) for lot in self.LOTS])
+        return snapshot
+
+    def test_load_skips_lots_without_id(self):
+        snapshot = self.snapshot()
+        self.assertEqual(len(snapshot), 3)
+        self.assertEqual([snapshot.free_spots(i) for i in (1, 2, 3, 4)], [4, 0, 0, None])
+        self.assertEqual(snapshot.index.total, 4)
+        self.assertTrue(snapshot.ready.is_set())
+
+    def test_updates_move_the_weights(self):
+        snapshot = self.snapshot()
+        snapshot.update(3, 5)
+        snapshot.adjust(1, -1)
+        snapshot.adjust(2, -1)
+        snapshot.update(42, 10)
+        self.assertEqual([snapshot.free_spots(i) for i in (1, 2, 3)], [3, 0, 5])
+        self.assertEqual(snapshot.lots[2]["freeSpots"], 5)
+        self.assertEqual(snapshot.index.total, 8)
+
+    def test_pick_only_lots_with_free_spots(self):
+        snapshot = self.snapshot()
+        self.assertEqual({snapshot.pick()["id"] for _ in range(50)}, {1})
+        snapshot.adjust(1, -4)
+        self.assertIsNone(snapshot.pick())
+
+    def test_refresh_replaces_the_snapshot(self):
+        async def fetch():
+            return [{"id": 7, "freeSpots": 2}]
+
+        snapshot = self.snapshot()
+        snapshot.fetch = fetch
+        asyncio.run(snapshot.refresh())
+        self.assertEqual([lot["id"] for lot in snapshot.lots], [7])
+        self.assertEqual(snapshot.free_spots(1), None)
+
+class TestClientMetrics(unittest.TestCase):
+    def test_outcome_for_status(self):
+        self.assertEqual([outcome_for_status(s) for s in (200, 204, 409, 404, 500)],
+                         [OUTCOME_SUCCESS, OUTCOME_SUCCESS, OUTCOME_CONFLICT, OUTCOME_ERROR, OUTCOME_ERROR])
+
+    def test_percentiles_within_bucket_precision(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 101):
+            histogram.observe(ms / 1000)
+        self.assertAlmostEqual(histogram.percentile(50), 0.050, delta=0.050 * 0.05)
+        self.assertAlmostEqual(histogram.percentile(99), 0.099, delta=0.099 * 0.05)
+        self.assertEqual(histogram.percentile(100), 0.1)
+        self.assertEqual(LatencyHistogram().percentile(95), 0.0)
+
+    def test_record_render_and_summary(self):
+        metrics = ClientMetrics(prefix='sim')
+        metrics.record('book', 0.003, OUTCOME_SUCCESS)
+        metrics.record('book', 0.2, OUTCOME_CONFLICT)
+        metrics.record('status', 20.0, OUTCOME_ERROR)
+        metrics.add_gauge('vehicles', 'Vehicles running', lambda: 5)
+        text = metrics.render()
+        self.assertIn('sim_request_duration_seconds_bucket{endpoint="book",le="0.005"} 1', text)
+        self.assertIn('sim_request_duration_seconds_bucket{endpoint="book",le="0.25"} 2', text)
+        self.assertIn('sim_request_duration_seconds_bucket{endpoint="status",le="10.0"} 0', text)
+        self.assertIn('sim_request_duration_seconds_bucket{endpoint="status",le="+Inf"} 1', text)
+        self.assertIn('sim_requests_total{endpoint="book",outcome="conflict"} 1', text)
+        self.assertIn('sim_vehicles 5', text)
+        summary = metrics.summary(vehicles=5)
+        self.assertEqual(summary["requests"], 3)
+        self.assertEqual(summary["endpoints"]["book"]["success"], 1)
+        self.assertEqual(summary["endpoints"]["status"]["max_ms"], 20000.0)
+        self.assertEqual((summary["gauges"], summary["run"]), ({"vehicles": 5}, {"vehicles": 5}))
+
+class TestReleaseScheduler(unittest.TestCase):
+    def test_releases_fire_in_delay_order(self):
+        released = []
+
+        async def release(name):
+            released.append(name)
+
+        async def run():
+            scheduler = ReleaseScheduler()
+            for delay, name in ((0.03, "c"), (0.01, "a"), (0.02, "b")):
+                scheduler.schedule(delay, release, name)
+            self.assertEqual(scheduler.pending(), 3)
+            await asyncio.sleep(0.1)
+            return scheduler.pending()
+
+        self.assertEqual(asyncio.run(run()), 0)
+        self.assertEqual(released, ["a", "b", "c"])
+
+    def test_cancel_all_drops_pending_releases(self):
+        released = []
+
+        async def release(name):
+            released.append(name)
+
+        async def run():
+            scheduler = ReleaseScheduler()
+            scheduler.schedule(0, release, "now")
+            scheduler.schedule(60, release, "later")
+            await asyncio.sleep(0.01)
+            scheduler.cancel_all()
+            await asyncio.sleep(0)
+            return scheduler.pending()
+
+        self.assertEqual(asyncio.run(run()), 0)
+        self.assertEqual(released, ["now"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,13 @@
-import requests
+import aiohttp
+import asyncio
+import os
 import random
+import signal
 import time
-import threading
-import concurrent.futures
 import logging
-from datetime import datetime
+from aiohttp import web
+from client_metrics import ClientMetrics, OUTCOME_ERROR, outcome_for_status
+from status_snapshot import StatusSnapshot
 
 # Настройка логирования
 logging.basicConfig(
@@ -13,67 +16,161 @@ logging.basicConfig(
 )
 logger = logging.getLogger('vehicle_simulator')
 
-BASE_URL = "http://nginx:80"
-# Максимальное количество активных потоков освобождения
-MAX_RELEASE_THREADS = 500
-# Семафор для контроля количества потоков
-release_semaphore = threading.Semaphore(MAX_RELEASE_THREADS)
+BASE_URL = os.getenv('API_URL', 'http://nginx:80')
+NUM_VEHICLES = int(os.getenv('NUM_VEHICLES', '100'))
+# Все машины ходят в nginx через один пул keep-alive соединений
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '100'))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '10'))
+# Старт машин растягивается на это время, чтобы не бить в API одной волной
+VEHICLE_RAMP_SECONDS = float(os.getenv('VEHICLE_RAMP_SECONDS', '10'))
+# Как часто общий снимок /parking/status обновляется из API;
+# 0 - каждая машина запрашивает список сама перед каждой попыткой
+STATUS_REFRESH_INTERVAL = float(os.getenv('STATUS_REFRESH_INTERVAL', '5'))
+# Длительность прогона в секундах, 0 - до остановки контейнера
+SIMULATION_DURATION = float(os.getenv('SIMULATION_DURATION', '0'))
+# Порт /metrics для Prometheus, 0 - не поднимать
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9102'))
+# Итоговые задержки и счетчики пишутся сюда при завершении
+METRICS_SUMMARY_FILE = os.getenv('METRICS_SUMMARY_FILE', 'vehicle_simulator_summary.json')
+METRICS_REPORT_INTERVAL = float(os.getenv('METRICS_REPORT_INTERVAL', '30'))
+
+metrics = ClientMetrics()
+
+
+class ApiError(Exception):
+    def __init__(self, status, text):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.text = text
+
+
+# Ошибки запроса к API: код ответа >= 400, сетевые ошибки и таймауты
+REQUEST_ERRORS = (ApiError, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+async def api_request(session, method, path, endpoint, check=True, **kwargs):
+    """Запрос к API; тело ответа читается целиком, чтобы соединение вернулось в пул.
+
+    Задержка (вместе с чтением тела) и исход записываются в ``metrics`` по ``endpoint``.
+    """
+    started = time.perf_counter()
+    outcome = OUTCOME_ERROR
+    try:
+        async with session.request(method, f"{BASE_URL}{path}", **kwargs) as response:
+            outcome = outcome_for_status(response.status)
+            if check and response.status >= 400:
+                raise ApiError(response.status, await response.text())
+            if response.status == 200 and response.content_type == 'application/json':
+                return await response.json()
+            await response.read()
+            return None
+    except asyncio.CancelledError:
+        outcome = None  # Остановка симулятора, не ошибка API
+        raise
+    finally:
+        if outcome is not None:
+            metrics.record(endpoint, time.perf_counter() - started, outcome)
+
+
+def describe_error(e):
+    if isinstance(e, ApiError):
+        return f"{e}, Response: {e.text}"
+    return repr(e) if isinstance(e, asyncio.TimeoutError) else str(e)
+
+
+class VehicleLogger(logging.LoggerAdapter):
+    """Один логгер на все машины, id машины добавляется в сообщение."""
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['vehicle_id']}] {msg}", kwargs
+
+
+class ReleaseScheduler:
+    """Отложенные освобождения мест.
+
+    Освобождение - это таймер event loop, а не поток, который спит несколько минут,
+    поэтому число ожидающих освобождений не ограничено пулом потоков.
+    """
+
+    def __init__(self):
+        self.timers = set()
+        self.tasks = set()
+
+    def schedule(self, delay, coro_fn, *args):
+        loop = asyncio.get_running_loop()
+
+        def fire():
+            self.timers.discard(handle)
+            task = loop.create_task(coro_fn(*args))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        handle = loop.call_later(delay, fire)
+        self.timers.add(handle)
+
+    def pending(self):
+        return len(self.timers) + len(self.tasks)
+
+    def cancel_all(self):
+        for handle in self.timers:
+            handle.cancel()
+        for task in self.tasks:
+            task.cancel()
+        self.timers.clear()
+
 
 class Vehicle:
-    def __init__(self, vehicle_id):
+    def __init__(self, vehicle_id, session, scheduler, snapshot):
         self.vehicle_id = vehicle_id
-        self.logger = logging.getLogger(f'vehicle.{vehicle_id}')
+        self.session = session
+        self.scheduler = scheduler
+        self.snapshot = snapshot
+        self.logger = VehicleLogger(logging.getLogger('vehicle'), {'vehicle_id': vehicle_id})
         self.active_bookings = set()  # Отслеживаем активные бронирования
 
-    def release_spot(self, booking_id, parking_id, spot_number, delay_minutes, use_delete=True):
-        with release_semaphore:
+    async def request(self, method, path, endpoint, check=True, **kwargs):
+        return await api_request(self.session, method, path, endpoint, check, **kwargs)
+
+    def schedule_release(self, booking_id, parking_id, spot_number, delay_minutes, use_delete=True):
+        # Реалистичная задержка в минутах
+        actual_delay = random.uniform(delay_minutes * 0.8, delay_minutes * 1.2)
+        self.logger.info(f"Will release spot {spot_number} at parking {parking_id} in {actual_delay:.1f} minutes")
+        self.scheduler.schedule(actual_delay * 60, self.release_spot,
+                                booking_id, parking_id, spot_number, use_delete)
+
+    async def release_spot(self, booking_id, parking_id, spot_number, use_delete=True):
+        try:
+            # Проверяем, не было ли уже освобождено это бронирование
+            if booking_id not in self.active_bookings:
+                self.logger.warning(f"Booking {booking_id} not found in active bookings, possibly already released")
+                return
+
             try:
-                # Реалистичная задержка в минутах
-                actual_delay = random.uniform(delay_minutes * 0.8, delay_minutes * 1.2)
-                self.logger.info(f"Will release spot {spot_number} at parking {parking_id} in {actual_delay:.1f} minutes")
-                time.sleep(actual_delay * 60)  # Конвертация в секунды
-                
-                # Проверяем, не было ли уже освобождено это бронирование
-                if booking_id not in self.active_bookings:
-                    self.logger.warning(f"Booking {booking_id} not found in active bookings, possibly already released")
-                    return
-                
-                try:
-                    if use_delete:
-                        # Используем DELETE для полного удаления бронирования
-                        response = requests.delete(f"{BASE_URL}/parking/{booking_id}")
-                        response.raise_for_status()
-                        self.logger.info(f"Released spot {spot_number} at parking {parking_id}, booking_id: {booking_id} (deleted)")
-                    else:
-                        # Используем UPDATE для изменения статуса на неактивный
-                        payload = {"vehicleId": self.vehicle_id, "active": False}
-                        response = requests.put(
-                            f"{BASE_URL}/parking/{booking_id}",
-                            json=payload,
-                            headers={"Content-Type": "application/json"}
-                        )
-                        response.raise_for_status()
-                        self.logger.info(f"Released spot {spot_number} at parking {parking_id}, booking_id: {booking_id} (updated to inactive)")
-                    
-                    # Успешно освободили место
-                    if booking_id in self.active_bookings:
-                        self.active_bookings.remove(booking_id)
-                        
-                except requests.exceptions.RequestException as e:
-                    if hasattr(e, 'response') and e.response is not None:
-                        self.logger.error(f"Error releasing spot: {e}, Response: {e.response.text}")
-                    else:
-                        self.logger.error(f"Error releasing spot: {e}")
-            except Exception as e:
-                self.logger.error(f"Unexpected error in release_spot: {e}")
+                if use_delete:
+                    # Используем DELETE для полного удаления бронирования
+                    await self.request('DELETE', f"/parking/{booking_id}", 'release')
+                    self.logger.info(f"Released spot {spot_number} at parking {parking_id}, booking_id: {booking_id} (deleted)")
+                else:
+                    # Используем UPDATE для изменения статуса на неактивный
+                    payload = {"vehicleId": self.vehicle_id, "active": False}
+                    await self.request('PUT', f"/parking/{booking_id}", 'release', json=payload)
+                    self.logger.info(f"Released spot {spot_number} at parking {parking_id}, booking_id: {booking_id} (updated to inactive)")
+
+                # Успешно освободили место
+                self.active_bookings.discard(booking_id)
+                self.snapshot.adjust(parking_id, 1)
+
+            except REQUEST_ERRORS as e:
+                self.logger.error(f"Error releasing spot: {describe_error(e)}")
+        except Exception as e:
+            self.logger.error(f"Unexpected error in release_spot: {e}")
 
-    def get_random_spot_number(self, parking_id):
+    async def get_random_spot_number(self, parking_id):
         """Получить реалистичный номер места на парковке"""
         try:
             # Запрашиваем детали парковки для получения capacity
-            response = requests.get(f"{BASE_URL}/parking/{parking_id}")
-            if response.status_code == 200:
-                parking_details = response.json()
+            parking_details = await self.request('GET', f"/parking/{parking_id}", 'details', check=False)
+            if parking_details is not None:
                 capacity = parking_details.get("capacity", 100)
                 return random.randint(1, capacity)
             else:
@@ -84,126 +181,147 @@ class Vehicle:
             self.logger.error(f"Error getting spot number for parking {parking_id}: {e}")
             return random.randint(1, 50)
 
-    def run(self):
+    async def run(self, start_delay=0):
+        await asyncio.sleep(start_delay)
         while True:
             try:
-                # ИСПРАВЛЕНИЕ: Не используем геокоординаты, так как координаты парковок не настроены
-                # Запрос списка всех парковок без параметров фильтрации
-                self.logger.debug(f"Requesting all parking lots")
-                
-                try:
-                    # Первый вариант эндпоинта (список всех парковок)
-                    response = requests.get(f"{BASE_URL}/parking/status")
-                    
-                    # Если первый вариант не работает, пробуем альтернативный эндпоинт
-                    # if response.status_code != 200:
-                    #     self.logger.debug(f"First endpoint returned {response.status_code}, trying alternative")
-                    #     response = requests.get(f"{BASE_URL}/parking")
-                    
-                    response.raise_for_status()
-                    parking_lots = response.json()
-                    self.logger.info(f"Received {len(parking_lots)} parking lots")
-                    
-                    # Логирование первых трех парковок для отладки
-                    if len(parking_lots) > 0:
-                        sample = parking_lots[:min(3, len(parking_lots))]
-                        self.logger.debug(f"Sample parking lots: {sample}")
-                
-                except requests.exceptions.RequestException as e:
-                    if hasattr(e, 'response') and e.response is not None:
-                        self.logger.error(f"Error requesting parking list: {e}, Response: {e.response.text}")
-                    else:
-                        self.logger.error(f"Error requesting parking list: {e}")
-                    parking_lots = []
-                    time.sleep(5)  # Ожидание перед следующей попыткой
-                    continue
+                if STATUS_REFRESH_INTERVAL <= 0:
+                    # Запрос списка всех парковок без параметров фильтрации
+                    self.logger.debug(f"Requesting all parking lots")
+                    try:
+                        await self.snapshot.refresh()
+                        self.logger.info(f"Received {len(self.snapshot)} parking lots")
+                    except REQUEST_ERRORS as e:
+                        self.logger.error(f"Error requesting parking list: {describe_error(e)}")
+                        await asyncio.sleep(5)  # Ожидание перед следующей попыткой
+                        continue
+                else:
+                    await self.snapshot.ready.wait()
 
-                if parking_lots:
+                if len(self.snapshot):
                     # Выбираем парковку с приоритетом для тех, где больше свободных мест
-                    parking_with_spots = [p for p in parking_lots if p.get("freeSpots", 0) > 0]
-                    
-                    if not parking_with_spots:
+                    parking = self.snapshot.pick()
+
+                    if parking is None:
                         self.logger.info("No parking lots with free spots available")
-                        time.sleep(random.uniform(30, 60))
+                        await asyncio.sleep(random.uniform(30, 60))
                         continue
-                    
-                    # Взвешенный выбор парковки по количеству свободных мест
-                    weighted_choice = [(p, p.get("freeSpots", 0)) for p in parking_with_spots]
-                    parking = random.choices(
-                        [p[0] for p in weighted_choice],
-                        weights=[p[1] for p in weighted_choice]
-                    )[0]
-                    
+
                     parking_id = parking.get("id")
                     free_spots = parking.get("freeSpots", 0)
-                    
+
                     if free_spots > 0:
                         # Получаем номер места
                         spot_number = random.randint(1, 50)  # Упрощенный подход
-                        
+
                         # Бронирование места
                         payload = {"VehicleId": self.vehicle_id, "SpotNumber": spot_number}
                         self.logger.info(f"Trying to book spot {spot_number} at parking {parking_id}")
-                        
+
                         try:
-                            book_response = requests.post(
-                                f"{BASE_URL}/parking/{parking_id}/book",
-                                json=payload,
-                                headers={"Content-Type": "application/json"}
-                            )
-                            book_response.raise_for_status()
-                            booking_data = book_response.json()
+                            booking_data = await self.request('POST', f"/parking/{parking_id}/book", 'book', json=payload) or {}
                             booking_id = booking_data.get("booking_id", "unknown")
                             self.logger.info(f"Booked spot {spot_number} at parking {parking_id}, booking_id: {booking_id}")
-                            
+
                             # Добавляем бронирование в активные
                             self.active_bookings.add(booking_id)
-                            
+                            self.snapshot.adjust(parking_id, -1)
+
                             # Запрос маршрута
-                            time.sleep(random.uniform(1, 3))
-                            route_response = requests.get(f"{BASE_URL}/parking/{parking_id}/route")
-                            
+                            await asyncio.sleep(random.uniform(1, 3))
+                            await self.request('GET', f"/parking/{parking_id}/route", 'route', check=False)
+
                             # Запуск освобождения места через реалистичное время
                             delay_minutes = random.uniform(0.5, 2.0)  # 30-120 секунд для тестирования
-                            
-                            release_thread = threading.Thread(
-                                target=self.release_spot,
-                                args=(booking_id, parking_id, spot_number, delay_minutes, True),
-                                daemon=True
-                            )
-                            release_thread.start()
-                            
-                        except requests.exceptions.RequestException as e:
-                            if hasattr(e, 'response') and e.response:
-                                status = e.response.status_code
-                                error_text = e.response.text
-                                self.logger.error(f"Error booking spot: Status {status}: {error_text}")
-                                
+                            self.schedule_release(booking_id, parking_id, spot_number, delay_minutes, True)
+
+                        except REQUEST_ERRORS as e:
+                            if isinstance(e, ApiError):
+                                self.logger.error(f"Error booking spot: Status {e.status}: {e.text}")
+
                                 # Проверка на "призрачное" бронирование
-                                if "already booked" in error_text:
+                                if "already booked" in e.text:
                                     self.logger.warning(f"Spot {spot_number} already booked at parking {parking_id}")
-                                elif "column" in error_text and "not exist" in error_text:
+                                elif "column" in e.text and "not exist" in e.text:
                                     self.logger.warning("Possible 'ghost booking' detected.")
                             else:
-                                self.logger.error(f"Error booking spot: {e}")
+                                self.logger.error(f"Error booking spot: {describe_error(e)}")
                     else:
                         self.logger.info(f"No free spots at parking {parking_id}")
-                
+
                 # Случайная пауза между попытками бронирования
-                time.sleep(random.uniform(5, 10))  # Уменьшено для тестирования
-                
+                await asyncio.sleep(random.uniform(5, 10))  # Уменьшено для тестирования
+
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 self.logger.error(f"Unexpected error in run: {e}")
-                time.sleep(5)
+                await asyncio.sleep(5)
+
+
+async def serve_metrics(port):
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logger.info(f"Serving client metrics on :{port}/metrics")
+    return runner
+
+
+async def report_metrics(interval):
+    while True:
+        await asyncio.sleep(interval)
+        metrics.report()
+
+
+async def main(num_vehicles=NUM_VEHICLES, duration=SIMULATION_DURATION):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+    scheduler = ReleaseScheduler()
+    metrics.add_gauge('pending_releases', "Scheduled spot releases not yet sent", scheduler.pending)
+    metrics_runner = await serve_metrics(METRICS_PORT) if METRICS_PORT else None
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        snapshot = StatusSnapshot(lambda: api_request(session, 'GET', "/parking/status", 'status'),
+                                  STATUS_REFRESH_INTERVAL)
+        metrics.add_gauge('snapshot_free_spots', "Free spots in the shared status snapshot",
+                          lambda: snapshot.index.total)
+        vehicles = [Vehicle(f"car{i}", session, scheduler, snapshot) for i in range(1, num_vehicles + 1)]
+        logger.info(f"Starting {num_vehicles} vehicles over {VEHICLE_RAMP_SECONDS}s, "
+                    f"{HTTP_POOL_SIZE} pooled connections to {BASE_URL}")
+        tasks = [asyncio.create_task(vehicle.run(random.uniform(0, VEHICLE_RAMP_SECONDS)))
+                 for vehicle in vehicles]
+        if STATUS_REFRESH_INTERVAL > 0:
+            tasks.append(asyncio.create_task(snapshot.run()))
+        if METRICS_REPORT_INTERVAL > 0:
+            tasks.append(asyncio.create_task(report_metrics(METRICS_REPORT_INTERVAL)))
+        try:
+            await asyncio.wait_for(stop.wait(), duration or None)
+        except asyncio.TimeoutError:
+            logger.info(f"Simulation finished after {duration}s")
+        finally:
+            scheduler.cancel_all()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            run_info = {'vehicles': num_vehicles, 'pool_size': HTTP_POOL_SIZE,
+                        'status_refresh_interval': STATUS_REFRESH_INTERVAL}
+            if METRICS_SUMMARY_FILE:
+                summary = metrics.write_summary(METRICS_SUMMARY_FILE, **run_info)
+            else:
+                summary = metrics.summary(**run_info)
+            logger.info(f"Client metrics summary: {summary}")
 
-def vehicle_task(vehicle_id):
-    vehicle = Vehicle(f"car{vehicle_id}")
-    vehicle.run()
 
 if __name__ == "__main__":
-    # Уменьшаем количество автомобилей для тестирования
-    num_vehicles = 100
-    
-    # Создаем и запускаем пул потоков для автомобилей
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_vehicles) as executor:
-        executor.map(vehicle_task, range(1, num_vehicles + 1))
\ No newline at end of file
+    asyncio.run(main())